@@ -1,15 +1,86 @@
 import datetime
 import argparse
-from nlannuzel.sgrain.rain import RainAreas
+import json
+import signal
+import sys
 from nlannuzel.sgrain.geo import Location
 
+# The other modules are imported by the functions that use them, so that
+# commands answered from the cache or by the daemon don't import png,
+# urllib.request or NumPy, see _cached_result().
+
+
+def read_locations(f):
+    """read one location per line, as "latitude,longitude" (or separated
+    by spaces). Empty lines and lines starting with # are ignored."""
+    locations = []
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        lat, lon = line.replace(',', ' ').split()
+        locations.append(Location(lat=float(lat), lon=float(lon)))
+    return locations
+
+
+def _locations_from_args(parser, args):
+    """returns the locations given with -a and -o, and/or -f"""
+    locations = []
+    if args.latitude is not None or args.longitude is not None:
+        if args.latitude is None or args.longitude is None:
+            parser.error('both latitude and longitude are needed')
+        locations.append(Location(lat=float(args.latitude), lon=float(args.longitude)))
+    if args.locations:
+        if args.locations == '-':
+            locations.extend(read_locations(sys.stdin))
+        else:
+            with open(args.locations) as f:
+                locations.extend(read_locations(f))
+    if not locations:
+        parser.error('a location (-a and -o) or a file of locations (-f) is needed')
+    return locations
+
+
+def _time_from_args(args):
+    """the time given with -Y, -M, -D, -H and -m, or None"""
+    if not args.year:
+        return None
+    return datetime.datetime(
+        year=int(args.year),
+        month=int(args.month),
+        day=int(args.day),
+        hour=int(args.hour),
+        minute=int(args.minute))
+
+
+def _cached_result(rain, when, *query):
+    """returns (image_time, filepath, key, result): the time and file
+    of the image of when (the latest by default), the key of the query
+    in the results kept for this image, and the result kept for it, if
+    any (see cache.read_result())"""
+    from nlannuzel.sgrain import cache
+    image_time = rain.round_to_previous_5_min(when if when is not None else datetime.datetime.now())
+    filepath = f"{rain.cache_dir}/{rain.filename_of(image_time)}"
+    key = json.dumps([cache.key_of(rain.color_scale, rain.top_left, rain.bottom_right).hex(), *query])
+    return image_time, filepath, key, cache.read_result(filepath, key)
+
+
+def _save_result(image_time, filepath, key, result, result_time):
+    """keep the result of a query for the next identical query, if it
+    was answered with the image asked for, and not an older one
+    because it was not published yet"""
+    from nlannuzel.sgrain import cache
+    if result_time == image_time:
+        cache.write_result(filepath, key, result)
+
 
 def rain_intensity_at():
     parser = argparse.ArgumentParser(
         prog='rain-intensity-at',
         description="Tells if it's raining at the given location")
-    parser.add_argument('-a', '--latitude', required=True, help='latitude in decimal')
-    parser.add_argument('-o', '--longitude', required=True, help='longitude in decimal')
+    parser.add_argument('-a', '--latitude', help='latitude in decimal')
+    parser.add_argument('-o', '--longitude', help='longitude in decimal')
+    parser.add_argument('-f', '--locations', help='file with one "latitude,longitude" per line, or - to read them from stdin')
     parser.add_argument('-c', '--cachedir', help='directory that holds downloaded images')
     parser.add_argument('-O', '--output', help='output file')
     parser.add_argument('-p', '--squaresize', help='square area to consider around location (in pixels)')
@@ -21,35 +92,83 @@ def rain_intensity_at():
     parser.add_argument('-n', '--filter-noise', help='remove small pixel blobs (noise) in the radar image.' )
     args = parser.parse_args()
 
+    from nlannuzel.sgrain.rain import RainAreas
     rain = RainAreas(cache_dir=args.cachedir if args.cachedir else None)
-
-    dt = None
-    if args.year:
-        dt = datetime.datetime(
-            year=int(args.year),
-            month=int(args.month),
-            day=int(args.day),
-            hour=int(args.hour),
-            minute=int(args.minute))
-    rain.load_image(dt)
-
-    location = Location(
-        lat = float(args.latitude),
-        lon = float(args.longitude))
-    if args.filter_noise:
-        rain.remove_blobs(int(args.filter_noise))
+    dt = _time_from_args(args)
+    locations = _locations_from_args(parser, args)
     squaresize = int(args.squaresize) if args.squaresize else 0
+    filter_noise = int(args.filter_noise) if args.filter_noise else None
+    if args.output:  # the image is needed anyway
+        lines, _ = _intensities(parser, rain, args, dt, locations, squaresize, filter_noise)
+        print('\n'.join(lines))
+        return
+    cached = _cached_result(rain, dt, 'rain-intensity-at', [[location.lat, location.lon] for location in locations], squaresize, filter_noise)
+    if cached[-1] is not None:
+        print('\n'.join(cached[-1]))
+        return
+    lines, image_time = _intensities(parser, rain, args, dt, locations, squaresize, filter_noise)
+    print('\n'.join(lines))
+    _save_result(*cached[:-1], lines, image_time)
+
+
+def _query(rain, args, dt, locations, d=0, filter_noise=None, nearest=False, load=None, use_daemon=True):
+    """the reports of RainAreas.query() on locations, with the given
+    options. They come from the daemon if it is running, and the latest
+    image is asked for (dt is None). Otherwise, the image is loaded and
+    filtered here, by load() if given, and queried."""
+    from nlannuzel.sgrain import daemon
+    if dt is None and use_daemon:
+        reports = daemon.query(locations, d=d, filter_noise=filter_noise, nearest=nearest, path=daemon.socket_path(args.cachedir))
+        if reports is not None:
+            return reports
+    if load is not None:
+        load()
+    else:
+        rain.load_image(dt)
+        if filter_noise:
+            rain.remove_blobs(filter_noise)
+    return rain.query(locations, d=d, nearest=nearest)
+
+
+def _load_intensities(rain, args, dt, locations, squaresize, filter_noise):
+    """load the image for rain-intensity-at, only decoding the pixels
+    needed if possible, and save it with -O"""
+    location = locations[0]
+    if filter_noise or args.output or len(locations) > 1:
+        rain.load_image(dt)
+    else:
+        rain.load_image(dt, location=location, d=squaresize)  # the whole image isn't needed
+    if filter_noise:
+        rain.remove_blobs(filter_noise)
     if args.output:
         rain.save_intensity_map(file_path=args.output, location=location, d=squaresize)
-    print(rain.intensity_at(location, squaresize))
+
+
+def _intensities(parser, rain, args, dt, locations, squaresize, filter_noise):
+    """the output lines of rain-intensity-at, and the time of the
+    image used"""
+    reports = _query(rain, args, dt, locations, d=squaresize, filter_noise=filter_noise,
+                     load=lambda: _load_intensities(rain, args, dt, locations, squaresize, filter_noise),
+                     use_daemon=not args.output)
+    image_time = reports[0].image_time
+    if len(locations) == 1:
+        if not reports[0].inside_map:
+            parser.error('location is outside of covered area')
+        return [str(reports[0].mean_intensity if squaresize else reports[0].intensity)], image_time
+    lines = []
+    for report in reports:
+        intensity = report.mean_intensity if squaresize else report.intensity
+        lines.append(f"{report.location.lat},{report.location.lon},{intensity if report.inside_map else 'nan'}")
+    return lines, image_time
 
 
 def nearest_rain_spot():
     parser = argparse.ArgumentParser(
         prog='nearest-rain-spot',
         description="Tells where, or how far, is the nearest rain spot")
-    parser.add_argument('-a', '--latitude', required=True, help='latitude in decimal')
-    parser.add_argument('-o', '--longitude', required=True, help='longitude in decimal')
+    parser.add_argument('-a', '--latitude', help='latitude in decimal')
+    parser.add_argument('-o', '--longitude', help='longitude in decimal')
+    parser.add_argument('-f', '--locations', help='file with one "latitude,longitude" per line, or - to read them from stdin')
     parser.add_argument('-c', '--cachedir', help='directory that holds downloaded images')
     parser.add_argument('-O', '--output', help='output file')
     parser.add_argument('-Y', '--year', help='year to consider instead of current date/time' )
@@ -61,28 +180,150 @@ def nearest_rain_spot():
     parser.add_argument('-l', '--location', action='store_true', help='report coordinates instead of distance' )
     args = parser.parse_args()
 
+    from nlannuzel.sgrain.rain import RainAreas
     rain = RainAreas(cache_dir=args.cachedir if args.cachedir else None)
-
-    dt = None
-    if args.year:
-        dt = datetime.datetime(
-            year=int(args.year),
-            month=int(args.month),
-            day=int(args.day),
-            hour=int(args.hour),
-            minute=int(args.minute))
-    rain.load_image(dt)
-
-    location = Location(
-        lat = float(args.latitude),
-        lon = float(args.longitude))
-    if args.filter_noise:
-        rain.remove_blobs(int(args.filter_noise))
-    nearest_rain = rain.nearest_rain_location(location)
-    if nearest_rain is None:
-        print(100.0)   # home assistant doesn't seem to understand "NaN" or "inf"
+    dt = _time_from_args(args)
+    locations = _locations_from_args(parser, args)
+    filter_noise = int(args.filter_noise) if args.filter_noise else None
+    cached = _cached_result(rain, dt, 'nearest-rain', [[location.lat, location.lon] for location in locations], filter_noise, args.location)
+    if cached[-1] is not None:
+        print('\n'.join(cached[-1]))
         return
-    if args.location:
-        print(f"{nearest_rain.lat},{nearest_rain.lon}")
-        return
-    print(location.distance_to(nearest_rain))
+    lines, image_time = _nearest_rain_spots(parser, rain, args, dt, locations, filter_noise)
+    print('\n'.join(lines))
+    _save_result(*cached[:-1], lines, image_time)
+
+
+def _nearest_rain_spots(parser, rain, args, dt, locations, filter_noise):
+    """the output lines of nearest-rain, and the time of the image
+    used"""
+    reports = _query(rain, args, dt, locations, filter_noise=filter_noise, nearest=True)
+    image_time = reports[0].image_time
+    if len(locations) == 1:
+        report = reports[0]
+        if not report.inside_map:
+            parser.error('location is outside of covered area')
+        if report.nearest_rain is None:
+            return [str(100.0)], image_time   # home assistant doesn't seem to understand "NaN" or "inf"
+        if args.location:
+            return [f"{report.nearest_rain.lat},{report.nearest_rain.lon}"], image_time
+        return [str(report.nearest_rain_distance)], image_time
+    lines = []
+    for report in reports:
+        prefix = f"{report.location.lat},{report.location.lon}"
+        if not report.inside_map:
+            lines.append(f"{prefix},nan")
+        elif report.nearest_rain is None:
+            lines.append(f"{prefix},{'nan,nan' if args.location else 100.0}")
+        elif args.location:
+            lines.append(f"{prefix},{report.nearest_rain.lat},{report.nearest_rain.lon}")
+        else:
+            lines.append(f"{prefix},{report.nearest_rain_distance}")
+    return lines, image_time
+
+
+def rain_report():
+    parser = argparse.ArgumentParser(
+        prog='rain-report',
+        description="Tells how it's raining at the given locations, and where the nearest rain is, as JSON")
+    parser.add_argument('-a', '--latitude', help='latitude in decimal')
+    parser.add_argument('-o', '--longitude', help='longitude in decimal')
+    parser.add_argument('-f', '--locations', help='file with one "latitude,longitude" per line, or - to read them from stdin')
+    parser.add_argument('-c', '--cachedir', help='directory that holds downloaded images')
+    parser.add_argument('-p', '--squaresize', help='also report the mean intensity of the square area around locations (in pixels)')
+    parser.add_argument('-Y', '--year', help='year to consider instead of current date/time' )
+    parser.add_argument('-M', '--month', help='month to consider instead of current date/time' )
+    parser.add_argument('-D', '--day', help='day to consider instead of current date/time' )
+    parser.add_argument('-H', '--hour', help='hour to consider instead of current date/time' )
+    parser.add_argument('-m', '--minute', help='minute to consider instead of current date/time. Will be rounded down to 5 min.' )
+    parser.add_argument('-n', '--filter-noise', help='remove small pixel blobs (noise) in the radar image.' )
+    args = parser.parse_args()
+
+    from nlannuzel.sgrain.rain import RainAreas
+    rain = RainAreas(cache_dir=args.cachedir if args.cachedir else None)
+    dt = _time_from_args(args)
+    locations = _locations_from_args(parser, args)
+    squaresize = int(args.squaresize) if args.squaresize else 0
+    filter_noise = int(args.filter_noise) if args.filter_noise else None
+    cached = _cached_result(rain, dt, 'rain-report', [[location.lat, location.lon] for location in locations], squaresize, filter_noise)
+    report = cached[-1]
+    if report is None:
+        report, image_time = _report(rain, args, dt, locations, squaresize, filter_noise)
+        _save_result(*cached[:-1], report, image_time)
+    print(json.dumps(report))
+
+
+def _report(rain, args, dt, locations, squaresize, filter_noise):
+    """the output of rain-report, in the same format as the response of
+    the daemon to a query (see the daemon module), and the time of the
+    image used. All values come from a single query on one image."""
+    from nlannuzel.sgrain import daemon
+    reports = _query(rain, args, dt, locations, d=squaresize, filter_noise=filter_noise, nearest=True)
+    image_time = reports[0].image_time
+    return {
+        'image_time': image_time.isoformat(),
+        'reports': [daemon.report_to_dict(report) for report in reports],
+    }, image_time
+
+
+def sgrain_daemon():
+    parser = argparse.ArgumentParser(
+        prog='sgrain-daemon',
+        description="Keeps the latest radar image in memory, and answers rain-intensity-at and nearest-rain")
+    parser.add_argument('-c', '--cachedir', help='directory that holds downloaded images')
+    parser.add_argument('-s', '--socket', help='path of the socket to listen on, sgrain.sock in the cache directory by default')
+    args = parser.parse_args()
+
+    from nlannuzel.sgrain import daemon
+    rain_daemon = daemon.RainDaemon(cache_dir=args.cachedir, socket_path=args.socket)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # so that the socket is removed
+    try:
+        rain_daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def sgrain_prefetch():
+    parser = argparse.ArgumentParser(
+        prog='sgrain-prefetch',
+        description="Downloads radar images into the cache as soon as they are published")
+    parser.add_argument('-c', '--cachedir', help='directory that holds downloaded images')
+    parser.add_argument('-d', '--delay', default='30', help='seconds after the time of an image before trying to download it')
+    args = parser.parse_args()
+
+    from nlannuzel.sgrain import fetch
+    prefetcher = fetch.Prefetcher(cache_dir=args.cachedir, delay=float(args.delay))
+    signal.signal(signal.SIGTERM, lambda signum, frame: prefetcher.stop())
+    try:
+        prefetcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def _parse_time(parser, value):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        parser.error(f'invalid time {value}, expected e.g. 2025-10-15T16:30')
+
+
+def sgrain_backfill():
+    parser = argparse.ArgumentParser(
+        prog='sgrain-backfill',
+        description="Downloads all radar images of a time range into the cache")
+    parser.add_argument('start', help='time of the first image, e.g. 2025-10-15T16:30, or 2025-10-15 for the whole day')
+    parser.add_argument('end', nargs='?', help='time of the last image, end of the day of start by default')
+    parser.add_argument('-c', '--cachedir', help='directory that holds downloaded images')
+    parser.add_argument('-j', '--jobs', default='4', help='number of downloads at the same time')
+    parser.add_argument('-u', '--url', help='where images are downloaded from, instead of www.weather.gov.sg')
+    args = parser.parse_args()
+
+    start = _parse_time(parser, args.start)
+    if args.end is not None:
+        end = _parse_time(parser, args.end)
+    else:
+        end = datetime.datetime.combine(start.date(), datetime.time(23, 55))
+    from nlannuzel.sgrain import fetch
+    backfill = fetch.Backfill(cache_dir=args.cachedir, base_url=args.url, workers=int(args.jobs))
+    backfill.run(start, end)
+    print(backfill.report())
@@ -0,0 +1,126 @@
+"""RainAreas for asyncio applications, e.g. Home Assistant
+integrations, where nothing must block the event loop.
+
+Downloading and decoding images, finding blobs and answering queries
+run in an executor, images are downloaded the same way as RainAreas
+does. Callers that ask for the same image at the same time share a
+single download and decoding."""
+import asyncio
+import datetime
+import os
+import urllib.error
+import weakref
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain import cache
+
+# event loop -> {file path: task downloading it}
+_downloads = weakref.WeakKeyDictionary()
+
+
+class AsyncRainAreas(RainAreas):
+    """RainAreas with coroutines to load images and query them. An
+    instance holds one image at a time, like RainAreas: its coroutines
+    run one after the other, so they can be called from concurrent
+    tasks. The methods of RainAreas can still be used, but they block."""
+    def __init__(self, cache_dir=None, engine=None, executor=None, timeout=30):
+        """
+
+        parameters:
+          cache_dir, engine: see RainAreas
+          executor: concurrent.futures.Executor that decodes images
+            and answers queries, the default executor of the event loop
+            by default
+          timeout: seconds to wait for the server
+        """
+        super().__init__(cache_dir=cache_dir, engine=engine)
+        self._executor = executor
+        self._timeout = timeout
+        self._lock = None
+        self._loading = {}   # requested image time -> task loading it
+        self._requested = None   # (requested image time, time of the image loaded for it)
+
+    async def _run(self, func, *args):
+        """run func in the executor, after other coroutines of this
+        instance"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def async_load_image(self, when=None, location=None, d=0):
+        """same as load_image()"""
+        image_time = self.round_to_previous_5_min(when if when is not None else datetime.datetime.now())
+        key = (image_time, location, d)
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load_image(image_time, location, d))
+            self._loading[key] = task
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        await asyncio.shield(task)  # other callers still wait for it if this one is cancelled
+
+    async def _load_image(self, image_time, location, d):
+        requested = image_time
+        if self._intensity_map is not None and self._query == (location, d):
+            if self.image_time == requested or self._requested == (requested, self.image_time):
+                return  # already loaded, or an older one because it is not published yet
+        for _ in range(0, 3):
+            try:
+                await self._load_file(image_time, location, d)
+                self._requested = (requested, image_time)
+                return
+            except urllib.error.HTTPError as e:
+                if e.code != 403:  # 403 is returned when the image is not yet available
+                    raise RuntimeError(f"Unable to download the rain areas image: the server returned a unexpected status code {e.code}: {e.reason}")
+                image_time -= datetime.timedelta(minutes=5)  # Try 5 minutes before
+        raise RuntimeError("Unable to download the rain areas image")
+
+    async def _load_file(self, image_time, location, d):
+        """load the image of image_time, downloading it first if it is
+        not in the cache, or broken"""
+        filepath = os.path.join(self.cache_dir, self.filename_of(image_time))
+        if not os.path.exists(filepath):
+            await self._download(filepath)
+        try:
+            await self._run(self._load_cached_image, image_time, location, d)
+        except Exception as e:
+            if not cache.is_broken_image(e):
+                raise
+            os.unlink(filepath)  # a broken file, e.g. written by a previous version
+            await self._download(filepath)
+            await self._run(self._load_cached_image, image_time, location, d)
+
+    def _load_cached_image(self, image_time, location, d):
+        self._set_image_time(image_time)
+        self._query = (location, d)
+        self._read_image_from_cache(location, d)
+
+    async def _download(self, filepath):
+        """download an image into the cache, once even if asked by
+        many tasks at the same time"""
+        downloads = _downloads.setdefault(asyncio.get_running_loop(), {})
+        task = downloads.get(filepath)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(filepath))
+            downloads[filepath] = task
+            task.add_done_callback(lambda _: downloads.pop(filepath, None))
+        await asyncio.shield(task)
+
+    async def _fetch(self, filepath):
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._download_image_to_cache, filepath, self._timeout)
+
+    async def async_query(self, locations, d=0, filter_noise=None, nearest=False):
+        """same as query()"""
+        return await self._run(self.query, locations, d, filter_noise, nearest)
+
+    async def async_intensity_at(self, location, d=0):
+        """same as intensity_at()"""
+        return await self._run(self.intensity_at, location, d)
+
+    async def async_remove_blobs(self, max_size=1):
+        """same as remove_blobs()"""
+        return await self._run(self.remove_blobs, max_size)
+
+    async def async_nearest_rain_location(self, location):
+        """same as nearest_rain_location()"""
+        return await self._run(self.nearest_rain_location, location)
@@ -0,0 +1,240 @@
+"""Archives of intensity maps, one file per day, to keep a long
+history of images without keeping, and decoding again, one PNG file per
+image.
+
+An archive file starts with a header (magic, format version, width and
+height of the maps, a key digest of the color scale and georeference,
+see cache.key_of(), and the day), followed by a time index of one byte
+per 5 minutes slot (1 if the slot holds an image), followed by one
+fixed size plane of width * height levels per slot. The file is
+memory-mapped, so any image can be reached without reading the others.
+
+Archives are meant to be written by a single process at a time, e.g.
+import_day(), while any number of processes read them."""
+import datetime
+import mmap
+import os
+import struct
+from nlannuzel.sgrain.graph import Image
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain import cache
+
+MAGIC = b'SGRA'
+VERSION = 1
+SLOTS = 24 * 60 // 5
+
+# magic, format version, width, height, key, day (as a date ordinal)
+_HEADER = struct.Struct('<4sHHH16sI')
+
+
+def archive_path(directory, day):
+    """path of the archive of the given day (a date or datetime) in
+    directory"""
+    return os.path.join(directory, f"sgrain_{day.year}{day.month:02d}{day.day:02d}.archive")
+
+
+class DailyArchive:
+    """the images of one day, in an archive file"""
+    def __init__(self, path, day=None, width=None, height=None, key=None, writable=False):
+        """Open an existing archive, or create it if writable is
+        True.
+
+        parameters:
+          path: path of the archive file, see archive_path()
+          day, width, height, key: needed to create the archive. If
+            the archive exists, they must match the ones it was
+            created with, if given.
+          writable: True to add images with write()
+        """
+        self.path = path
+        self.writable = writable
+        if writable and not os.path.exists(path):
+            self._create(day, width, height, key)
+        with open(path, 'r+b' if writable else 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        try:
+            self._read_header(day, width, height, key)
+        except Exception:
+            self._mm.close()
+            raise
+
+    def _create(self, day, width, height, key):
+        if day is None or width is None or height is None or key is None:
+            raise RuntimeError("day, width, height and key are needed to create an archive")
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, width, height, key, day.toordinal()))
+            f.truncate(_HEADER.size + SLOTS + SLOTS * width * height)  # sparse, planes are filled later
+        os.replace(tmp, self.path)
+
+    def _read_header(self, day, width, height, key):
+        if len(self._mm) < _HEADER.size:
+            raise RuntimeError(f"{self.path} is not an archive")
+        magic, version, self.width, self.height, self.key, ordinal = _HEADER.unpack_from(self._mm)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError(f"{self.path} is not an archive of version {VERSION}")
+        if len(self._mm) != _HEADER.size + SLOTS + SLOTS * self.width * self.height:
+            raise RuntimeError(f"{self.path} is truncated")
+        self.day = datetime.date.fromordinal(ordinal)
+        if day is not None and self.day != (day.date() if isinstance(day, datetime.datetime) else day):
+            raise RuntimeError(f"{self.path} holds the images of {self.day}, not of {day}")
+        if (width is not None and width != self.width) or (height is not None and height != self.height):
+            raise RuntimeError(f"{self.path} holds images of {self.width}x{self.height}, not {width}x{height}")
+        if key is not None and key != self.key:
+            raise RuntimeError(f"{self.path} was created with another color scale or georeference")
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def slot_of(self, when):
+        """position in the day of the image of time when"""
+        if when.date() != self.day:
+            raise RuntimeError(f"{when} is not in the archive of {self.day}")
+        return (when.hour * 60 + when.minute) // 5
+
+    def _offset_of(self, slot):
+        return _HEADER.size + SLOTS + slot * self.width * self.height
+
+    def __contains__(self, when):
+        return when.date() == self.day and self._mm[_HEADER.size + self.slot_of(when)] != 0
+
+    def times(self):
+        """times of all images in the archive, in order"""
+        midnight = datetime.datetime.combine(self.day, datetime.time())
+        index = self._mm[_HEADER.size:_HEADER.size + SLOTS]
+        return [midnight + datetime.timedelta(minutes=5 * slot) for slot, present in enumerate(index) if present]
+
+    def plane(self, when):
+        """the levels of the image of time when, as a read only view
+        of the archive, without copy. Raises KeyError if the archive
+        does not hold this image."""
+        if when not in self:
+            raise KeyError(when)
+        offset = self._offset_of(self.slot_of(when))
+        return memoryview(self._mm)[offset:offset + self.width * self.height].toreadonly()
+
+    def read(self, when):
+        """a copy of the image of time when, as an intensity map that
+        can be modified"""
+        with self.plane(when) as plane:
+            return Image(width=self.width, height=self.height, data=bytearray(plane))
+
+    def write(self, when, intensity_map):
+        """add (or replace) the image of time when"""
+        if not self.writable:
+            raise RuntimeError(f"{self.path} is opened read only")
+        if (intensity_map.width, intensity_map.height) != (self.width, self.height):
+            raise RuntimeError(f"images of {self.path} must be {self.width}x{self.height}")
+        slot = self.slot_of(when)
+        offset = self._offset_of(slot)
+        self._mm[offset:offset + self.width * self.height] = intensity_map.data
+        self._mm[_HEADER.size + slot] = 1  # after the plane, so readers never see a partial image
+        self._mm.flush()
+
+
+def import_day(day, cache_dir, archive_dir=None, rain_class=RainAreas):
+    """add the images of the given day found in cache_dir to the
+    archive of this day, creating it if needed. Images already in the
+    archive are skipped, and so are broken images, e.g. partially
+    downloaded by an old version. Returns (added, broken), the number
+    of images added and of broken images.
+
+    parameters:
+      archive_dir: where archives are kept, cache_dir by default
+      rain_class: RainAreas, or a subclass with another color scale
+        or georeference, used to decode the images
+    """
+    rain = rain_class(cache_dir=cache_dir)
+    midnight = datetime.datetime(day.year, day.month, day.day)
+    path = archive_path(archive_dir if archive_dir is not None else cache_dir, day)
+    archive = None
+    added = 0
+    broken = 0
+    try:
+        for slot in range(0, SLOTS):
+            image_time = midnight + datetime.timedelta(minutes=5 * slot)
+            if archive is not None and image_time in archive:
+                continue
+            try:
+                rain.load_cached_image(image_time, write_sidecar=False)  # each image is only decoded once here
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                if not cache.is_broken_image(e):
+                    raise
+                broken += 1
+                continue
+            intensity_map = rain.intensity_map
+            if archive is None:
+                archive = DailyArchive(path, day=midnight, width=intensity_map.width,
+                                       height=intensity_map.height, key=rain.cache_key, writable=True)
+                if image_time in archive:
+                    continue
+            archive.write(image_time, intensity_map)
+            added += 1
+    finally:
+        if archive is not None:
+            archive.close()
+    return added, broken
+
+
+class ArchivedRainAreas(RainAreas):
+    """RainAreas that loads images from daily archives instead of
+    downloading and decoding PNG files. The original image is not
+    available."""
+    def __init__(self, archive_dir=None, cache_dir=None, engine=None):
+        """
+
+        parameters:
+          archive_dir: directory that holds the archives, cache_dir by
+            default
+          cache_dir, engine: see RainAreas
+        """
+        super().__init__(cache_dir=cache_dir, engine=engine)
+        self._archive_dir = archive_dir
+        self._archive = None
+
+    @property
+    def archive_dir(self):
+        return self._archive_dir if self._archive_dir is not None else self.cache_dir
+
+    def _archive_of(self, when):
+        """the archive of the day of when, or None if there is none"""
+        if self._archive is None or self._archive.day != when.date():
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+            path = archive_path(self.archive_dir, when)
+            if not os.path.exists(path):
+                return None
+            self._archive = DailyArchive(path, day=when, key=self.cache_key)
+        return self._archive
+
+    def load_image(self, when=None, location=None, d=0):
+        """get the image of time when (the latest by default) from the
+        archive, looking back in 5 minutes steps if needed, like
+        RainAreas.load_image(). The whole image is always loaded, so
+        location and d are ignored."""
+        image_time = self.round_to_previous_5_min(when if when is not None else datetime.datetime.now())
+        for _ in range(0, 3):
+            archive = self._archive_of(image_time)
+            if archive is not None and image_time in archive:
+                self._set_image_time(image_time)
+                self._set_intensity_map(archive.read(image_time))
+                return
+            image_time -= datetime.timedelta(minutes=5)
+        raise RuntimeError(f"no image in the archive of {self.archive_dir} at {when}")
+
+    def times(self, day):
+        """times of all images of the given day in the archive"""
+        archive = self._archive_of(datetime.datetime(day.year, day.month, day.day))
+        return archive.times() if archive is not None else []
+
+    def _read_original_image_from_cache(self):
+        raise RuntimeError("archives only hold intensity maps, the original image is not available")
@@ -0,0 +1,262 @@
+"""Files of the cache directory: downloaded images, decoded intensity
+maps saved next to them, so that an image is only decoded and
+posterized once, even across processes, and results of queries on an
+image, so that the same query is only answered once.
+
+Files are always written to a temporary file in the same directory
+first, then renamed, so that other processes never see a partially
+written file.
+
+A sidecar file holds a small header followed by the raw intensity
+levels, one byte per pixel, row by row. The header records the
+dimensions of the map, a key computed from the color scale and the
+georeference used to decode it, and the size and modification time of
+the image it was decoded from: a sidecar written with other values, or
+for another image, e.g. one downloaded again since, is ignored, and
+written again. The modification time of the sidecar itself is not
+used, since images are given the time they were published at, which
+can be older."""
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from nlannuzel.sgrain.graph import Image
+
+MAGIC = b'SGRI'
+VERSION = 2
+SUFFIX = '.intensity'
+
+# magic, format version, width, height, key, image size, image mtime (ns)
+_HEADER = struct.Struct('<4sHHH16sQq')
+
+
+def sidecar_path(filepath):
+    """path of the sidecar of the image at filepath"""
+    return filepath + SUFFIX
+
+
+def key_of(color_scale, top_left, bottom_right):
+    """a digest of everything the intensity levels depend on, besides
+    the image itself"""
+    h = hashlib.sha256()
+    for col in color_scale:
+        h.update(bytes((col.g, col.g, col.g) if col.is_grey() else (col.r, col.g, col.b)))
+    h.update(repr((top_left.lat, top_left.lon, bottom_right.lat, bottom_right.lon)).encode())
+    return h.digest()[:16]
+
+
+def read_sidecar(filepath, key):
+    """returns the intensity map saved next to the image at filepath,
+    or None if there is none, or if it was not saved with the same key,
+    or from the same image. Raises FileNotFoundError if the image itself
+    does not exist."""
+    image_stat = os.stat(filepath)
+    path = sidecar_path(filepath)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, width, height, sidecar_key, size, mtime = _HEADER.unpack_from(mm)
+            if magic != MAGIC or version != VERSION or sidecar_key != key:
+                return None
+            if size != image_stat.st_size or mtime != image_stat.st_mtime_ns:
+                return None
+            if len(mm) != _HEADER.size + width * height:
+                return None
+            with memoryview(mm) as view:
+                data = bytearray(view[_HEADER.size:])
+    return Image(width=width, height=height, data=data)
+
+
+def write_sidecar(filepath, key, intensity_map, image_stat=None):
+    """save intensity_map next to the image at filepath. The sidecar
+    is written to a temporary file first, then renamed, so other
+    processes never see a partially written sidecar. Nothing is saved
+    if the directory is not writable.
+
+    parameters:
+      image_stat: os.stat_result of the image intensity_map was decoded
+        from, e.g. os.fstat() of the file it was read from, in case the
+        image was replaced since. Defaults to the image at filepath.
+    """
+    if intensity_map.typecode != 'B' or intensity_map.channels != 1:
+        raise RuntimeError("only 8 bits grey images can be saved as a sidecar")
+    path = sidecar_path(filepath)
+    try:
+        if image_stat is None:
+            image_stat = os.stat(filepath)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix=SUFFIX)
+    except OSError:
+        return False
+    try:
+        os.fchmod(fd, 0o644)  # like the image, mkstemp() makes it private
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, intensity_map.width, intensity_map.height, key,
+                                 image_stat.st_size, image_stat.st_mtime_ns))
+            f.write(intensity_map.data)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_END = b'IEND\xaeB`\x82'
+
+
+def is_broken_image(e):
+    """True if the exception e, raised while reading an image of the
+    cache, tells that the file is not a complete image"""
+    png = sys.modules.get('png')  # if png was not imported, e can't come from it
+    return isinstance(e, EOFError) or (png is not None and isinstance(e, png.Error))
+
+
+def check_png(path):
+    """raises RuntimeError if the file at path is empty, or is not a
+    complete PNG file, e.g. because its download was interrupted"""
+    with open(path, 'rb') as f:
+        if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            raise RuntimeError(f"{path} is not a PNG file")
+        f.seek(0, os.SEEK_END)
+        if f.tell() < len(PNG_SIGNATURE) + len(PNG_END):
+            raise RuntimeError(f"{path} is truncated")
+        f.seek(-len(PNG_END), os.SEEK_END)
+        if f.read() != PNG_END:
+            raise RuntimeError(f"{path} is truncated")
+
+
+def save_stream(stream, filepath, check=check_png, mtime=None):
+    """copy the content of stream (e.g. a HTTP response) to filepath.
+    The content is checked with check(path) before being renamed into
+    place. If it can't be read completely, or the check fails, no file
+    is left behind.
+
+    parameters:
+      mtime: if given, the modification time of the file, as a
+        timestamp
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filepath) or '.', prefix='.', suffix='.tmp')
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        if check is not None:
+            check(tmp)
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, filepath)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+LOCK_SUFFIX = '.lock'
+
+
+@contextlib.contextmanager
+def locked(filepath):
+    """Hold the lock of the image at filepath, shared by all processes,
+    e.g. while downloading it, or updating its results. The lock is a
+    lock file next to the image, removed when the lock is released, so
+    that none are left in the cache. Processes that were waiting on a
+    removed file take the lock again on a new one."""
+    path = filepath + LOCK_SUFFIX
+    while True:
+        f = open(path, 'ab')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)  # wait until we get the lock...
+            try:
+                same = os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                same = False
+        except BaseException:
+            f.close()
+            raise
+        if same:
+            break
+        f.close()  # removed by the previous holder, try again
+    try:
+        yield
+    finally:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        f.close()  # releases the lock
+
+
+RESULTS_SUFFIX = '.results'
+
+# most results kept per image, see write_result()
+MAX_RESULTS = 256
+
+
+def results_path(filepath):
+    """path of the results of queries on the image at filepath"""
+    return filepath + RESULTS_SUFFIX
+
+
+def _image_of(stat):
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _read_results(filepath):
+    """the results saved for the image at filepath, if they were saved
+    for the same image, see write_result()"""
+    try:
+        image = _image_of(os.stat(filepath))
+        with open(results_path(filepath)) as f:
+            saved = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if not isinstance(saved, dict) or saved.get('image') != image or not isinstance(saved.get('results'), dict):
+        return {}
+    return saved['results']
+
+
+def read_result(filepath, query):
+    """returns the result saved by write_result() for query (a string)
+    on the image at filepath, or None"""
+    return _read_results(filepath).get(query)
+
+
+def write_result(filepath, query, result):
+    """save result (anything JSON can encode) of query (a string) on
+    the image at filepath. Results of other queries are kept, up to
+    MAX_RESULTS. Nothing is saved if the directory is not writable.
+    Processes that save results of the same image at the same time
+    wait for each other, so that none is lost, see locked().
+
+    Like sidecars, results are saved along with the size and
+    modification time of the image, and are dropped when the image is
+    replaced, e.g. downloaded again."""
+    try:
+        with locked(filepath):
+            image = _image_of(os.stat(filepath))
+            results = _read_results(filepath)
+            if len(results) >= MAX_RESULTS:
+                results.clear()
+            results[query] = result
+            saved = {'image': image, 'results': results}
+            save_stream(io.BytesIO(json.dumps(saved).encode()), results_path(filepath), check=None)
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,270 @@
+"""A long running process that keeps the latest image decoded in
+memory, and answers queries from local clients, so that each query
+does not pay for starting Python, reading and decoding the image, and
+finding blobs again.
+
+Clients connect to a Unix domain socket, and exchange JSON objects,
+one per line. A request is either:
+
+  {"op": "status"}
+  {"op": "query", "locations": [[lat, lon], ...], "d": 0,
+   "filter_noise": null, "nearest": false}
+
+and the response is either {"error": message}, or:
+
+  {"image_time": "2025-10-15T16:30:00"} for status
+  {"image_time": ..., "reports": [{"lat": ..., "lon": ...,
+   "pixel": [i, j] or null, "intensity": ..., "mean_intensity": ...,
+   "nearest_rain": [lat, lon] or null,
+   "nearest_rain_distance": ...}, ...]} for query
+"""
+import datetime
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from nlannuzel.sgrain.geo import Location
+from nlannuzel.sgrain.graph import Pixel
+from nlannuzel.sgrain.rain import RainAreas, RainReport
+
+SOCKET_NAME = 'sgrain.sock'
+
+
+def socket_path(cache_dir=None):
+    """default path of the socket, in the cache directory"""
+    return os.path.join(RainAreas(cache_dir=cache_dir).cache_dir, SOCKET_NAME)
+
+
+def report_to_dict(report):
+    """a RainReport as a JSON object, as sent by the daemon and printed
+    by rain-report"""
+    return {
+        'lat': report.location.lat,
+        'lon': report.location.lon,
+        'pixel': None if report.pixel is None else [report.pixel.i, report.pixel.j],
+        'intensity': report.intensity,
+        'mean_intensity': report.mean_intensity,
+        'nearest_rain': None if report.nearest_rain is None else [report.nearest_rain.lat, report.nearest_rain.lon],
+        'nearest_rain_distance': report.nearest_rain_distance,
+    }
+
+
+def report_from_dict(d, image_time):
+    report = RainReport(Location(d['lat'], d['lon']), image_time)
+    if d['pixel'] is not None:
+        report.pixel = Pixel(*d['pixel'])
+    report.intensity = d['intensity']
+    report.mean_intensity = d['mean_intensity']
+    if d['nearest_rain'] is not None:
+        report.nearest_rain = Location(*d['nearest_rain'])
+    report.nearest_rain_distance = d['nearest_rain_distance']
+    return report
+
+
+class RainDaemon:
+    """keeps the latest image, as downloaded, and copies of it with
+    noise removed, for each filter_noise value asked by clients. While
+    serving, a new image is loaded in the background when the 5 minutes
+    slot changes, and queries are answered with the image loaded until
+    then. If the image of the current slot is not available yet, or
+    can't be loaded, loading it is tried again every retry seconds, and
+    the previous image is used meanwhile."""
+
+    # most filtered copies kept, see frame()
+    max_filtered = 8
+
+    def __init__(self, cache_dir=None, socket_path=None, engine=None, retry=60):
+        self.cache_dir = cache_dir
+        self.socket_path = socket_path
+        self.engine = engine
+        self.retry = retry
+        self._raw = None
+        self._filtered = {}
+        self._slot = None
+        self._checked = None
+        self._lock = threading.Lock()           # images being queried
+        self._refresh_lock = threading.Lock()   # one refresh at a time
+        self._stopped = threading.Event()
+        self._server = None
+
+    def now(self):
+        """current time, can be replaced e.g. to replay past images"""
+        return datetime.datetime.now()
+
+    def refresh(self):
+        """load the image of the current 5 minutes slot, if not
+        already loaded. The image is downloaded and decoded without
+        blocking queries, which only wait for the new image to replace
+        the previous one."""
+        with self._refresh_lock:
+            now = self.now()
+            rain = RainAreas(cache_dir=self.cache_dir, engine=self.engine)
+            slot = rain.round_to_previous_5_min(now)
+            if self._raw is not None:
+                if self._raw.image_time == slot:
+                    return
+                if self._slot == slot and time.monotonic() - self._checked < self.retry:
+                    return
+            self._slot = slot
+            self._checked = time.monotonic()
+            try:
+                rain.load_image(now)
+            except Exception:   # e.g. network down, or broken image
+                if self._raw is None:
+                    raise
+                return   # keep answering with the image already loaded, try again after retry seconds
+            with self._lock:
+                if self._raw is not None:
+                    if rain.image_time == self._raw.image_time:
+                        return
+                    rain.follow(self._raw)   # only label again what changed since the previous image
+                self._raw = rain
+                self._filtered = {}
+
+    def _next_refresh(self):
+        """seconds until refresh() has something to do: the start of
+        the next slot, or the next retry if the image of the current
+        one is not loaded"""
+        raw = self._raw
+        if raw is not None:
+            now = self.now()
+            slot = raw.round_to_previous_5_min(now)
+            if raw.image_time == slot:
+                return (slot + datetime.timedelta(minutes=5) - now).total_seconds()
+        if self._checked is None:
+            return 0
+        return max(0, self.retry - (time.monotonic() - self._checked))
+
+    def _refresh_forever(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:   # nothing loaded yet, e.g. offline, tried again after retry seconds
+                pass
+            self._stopped.wait(self._next_refresh())
+
+    def frame(self, filter_noise=None):
+        """the image currently loaded, with blobs of filter_noise
+        pixels or less removed. It is only loaded here if no image
+        was loaded yet."""
+        if self._raw is None:
+            self.refresh()
+        with self._lock:
+            if not filter_noise:
+                return self._raw
+            if filter_noise not in self._filtered:
+                if len(self._filtered) >= self.max_filtered:
+                    self._filtered.clear()
+                rain = self._raw.copy()
+                rain.follow(self._raw)   # same image, all blobs are kept
+                rain.remove_blobs(filter_noise)
+                self._filtered[filter_noise] = rain
+            return self._filtered[filter_noise]
+
+    def handle(self, request):
+        """returns the response to a request, see the module
+        documentation"""
+        op = request.get('op')
+        if op == 'status':
+            return {'image_time': self.frame().image_time.isoformat()}
+        if op == 'query':
+            rain = self.frame(request.get('filter_noise'))
+            locations = [Location(lat, lon) for lat, lon in request['locations']]
+            with self._lock:   # maps computed by queries are kept in rain
+                reports = rain.query(locations, d=request.get('d', 0), nearest=request.get('nearest', False))
+            return {
+                'image_time': rain.image_time.isoformat(),
+                'reports': [report_to_dict(report) for report in reports],
+            }
+        raise RuntimeError(f"unknown operation {op}")
+
+    def serve_forever(self):
+        """answer clients until shutdown() is called"""
+        path = self.socket_path if self.socket_path is not None else socket_path(self.cache_dir)
+        if os.path.exists(path):
+            s = _connect(path, timeout=1)
+            if s is not None:
+                s.close()
+                raise RuntimeError(f"a daemon is already listening on {path}")
+            os.unlink(path)  # left by a daemon that didn't stop cleanly
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = daemon.handle(json.loads(line))
+                    except Exception as e:
+                        response = {'error': str(e)}
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+                    self.wfile.flush()
+
+        self._stopped.clear()
+        refresher = threading.Thread(target=self._refresh_forever, daemon=True)
+        refresher.start()
+        self._server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self._server.daemon_threads = True
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stopped.set()
+            self._server.server_close()
+            os.unlink(path)
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def _connect(path, timeout):
+    """returns a socket connected to the daemon, or None if no daemon
+    is listening"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(path)
+    except OSError:
+        s.close()
+        return None
+    return s
+
+
+def request(request, path=None, timeout=30):
+    """send a request to the daemon listening on path (see
+    socket_path()), and returns its response, or None if no daemon is
+    listening, or if it doesn't answer in time"""
+    s = _connect(path if path is not None else socket_path(), timeout)
+    if s is None:
+        return None
+    try:
+        with s, s.makefile('rwb') as f:
+            f.write(json.dumps(request).encode() + b'\n')
+            f.flush()
+            line = f.readline()
+    except OSError:  # e.g. timeout, or the daemon stopped
+        return None
+    if not line:
+        return None
+    response = json.loads(line)
+    if 'error' in response:
+        raise RuntimeError(f"the daemon returned an error: {response['error']}")
+    return response
+
+
+def query(locations, d=0, filter_noise=None, nearest=False, path=None, timeout=30):
+    """same as RainAreas.query() for the latest image, but answered by
+    the daemon. Returns None if no daemon is listening."""
+    response = request({
+        'op': 'query',
+        'locations': [[location.lat, location.lon] for location in locations],
+        'd': d,
+        'filter_noise': filter_noise,
+        'nearest': nearest,
+    }, path=path, timeout=timeout)
+    if response is None:
+        return None
+    image_time = datetime.datetime.fromisoformat(response['image_time'])
+    return [report_from_dict(report, image_time) for report in response['reports']]
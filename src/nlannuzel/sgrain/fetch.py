@@ -0,0 +1,294 @@
+"""Download images into the cache ahead of RainAreas.load_image():
+as soon as they are published (Prefetcher), so that it finds them there
+instead of downloading them, and probing for images not published yet,
+when it is asked for the latest image, or many past images at once
+(Backfill).
+
+Images are published every 5 minutes, a little while after the time
+they are named after. Until then, the server returns 403."""
+import concurrent.futures
+import datetime
+import email.utils
+import http.client
+import os
+import threading
+import time
+import urllib.parse
+import urllib.error
+import urllib.request
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain import cache
+
+FETCHED = 'fetched'
+CACHED = 'cached'
+NOT_MODIFIED = 'not modified'
+NOT_PUBLISHED = 'not published'
+
+
+class Prefetcher:
+    """polls the server for the image of each 5 minutes slot, shortly
+    after it is expected to be published, and saves it in the cache.
+    If the image is not published yet, the server is polled again after
+    a delay that doubles each time, until the image is found or the
+    next slot begins."""
+    def __init__(self, cache_dir=None, base_url=None, delay=30, backoff=(5, 60), timeout=30, rain_class=RainAreas):
+        """
+
+        parameters:
+          cache_dir: directory that holds downloaded images
+          base_url: where images are downloaded from, see
+            RainAreas.base_url
+          delay: seconds between the time of an image, and the first
+            attempt to download it
+          backoff: (first, longest) seconds to wait before polling
+            again for an image that is not published yet
+          timeout: seconds to wait for the server
+          rain_class: RainAreas, or a subclass, that gives the file
+            names of images
+        """
+        self._rain = rain_class(cache_dir=cache_dir)
+        self.base_url = base_url if base_url is not None else self._rain.base_url
+        self.delay = delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self.stats = {FETCHED: 0, CACHED: 0, NOT_MODIFIED: 0, NOT_PUBLISHED: 0, 'errors': 0}
+        self._etags = {}   # file name -> ETag of the saved image
+        self._stop = threading.Event()
+
+    def now(self):
+        """current time, same clock as the times of images"""
+        return datetime.datetime.now()
+
+    def sleep(self, seconds):
+        """wait, returns True if stop() was called meanwhile"""
+        return self._stop.wait(seconds)
+
+    def stop(self):
+        """make run() return"""
+        self._stop.set()
+
+    def filepath_of(self, image_time):
+        """where the image of image_time is saved in the cache"""
+        self._rain._set_image_time(image_time)
+        return self._rain.filepath
+
+    def fetch(self, image_time, revalidate=False):
+        """download the image of image_time into the cache, unless it
+        is already there. If revalidate is True, a cached image is
+        downloaded again, only if it has changed on the server since it
+        was saved. Returns FETCHED, CACHED, NOT_MODIFIED or
+        NOT_PUBLISHED."""
+        filepath = self.filepath_of(image_time)
+        st = self._cached_stat(filepath)
+        if st is not None and not revalidate:
+            result = CACHED
+        else:
+            result = self._download(filepath, st)
+        self.stats[result] += 1
+        return result
+
+    def _cached_stat(self, filepath):
+        """os.stat() of the image in the cache, or None if it is not
+        there"""
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+        if st.st_size == 0:
+            return None  # left by a download that failed
+        return st
+
+    def _download(self, filepath, st=None):
+        """download the image saved as filepath. If st, the os.stat()
+        of the cached image, is given, only if it has changed on the
+        server since. Returns FETCHED, NOT_MODIFIED or NOT_PUBLISHED."""
+        filename = os.path.basename(filepath)
+        request = urllib.request.Request(f"{self.base_url}{filename}")
+        if st is not None:
+            request.add_header('If-Modified-Since', email.utils.formatdate(st.st_mtime, usegmt=True))
+            if filename in self._etags:
+                request.add_header('If-None-Match', self._etags[filename])
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                self._save(response, filepath)
+                if response.headers.get('ETag') is not None:
+                    self._etags[filename] = response.headers['ETag']
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return NOT_MODIFIED
+            if e.code in (403, 404):
+                return NOT_PUBLISHED
+            raise
+        return FETCHED
+
+    def _save(self, response, filepath):
+        """save the image atomically, see cache.save_stream(). Its
+        modification time is set to the one given by the server, for
+        If-Modified-Since."""
+        mtime = None
+        last_modified = response.headers.get('Last-Modified')
+        if last_modified is not None:
+            mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+        cache.save_stream(response, filepath, mtime=mtime)
+
+    def poll(self, image_time, until):
+        """fetch the image of image_time, trying again with backoff
+        while it is not published, or the server can't be reached,
+        until the time until. If the image is already in the cache, it
+        is downloaded again only if it has changed on the server.
+        Returns the result of the last fetch(), or None if stop() was
+        called."""
+        wait, longest = self.backoff
+        while True:
+            try:
+                result = self.fetch(image_time, revalidate=True)
+            except (OSError, RuntimeError):  # network errors, unexpected statuses
+                self.stats['errors'] += 1
+                result = NOT_PUBLISHED
+            if result != NOT_PUBLISHED:
+                return result
+            remaining = (until - self.now()).total_seconds()
+            if remaining <= 0:
+                return result
+            if self.sleep(min(wait, remaining)):
+                return None
+            wait = min(2 * wait, longest)
+
+    def next_publish_time(self, now=None):
+        """the time of the next image, and when to start polling for
+        it"""
+        now = now if now is not None else self.now()
+        image_time = self._rain.round_to_previous_5_min(now)
+        poll_time = image_time + datetime.timedelta(seconds=self.delay)
+        if poll_time <= now:
+            image_time += datetime.timedelta(minutes=5)
+            poll_time += datetime.timedelta(minutes=5)
+        return image_time, poll_time
+
+    def run(self):
+        """prefetch images until stop() is called. The latest image is
+        fetched first, then each image when it is published."""
+        image_time = self._rain.round_to_previous_5_min(self.now())
+        while True:
+            result = self.poll(image_time, until=image_time + datetime.timedelta(minutes=5))
+            if result is None:
+                return
+            image_time, poll_time = self.next_publish_time()
+            wait = (poll_time - self.now()).total_seconds()
+            if wait > 0 and self.sleep(wait):
+                return
+
+
+class Backfill:
+    """downloads all the images of a time range into the cache, with
+    a pool of threads. Each thread keeps its connection to the server
+    open, and uses it for all its downloads."""
+    def __init__(self, cache_dir=None, base_url=None, workers=4, timeout=30, rain_class=RainAreas):
+        """
+
+        parameters:
+          cache_dir: directory that holds downloaded images
+          base_url: where images are downloaded from, see
+            RainAreas.base_url
+          workers: number of downloads at the same time
+          timeout: seconds to wait for the server
+          rain_class: RainAreas, or a subclass, that gives the file
+            names of images
+        """
+        self._rain = rain_class(cache_dir=cache_dir)
+        self.base_url = base_url if base_url is not None else self._rain.base_url
+        self.workers = workers
+        self.timeout = timeout
+        self.stats = {FETCHED: 0, CACHED: 0, NOT_PUBLISHED: 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []   # of all threads, closed by run()
+        url = urllib.parse.urlsplit(self.base_url)
+        self._connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self._host = url.netloc
+        self._path = url.path
+
+    def image_times(self, start, end):
+        """times of all images from start to end, both included"""
+        image_time = self._rain.round_to_previous_5_min(start)
+        while image_time <= end:
+            yield image_time
+            image_time += datetime.timedelta(minutes=5)
+
+    def _count(self, result, size=0):
+        with self._lock:
+            self.stats[result] += 1
+            self.stats['bytes'] += size
+
+    def _connection(self):
+        """the connection of the current thread"""
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = self._connection_class(self._host, timeout=self.timeout)
+            with self._lock:
+                self._connections.append(self._local.connection)
+        return self._local.connection
+
+    def _close_connection(self):
+        if getattr(self._local, 'connection', None) is not None:
+            self._local.connection.close()
+            self._local.connection = None
+
+    def _get(self, filename, filepath):
+        """download one image with the connection of the current
+        thread, returns FETCHED or NOT_PUBLISHED"""
+        connection = self._connection()
+        connection.request('GET', f"{self._path}{filename}")
+        response = connection.getresponse()
+        if response.status in (403, 404):  # gap, e.g. radar maintenance
+            response.read()  # so that the connection can be used again
+            return NOT_PUBLISHED
+        if response.status != 200:
+            response.read()
+            raise RuntimeError(f"the server returned a unexpected status code {response.status}: {response.reason}")
+        cache.save_stream(response, filepath)
+        if response.will_close:
+            self._close_connection()
+        return FETCHED
+
+    def fetch(self, image_time):
+        """download the image of image_time, unless it is already in
+        the cache. Returns FETCHED, CACHED or NOT_PUBLISHED, or None if
+        it failed."""
+        filename = self._rain.filename_of(image_time)
+        filepath = os.path.join(self._rain.cache_dir, filename)
+        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            self._count(CACHED)
+            return CACHED
+        for _ in range(0, 2):
+            try:
+                result = self._get(filename, filepath)
+                break
+            except (OSError, http.client.HTTPException, RuntimeError):
+                self._close_connection()  # the server may have closed it, try again with a new one
+        else:
+            self._count('errors')
+            return None
+        self._count(result, os.path.getsize(filepath) if result == FETCHED else 0)
+        return result
+
+    def run(self, start, end):
+        """download all images from start to end, returns stats"""
+        started = time.monotonic()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for _ in pool.map(self.fetch, self.image_times(start, end)):
+                    pass
+        finally:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._local = threading.local()
+            self.stats['seconds'] += time.monotonic() - started
+        return self.stats
+
+    def report(self):
+        """a summary of stats, with the throughput"""
+        seconds = max(self.stats['seconds'], 1e-6)
+        return (f"{self.stats[FETCHED]} images downloaded ({self.stats['bytes'] / 1e6:.1f} MB) in {self.stats['seconds']:.1f}s, "
+                f"{self.stats[FETCHED] / seconds:.1f} images/s, {self.stats['bytes'] / 1e6 / seconds:.2f} MB/s, "
+                f"{self.stats[CACHED]} already in the cache, {self.stats[NOT_PUBLISHED]} missing, {self.stats['errors']} errors")
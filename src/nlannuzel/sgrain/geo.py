@@ -1,5 +1,9 @@
 from math import sqrt, cos, asin, radians
 
+# https://en.wikipedia.org/wiki/Haversine_formula
+# EARTH_RADIUS = 6356.752  # Radius of the earth at the poles
+EARTH_RADIUS = 6378.137  # Radius of the earth on the equator
+
 
 class Location:
     def __init__(self, lat, lon):
@@ -11,15 +15,35 @@ class Location:
 
     def distance_to(self, other):
         """Returns the distance to another point, in kilometers, using the Haversine formula."""
-        # https://en.wikipedia.org/wiki/Haversine_formula
-        # r = 6356.752  # Radius of the earth at the poles
-        r = 6378.137  # Radius of the earth on the equator
-
-        def to_rad(loc):
-            yield radians(loc.lon)
-            yield radians(loc.lat)
-        lambda1, phi1 = to_rad(self)
-        lambda2, phi2 = to_rad(other)
+        return _haversine(self.lat, self.lon, other.lat, other.lon)
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    phi1 = radians(lat1)
+    phi2 = radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = radians(lon2) - radians(lon1)
+    return 2 * EARTH_RADIUS * asin( sqrt( 1/2 * (1 - cos(d_phi) + cos(phi1) * cos(phi2) * (1 - cos(d_lambda))) ) )
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Returns the distances, in kilometers, between points given by
+    their latitudes and longitudes in degrees, like
+    Location.distance_to(). Each argument is either a number, or a
+    sequence of numbers, all sequences having the same length. With
+    sequences, the distances are computed with NumPy if it is
+    installed, and returned as an array, or else as a list."""
+    coordinates = (lat1, lon1, lat2, lon2)
+    sequences = [c for c in coordinates if not isinstance(c, (int, float))]
+    if not sequences:
+        return _haversine(lat1, lon1, lat2, lon2)
+    from nlannuzel.sgrain import vector
+    if vector.available():
+        np = vector.np
+        phi1, lambda1, phi2, lambda2 = (np.radians(np.asarray(c, dtype=np.float64)) for c in coordinates)
         d_phi = phi2 - phi1
         d_lambda = lambda2 - lambda1
-        return 2 * r * asin( sqrt( 1/2 * (1 - cos(d_phi) + cos(phi1) * cos(phi2) * (1 - cos(d_lambda))) ) )
+        return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(0.5 * (1 - np.cos(d_phi) + np.cos(phi1) * np.cos(phi2) * (1 - np.cos(d_lambda)))))
+    n = len(sequences[0])
+    columns = [c if not isinstance(c, (int, float)) else [c] * n for c in coordinates]
+    return [_haversine(*point) for point in zip(*columns)]
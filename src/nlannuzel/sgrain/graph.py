@@ -1,5 +1,11 @@
 """Classes for basic in-memory image handling"""
-from math import atan, degrees
+from array import array
+from bisect import insort
+from itertools import accumulate, groupby
+from operator import add
+from math import atan, degrees, sqrt
+from copy import copy
+import re
 
 
 class Color:
@@ -81,6 +87,64 @@ class Color:
         return True
 
 
+class Posterizer:
+    """Maps r, g, b components to the position of the nearest color
+    in a palette. The result of Color.posterize() is memoized per
+    packed r, g, b value, so each distinct color is only compared
+    once against the whole palette."""
+    def __init__(self, palette):
+        """
+
+        parameters:
+          palette: tuples of Color
+        """
+        if len(palette) > 256:
+            raise RuntimeError("palette cannot have more than 256 colors")
+        self.palette = palette
+        self._lut = {}
+        for col in palette:
+            self.index_of_color(col)
+
+    @staticmethod
+    def pack(r, g, b):
+        """returns r, g and b packed in a single integer"""
+        return (r << 16) | (g << 8) | b
+
+    def index_of_packed(self, key):
+        """returns the position of the nearest color in the palette,
+        for a color given as a packed r, g, b value"""
+        index = self._lut.get(key)
+        if index is None:
+            index = Color(key >> 16, (key >> 8) & 0xff, key & 0xff).posterize(self.palette)
+            self._lut[key] = index
+        return index
+
+    def index_of(self, r, g, b):
+        """returns the position of the nearest color in the palette"""
+        return self.index_of_packed(self.pack(r, g, b))
+
+    def index_of_color(self, col):
+        """same as col.posterize(palette), but memoized"""
+        if col.is_grey():
+            return self.index_of(col.g, col.g, col.g)
+        return self.index_of(col.r, col.g, col.b)
+
+    def posterize_row(self, row, channels=3):
+        """posterize a (r, g, b, r, g, b...) row, returns a bytearray
+        with one palette position per pixel. Set channels to 4 if the
+        row has an alpha component."""
+        lut = self._lut
+        index_of_packed = self.index_of_packed
+        out = bytearray(len(row) // channels)
+        k = 0
+        for r, g, b in zip(row[0::channels], row[1::channels], row[2::channels]):
+            key = (r << 16) | (g << 8) | b
+            index = lut.get(key)
+            out[k] = index if index is not None else index_of_packed(key)
+            k += 1
+        return out
+
+
 BLACK   = Color( 0  , 0  , 0   )
 WHITE   = Color( 255, 255, 255 )
 RED     = Color( 255, 0  , 0   )
@@ -139,6 +203,10 @@ class Box:
         br = Pixel(i=ib, j=jb)
         return Box(tl, br)
 
+    def area(self):
+        """number of pixels inside and on the boundary of this box"""
+        return (self.br.i - self.tl.i + 1) * (self.br.j - self.tl.j + 1)
+
     def iter_width(self):
         """returns an iterator on the width of this box"""
         return range(self.tl.i, self.br.i+1)
@@ -166,51 +234,74 @@ class Box:
 
 
 class Image:
-    """a 8 bits image in memory stored as rows of Color"""
-    def __init__(self, width=None, height=None, rows=None):
+    """an image in memory, stored as a contiguous plane of grey levels
+    (channels=1), or of interleaved r, g, b components (channels=3).
+    By default the levels are 8 bits, other array typecodes (e.g. 'L')
+    can be used to store larger values such as labels."""
+    def __init__(self, width=None, height=None, rows=None, channels=1, typecode='B', data=None):
         """
 
         parameters:
           width and height: dimensions of the image
           rows: list of list of Color object
+          channels: 1 for grey levels, 3 for r, g, b
+          typecode: array typecode of the levels
+          data: an existing plane of width * height * channels levels
 
         Either (width and height) or rows are needed.
-        If width and height are given, rows is initialized as a all
-        black image.
+        If width and height are given, the image is initialized as a
+        all black image, unless data is given.
         If rows is given, width and height are calculated from the
         number of rows, and length of each row.
         """
         if rows is None:
             if width is None or height is None:
                 raise RuntimeError("at least width and height or rows must be given")
-        self._rows = rows
-        self._height = height
-        self._width = width
+        if channels not in (1, 3):
+            raise RuntimeError("only grey (1 channel) or r, g, b (3 channels) images are supported")
+        if channels == 3 and typecode != 'B':
+            raise RuntimeError("r, g, b images must be 8 bits")
+        self.typecode = typecode
         self._box = None
+        if rows is not None:
+            height = len(rows)
+            width = len(rows[0])
+            if any(not col.is_grey() for row in rows for col in row):
+                channels = 3
+        self._width = width
+        self._height = height
+        self.channels = channels
+        if data is None:
+            data = self._new_plane(width * height * channels)
+        elif len(data) != width * height * channels:
+            raise RuntimeError("data does not match the image dimensions")
+        self.data = data
+        self.version = 0   # incremented each time the image is modified, see modified()
+        if rows is not None:
+            for j, row in enumerate(rows):
+                for i, col in enumerate(row):
+                    self.set_color_at(i, j, col)
+
+    def _new_plane(self, size):
+        if self.typecode == 'B':
+            return bytearray(size)
+        return array(self.typecode, bytes(size * array(self.typecode).itemsize))
 
     def __repr__(self):
         return f"Image ({self.width}x{self.height})"
 
     @property
     def rows(self):
-        if self._rows is None:
-            self._rows = []
-            for j in range(0, self.height):
-                row = []
-                row.extend([ BLACK for i in range(0, self.width) ])
-                self._rows.append(row)
-        return self._rows
+        """the image as a list of list of Color. This is a copy, changes
+        made to it are not reflected in the image."""
+        return [[self.get_color_at(i, j) for i in range(0, self.width)] for j in range(0, self.height)]
 
     @property
     def height(self):
-        if self._height is None:
-            self._height = len(self.rows)
         return self._height
 
     @property
     def width(self):
-        if self._width is None:
-            self._width = len(self.rows[0])
         return self._width
 
     @property
@@ -219,37 +310,115 @@ class Image:
             self._box = Box.from_coordinates(0, 0, self.width - 1, self.height - 1)
         return self._box
 
+    def is_grey(self):
+        return self.channels == 1
+
+    def modified(self):
+        """to be called after changing data directly, so that objects
+        computed from this image (e.g. SummedAreaTable) know that they
+        are out of date"""
+        self.version += 1
+
+    def copy(self):
+        """returns a copy of this image"""
+        return Image(
+            width=self.width, height=self.height, channels=self.channels,
+            typecode=self.typecode, data=self.data[:])
+
     @classmethod
     def from_rgb_rows(cls, rows, has_alpha=False):
         """generate a new image from a list of (r, g, b, r, g, b...)
         lists instead of list of list Color"""
         skip = 4 if has_alpha else 3
-        new_rows = []
+        planes = []
         for row in rows:
-            new_row = [ Color(row[i], row[i+1], row[i+2]) for i in range(0, len(row), skip) ]
-            new_rows.append(new_row)
-        return Image(rows=new_rows)
+            plane = bytearray(len(row) // skip * 3)
+            plane[0::3] = bytes(row[0::skip])
+            plane[1::3] = bytes(row[1::skip])
+            plane[2::3] = bytes(row[2::skip])
+            planes.append(plane)
+        return Image(width=len(planes[0]) // 3, height=len(planes), channels=3, data=bytearray().join(planes))
 
     def to_rgb_rows(self):
         """export the image as a list of (r, g, b, r, g, b...) lists
         """
         rows = []
-        for row in self.rows:
-            new_row = []
-            for i in range(0, len(row)):
-                col = row[i]
-                a = [col.g, col.g, col.g] if col.is_grey() else [col.r, col.g, col.b]
-                new_row.extend(a)
-            rows.append(new_row)
+        for j in range(0, self.height):
+            row = self.get_row(j)
+            if self.is_grey():
+                grey = bytes(row)
+                row = bytearray(3 * self.width)
+                row[0::3] = grey
+                row[1::3] = grey
+                row[2::3] = grey
+            rows.append(list(row))
         return rows
 
+    def get_row(self, j, ia=0, ib=None):
+        """Return a copy of the levels of row j, from column ia up to,
+        but not including, column ib. For r, g, b images, components
+        are interleaved"""
+        if ib is None or ib > self.width:
+            ib = self.width
+        offset = j * self.width
+        return self.data[(offset + ia) * self.channels:(offset + ib) * self.channels]
+
+    def set_row(self, j, levels, ia=0):
+        """Overwrite row j, starting at column ia, with the given
+        levels"""
+        start = (j * self.width + ia) * self.channels
+        self.data[start:start + len(levels)] = levels
+        self.version += 1
+
+    def iter_rows(self):
+        """Returns an iterator on the levels of all rows, see get_row"""
+        for j in range(0, self.height):
+            yield self.get_row(j)
+
+    def get_level_at(self, i, j):
+        """Return the grey level at location (i, j)"""
+        return self.data[j * self.width + i]
+
+    def set_level_at(self, i, j, level):
+        """Set the grey level at location (i, j)"""
+        self.data[j * self.width + i] = level
+        self.version += 1
+
+    def _to_rgb(self):
+        """convert a grey image to a r, g, b image"""
+        grey = self.data
+        self.data = bytearray(3 * len(grey))
+        self.data[0::3] = grey
+        self.data[1::3] = grey
+        self.data[2::3] = grey
+        self.channels = 3
+
     def get_color_at(self, i, j):
         """Return the color at location (i, j) as a Color object"""
-        return self.rows[j][i]
+        k = j * self.width + i
+        if self.channels == 1:
+            level = self.data[k]
+            return _GREYS[level] if level < 256 else Color.grey(level)
+        k *= 3
+        return Color(self.data[k], self.data[k+1], self.data[k+2])
 
     def set_color_at(self, i, j, col):
-        """Set the color at location (i, j) to the given Color"""
-        self.rows[j][i] = col
+        """Set the color at location (i, j) to the given Color. A grey
+        image is converted to a r, g, b image if needed."""
+        k = j * self.width + i
+        self.version += 1
+        if self.channels == 1:
+            if col.is_grey():
+                self.data[k] = col.g
+                return
+            if self.typecode != 'B':
+                raise RuntimeError(f"cannot store {col} in a {self.typecode} grey image")
+            self._to_rgb()
+        k *= 3
+        if col.is_grey():
+            self.data[k:k+3] = bytes((col.g, col.g, col.g))
+        else:
+            self.data[k:k+3] = bytes((col.r, col.g, col.b))
 
     def get_pixel_at(self, i, j):
         """Return the color at location (i, j) in the form of a new
@@ -290,8 +459,13 @@ class Image:
         return Box.from_coordinates(
             max( 0          , pixel.i - d ),
             max( 0          , pixel.j - d ),
-            min( self.width , pixel.i + d ),
-            min( self.height, pixel.j + d ))
+            min( self.width  - 1, pixel.i + d ),
+            min( self.height - 1, pixel.j + d ))
+
+    def max_level_in(self, box):
+        """Returns the highest level of a grey image within the given
+        box area"""
+        return max(max(self.get_row(j, box.tl.i, box.br.i + 1)) for j in box.iter_height())
 
     def iter_neighbours_r(self, pixel, d):
         """Returns an iterator on all pixels within a box (size d x d)
@@ -308,22 +482,513 @@ class Image:
 
         Apply functiopn `func` on all pixels of this image, and return a new image.
         `func` takes a Pixel object and must return a Color object.
+        See translate() for a faster alternative on grey images.
         """
         new_image = Image(width=self.width, height=self.height)
         for pixel in self.iter_area():
             new_image.set_color_at(pixel.i, pixel.j, func(pixel))
         return new_image
 
+    def translate(self, table):
+        """Map each level of this 8 bits grey image through table (a
+        sequence of 256 levels), and return a new grey image"""
+        if self.channels != 1 or self.typecode != 'B':
+            raise RuntimeError("only 8 bits grey images can be translated")
+        return Image(width=self.width, height=self.height, data=bytearray(self.data).translate(bytes(table)))
+
+    def foreground_row(self, j, bg_col=BLACK):
+        """Returns a bytearray with 1 for each pixel of row j that is
+        not bg_col, and 0 otherwise"""
+        row = self.get_row(j)
+        if self.channels == 1:
+            if not bg_col.is_grey():
+                return bytearray(b'\x01' * self.width)
+            if self.typecode == 'B':
+                return bytearray(row).translate(_foreground_table(bg_col.g))
+            return bytearray(level != bg_col.g for level in row)
+        bg = bytes((bg_col.g, bg_col.g, bg_col.g)) if bg_col.is_grey() else bytes((bg_col.r, bg_col.g, bg_col.b))
+        return bytearray(row[k:k+3] != bg for k in range(0, len(row), 3))
+
     def draw_box(self, box, color):
         """draw a box in a given color"""
         for i, j in box.iter_boundary():
             self.set_color_at(i, j, color)
 
 
+# shared Color objects for 8 bits grey levels, and translate() tables
+# mapping a background level to 0, and all other levels to 1, built
+# when first needed
+_GREYS = tuple(Color.grey(level) for level in range(0, 256))
+_FOREGROUND_TABLES = {}
+_FOREGROUND_RUN = re.compile(b'\x01+')
+
+
+def _foreground_table(bg):
+    if bg not in _FOREGROUND_TABLES:
+        _FOREGROUND_TABLES[bg] = bytes(b'\x01' * bg + b'\x00' + b'\x01' * (255 - bg))
+    return _FOREGROUND_TABLES[bg]
+
+
+class DisjointSet:
+    """Union-find structure over labels 1, 2, 3... Labels are merged
+    with union by rank, and paths are compressed when looking up the
+    set of a label, so both operations are almost constant time."""
+    def __init__(self):
+        self._parent = [0]
+        self._rank = [0]
+        self._smallest = [0]   # smallest label of each set, stored at its root
+
+    def __len__(self):
+        """number of labels"""
+        return len(self._parent) - 1
+
+    def make_set(self):
+        """returns a new label, alone in its own set"""
+        label = len(self._parent)
+        self._parent.append(label)
+        self._rank.append(0)
+        self._smallest.append(label)
+        return label
+
+    def find(self, label):
+        """returns the root label of the set containing label"""
+        parent = self._parent
+        root = label
+        while parent[root] != root:
+            root = parent[root]
+        while parent[label] != root:
+            parent[label], label = root, parent[label]
+        return root
+
+    def union(self, label1, label2):
+        """merge the sets containing label1 and label2"""
+        root1 = self.find(label1)
+        root2 = self.find(label2)
+        if root1 == root2:
+            return root1
+        if self._rank[root1] < self._rank[root2]:
+            root1, root2 = root2, root1
+        self._parent[root2] = root1
+        if self._rank[root1] == self._rank[root2]:
+            self._rank[root1] += 1
+        if self._smallest[root2] < self._smallest[root1]:
+            self._smallest[root1] = self._smallest[root2]
+        return root1
+
+    def smallest(self, label):
+        """returns the smallest label of the set containing label"""
+        return self._smallest[self.find(label)]
+
+
+class SummedAreaTable:
+    """Integral image of a grey image: each entry holds the sum of the
+    levels of all pixels above and on the left of a pixel. Once built,
+    the sum of the levels of any box is found with 4 lookups."""
+    def __init__(self, image):
+        if not image.is_grey():
+            raise RuntimeError("only grey images have a summed area table")
+        self.width = image.width
+        self.height = image.height
+        self.version = image.version
+        stride = self.width + 1
+        table = array('q', bytes(8 * stride * (self.height + 1)))
+        previous = table[0:stride]
+        for j in range(0, self.height):
+            current = array('q', [0])
+            current.extend(map(add, previous[1:], accumulate(image.get_row(j))))
+            table[(j + 1) * stride:(j + 2) * stride] = current
+            previous = current
+        self._table = table
+
+    @classmethod
+    def of_foreground(cls, image, bg_col=BLACK):
+        """table counting the pixels of the image that are not bg_col"""
+        mask = Image(width=image.width, height=image.height)
+        for j in range(0, image.height):
+            mask.set_row(j, image.foreground_row(j, bg_col))
+        table = cls(mask)
+        table.version = image.version
+        return table
+
+    def sum(self, box):
+        """sum of the levels of all pixels within the given box area"""
+        stride = self.width + 1
+        table = self._table
+        top = box.tl.j * stride
+        bottom = (box.br.j + 1) * stride
+        left = box.tl.i
+        right = box.br.i + 1
+        return table[bottom + right] - table[top + right] - table[bottom + left] + table[top + left]
+
+    def mean(self, box):
+        """average level of pixels within the given box area"""
+        return self.sum(box) / box.area()
+
+
+def _lower_envelope(f, w):
+    """1D squared distance transform of the sampled function f: for
+    each q, the minimum over p of f[p] + w * (q - p)², and the p that
+    gives it (-1 where all f[p] are infinite). Finds the lower envelope
+    of the parabolas rooted at each p, then reads it from left to right,
+    in linear time (Felzenszwalb and Huttenlocher, Distance Transforms
+    of Sampled Functions)."""
+    n = len(f)
+    inf = float('inf')
+    v = [0] * n           # roots of the parabolas of the envelope
+    z = [0.0] * (n + 1)   # z[k] to z[k + 1]: where parabola v[k] is the lowest
+    k = -1
+    for q in range(0, n):
+        fq = f[q]
+        if fq == inf:
+            continue
+        if k < 0:
+            k = 0
+            v[0] = q
+            z[0] = -inf
+            z[1] = inf
+            continue
+        while True:
+            p = v[k]
+            s = ((fq + w * q * q) - (f[p] + w * p * p)) / (2 * w * (q - p))
+            if s > z[k]:
+                break
+            k -= 1   # parabola p is hidden by q, z[0] is -inf so k stays >= 0
+        k += 1
+        v[k] = q
+        z[k] = s
+        z[k + 1] = inf
+    if k < 0:
+        return [inf] * n, [-1] * n
+    d = [0.0] * n
+    arg = [0] * n
+    k = 0
+    for q in range(0, n):
+        while z[k + 1] < q:
+            k += 1
+        p = v[k]
+        d[q] = f[p] + w * (q - p) * (q - p)
+        arg[q] = p
+    return d, arg
+
+
+class DistanceTransform:
+    """Exact Euclidean distance transform of a grey image: for each
+    pixel, the distance to the nearest foreground pixel (level above
+    threshold), and which pixel it is. Built in linear time with two
+    passes: the nearest foreground pixel of each column, then the
+    lower envelope of each row, see _lower_envelope(). Once built,
+    both are found with 1 lookup.
+
+    Distances are in pixels by default, or with a scale (sx, sy) like
+    PixelGrid, where sx and sy can also be lists with the width and
+    height of the pixels of each row. Distances from a pixel then use
+    the scale of its row, like PixelGrid queries given the scale of the
+    row of the searched pixel: both find the same distances. When many
+    pixels are at the same distance, they may pick different ones."""
+    def __init__(self, image, threshold=0, scale=(1, 1)):
+        if not image.is_grey():
+            raise RuntimeError("only grey images have a distance transform")
+        self.width = width = image.width
+        self.height = height = image.height
+        self.version = image.version
+        self.threshold = threshold
+        sx, sy = scale
+        widths = [sx] * height if isinstance(sx, (int, float)) else sx
+        heights = [sy] * height if isinstance(sy, (int, float)) else sy
+        # first pass: row of the nearest foreground pixel of the same
+        # column, or -1, the first one if two are at the same distance.
+        # It doesn't depend on the scale.
+        rows = []
+        above = [-1] * width
+        for j in range(0, height):
+            above = [j if level > threshold else a for level, a in zip(image.get_row(j), above)]
+            rows.append(above)
+        below = [-1] * width
+        for j in range(height - 1, -1, -1):
+            below = [j if a == j else b for a, b in zip(rows[j], below)]
+            rows[j] = [b if a < 0 or (b >= 0 and b - j < j - a) else a for a, b in zip(rows[j], below)]
+        # second pass: combine columns along each row
+        inf = float('inf')
+        self._d2 = array('d')
+        self._nearest = array('q')   # j * width + i of the nearest pixel, or -1
+        for j in range(0, height):
+            column_rows = rows[j]
+            sy2 = heights[j] * heights[j]
+            f = [inf if r < 0 else sy2 * (r - j) * (r - j) for r in column_rows]
+            d2, arg = _lower_envelope(f, widths[j] * widths[j])
+            self._d2.extend(d2)
+            self._nearest.extend(-1 if i < 0 else column_rows[i] * width + i for i in arg)
+
+    def distance(self, pixel):
+        """distance from pixel to the nearest foreground pixel, 0 on
+        the foreground, inf if there is none"""
+        return sqrt(self._d2[pixel.j * self.width + pixel.i])
+
+    def nearest(self, pixel):
+        """the foreground Pixel nearest to pixel, or None if there is
+        none"""
+        n = self._nearest[pixel.j * self.width + pixel.i]
+        if n < 0:
+            return None
+        return Pixel(n % self.width, n // self.width)
+
+    def max_distance(self):
+        """the largest distance to the foreground, of any pixel, inf if
+        there is no foreground"""
+        return sqrt(max(self._d2))
+
+
+class Blob:
+    """A blob found by BlobFinder, stored as runs of pixels along with
+    a summary: size, bounding box, centroid, and min, max, mean grey
+    level (e.g. rain intensity) of its pixels. The summary is computed
+    while the runs are added, the Pixel objects are only created when
+    the blob is iterated."""
+    def __init__(self, label, image):
+        self.label = label
+        self.image = image
+        self.runs = []   # (j, ia, ib): pixels of row j, from column ia to ib included
+        self.size = 0
+        self.ia = None   # bounding box
+        self.ja = None
+        self.ib = None
+        self.jb = None
+        self.min_level = None
+        self.max_level = None
+        self._sum_i = 0
+        self._sum_j = 0
+        self._sum_level = 0
+        self._pixels = None
+
+    def add_run(self, j, ia, ib):
+        """add pixels of row j, from column ia to column ib included.
+        Runs must be added from top to bottom, and left to right."""
+        n = ib - ia + 1
+        self.runs.append((j, ia, ib))
+        self.size += n
+        self._sum_i += (ia + ib) * n / 2
+        self._sum_j += j * n
+        if self.ja is None:
+            self.ia, self.ja, self.ib = ia, j, ib
+        self.ia = min(self.ia, ia)
+        self.ib = max(self.ib, ib)
+        self.jb = j
+        if self.image.is_grey():
+            levels = self.image.get_row(j, ia, ib + 1)
+            low = min(levels)
+            high = max(levels)
+            self._sum_level += sum(levels)
+            if self.min_level is None or low < self.min_level:
+                self.min_level = low
+            if self.max_level is None or high > self.max_level:
+                self.max_level = high
+        self._pixels = None
+
+    def __len__(self):
+        """number of pixels in the blob"""
+        return self.size
+
+    def __repr__(self):
+        return f"Blob({self.label}, size={self.size}, box=({self.ia},{self.ja})-({self.ib},{self.jb}))"
+
+    @property
+    def tl(self):
+        """top-left Pixel of the bounding box"""
+        return Pixel(self.ia, self.ja)
+
+    @property
+    def br(self):
+        """bottom-right Pixel of the bounding box"""
+        return Pixel(self.ib, self.jb)
+
+    @property
+    def centroid(self):
+        """(i, j) coordinates of the center of the blob"""
+        return (self._sum_i / self.size, self._sum_j / self.size)
+
+    @property
+    def mean_level(self):
+        if not self.image.is_grey():
+            return None
+        return self._sum_level / self.size
+
+    @property
+    def pixels(self):
+        """the pixels of the blob, as a list of Pixel"""
+        if self._pixels is None:
+            get_pixel_at = self.image.get_pixel_at
+            self._pixels = [get_pixel_at(i, j) for j, ia, ib in self.runs for i in range(ia, ib + 1)]
+        return self._pixels
+
+    def __iter__(self):
+        return iter(self.pixels)
+
+    def __getitem__(self, n):
+        return self.pixels[n]
+
+
+class PixelGrid:
+    """Spatial index of pixels, stored as horizontal runs in a uniform
+    grid of square cells. Nearest neighbour queries only visit the
+    cells around the searched pixel, and compare squared distances.
+
+    Distances are in pixels by default. Queries can also be given a
+    scale (sx, sy), the width and height of a pixel in another unit,
+    e.g. kilometers on a map whose pixels are not square. Distances are
+    then sqrt((sx * di)² + (sy * dj)²), in this unit."""
+    def __init__(self, cell=8):
+        self.cell = cell
+        self._cells = {}   # (ci, cj) -> list of (j, ia, ib) runs
+        self._count = 0
+        self._ca = self._cb = None   # range of cell columns used
+        self._ra = self._rb = None   # range of cell rows used
+
+    def __len__(self):
+        """number of pixels in the index"""
+        return self._count
+
+    def add_run(self, j, ia, ib):
+        """add pixels of row j, from column ia to column ib included"""
+        cell = self.cell
+        cj = j // cell
+        self._count += ib - ia + 1
+        while ia <= ib:
+            ci = ia // cell
+            end = min(ib, (ci + 1) * cell - 1)
+            self._cells.setdefault((ci, cj), []).append((j, ia, end))
+            self._ca = ci if self._ca is None else min(self._ca, ci)
+            self._cb = ci if self._cb is None else max(self._cb, ci)
+            self._ra = cj if self._ra is None else min(self._ra, cj)
+            self._rb = cj if self._rb is None else max(self._rb, cj)
+            ia = end + 1
+
+    @classmethod
+    def from_blobs(cls, blobs, cell=8):
+        """index all pixels of the given Blob objects"""
+        grid = cls(cell)
+        for blob in blobs:
+            for j, ia, ib in blob.runs:
+                grid.add_run(j, ia, ib)
+        return grid
+
+    def _iter_ring(self, ci, cj, r):
+        """returns an iterator on the runs of cells at a distance of
+        exactly r cells of cell (ci, cj)"""
+        cells = self._cells
+        for y in range(cj - r, cj + r + 1):
+            if y < self._ra or y > self._rb:
+                continue
+            step = 1 if y in (cj - r, cj + r) else 2 * r
+            for x in range(ci - r, ci + r + 1, step):
+                runs = cells.get((x, y))
+                if runs is not None:
+                    yield from runs
+
+    def _max_ring(self, ci, cj):
+        """the ring that includes all cells"""
+        return max(abs(ci - self._ca), abs(ci - self._cb), abs(cj - self._ra), abs(cj - self._rb))
+
+    def _ring_bound(self, r, scale=(1, 1)):
+        """squared distance below which no pixel of ring r can be"""
+        return ((r - 1) * self.cell * min(scale)) ** 2 if r > 0 else 0
+
+    def nearest(self, pixel, scale=(1, 1)):
+        """returns the indexed Pixel nearest to the given pixel, or
+        None if the index is empty. Ties are broken by picking the
+        first pixel in rows, then columns order"""
+        return next(iter(self.k_nearest(pixel, 1, scale)), None)
+
+    def k_nearest(self, pixel, k, scale=(1, 1)):
+        """returns the k indexed pixels nearest to the given pixel,
+        as a list of Pixel sorted by distance"""
+        if self._count == 0 or k <= 0:
+            return []
+        qi, qj = pixel.i, pixel.j
+        sx2, sy2 = scale[0] ** 2, scale[1] ** 2
+        ci, cj = qi // self.cell, qj // self.cell
+        best = []   # up to k (d2, j, i) tuples, sorted
+        for r in range(0, self._max_ring(ci, cj) + 1):
+            if len(best) == k and best[-1][0] <= self._ring_bound(r, scale):
+                break
+            for j, ia, ib in self._iter_ring(ci, cj, r):
+                dj2 = sy2 * (j - qj) ** 2
+                if k == 1:
+                    i = min(max(qi, ia), ib)   # nearest pixel of the run
+                    candidates = ((dj2 + sx2 * (i - qi) ** 2, j, i),)
+                else:
+                    candidates = ((dj2 + sx2 * (i - qi) ** 2, j, i) for i in range(ia, ib + 1))
+                for candidate in candidates:
+                    if len(best) < k or candidate < best[-1]:
+                        insort(best, candidate)
+                        del best[k:]
+        return [Pixel(i, j) for d2, j, i in best]
+
+    def within(self, pixel, d, scale=(1, 1)):
+        """returns all indexed pixels at a distance of d or less from
+        the given pixel, as a list of Pixel in rows, then columns
+        order"""
+        if self._count == 0:
+            return []
+        qi, qj = pixel.i, pixel.j
+        sx2, sy2 = scale[0] ** 2, scale[1] ** 2
+        ci, cj = qi // self.cell, qj // self.cell
+        d2 = d * d
+        found = []
+        for r in range(0, min(self._max_ring(ci, cj), int(d / min(scale)) // self.cell + 1) + 1):
+            for j, ia, ib in self._iter_ring(ci, cj, r):
+                dj2 = sy2 * (j - qj) ** 2
+                for i in range(ia, ib + 1):
+                    if dj2 + sx2 * (i - qi) ** 2 <= d2:
+                        found.append((j, i))
+        return [Pixel(i, j) for j, i in sorted(found)]
+
+
 class BlobFinder:
-    def __init__(self, image, bg_col=BLACK):
+    """Finds blobs: groups of contiguous pixels (left, right, up or down)
+    that are not of the background color.
+
+    Two methods are available:
+      'pixels': labels each pixel, then resolves equivalent labels
+      'runs': finds horizontal runs of non background pixels in each
+        row, then merges runs that overlap between adjacent rows. Much
+        faster when most of the image is background, since the cost
+        depends on the number of runs rather than the number of pixels.
+    Both methods find the same blobs, in the same order.
+
+    With the 'runs' method, blobs can also be found from those of the
+    previous image of a sequence (e.g. radar images 5 minutes apart),
+    when consecutive images are mostly the same: the image is compared
+    with the previous one in square tiles, blobs that are away from
+    tiles that changed are kept as they are, and only the rest of the
+    image is labelled again. Blobs keep their label from one image to
+    the next: a blob that is kept, or that has the most pixels in
+    common with a blob of the previous image, has the same label. New
+    blobs get labels never used before in the sequence."""
+    methods = ('pixels', 'runs')
+
+    def __init__(self, image, bg_col=BLACK, method='pixels', previous=None, tile=16):
+        """
+
+        parameters:
+          image: Image where blobs are searched
+          bg_col: color of the background
+          method: see above
+          previous: BlobFinder of the previous image, of the same size,
+            which must not have changed since its blobs were found.
+            Needs the 'runs' method.
+          tile: size of the tiles compared with the previous image
+        """
+        if method not in self.methods:
+            raise RuntimeError(f"unknown method {method}, must be one of {self.methods}")
+        if previous is not None and method != 'runs':
+            raise RuntimeError("blobs can only be found from the previous image with the 'runs' method")
         self.image = image
         self.bg_col = bg_col
+        self.method = method
+        self.tile = tile
+        self.reused = 0   # number of blobs kept from the previous image
+        self._previous = previous
+        self._next_label = None
         self._blobmap = None
         self._blobs = None
 
@@ -333,75 +998,46 @@ class BlobFinder:
         label are part of the same blob. Potential new blobs, or for
         those where connection to existing blobs is not known yet, are
         given a new label. later, when two labels are found to be
-        actually in the same blob, their labels is added to a
-        "equivalence" table that forms a cyclic graph, where nodes in
-        a cycle are equivalent:
+        actually in the same blob, their sets are merged in a
+        DisjointSet:
         e.g.:
-            1: 2, 3
-            2: 1, 3
-            3: 1
-            4: 6
-            5:
-            6: 4, 7
-            7: 6
+            {1, 2, 3}
+            {4, 6, 7}
+            {5}
 
             1, 2, and 3 are equivalents
             4, 6 and 7 are equivalent
         """
-        graph = {}
-        blob_id = 0
-        blobmap = Image(self.image.width, self.image.height)
-
-        def set_equivalence(label1, label2):
-            if label1 is None or label2 is None:
-                raise RuntimeError("None labels")
-            if label1 == label2:
-                raise RuntimeError("equal labels")
-            if label1 not in graph:
-                graph[label1] = [label2]
-                return
-            if label2 not in graph[label1]:
-                graph[label1].append(label2)
-
-        def non_bg_color_at(i, j):
-            col = blobmap.get_color_at(i, j)
-            if col == self.bg_col:
-                return None
-            return col
-
-        for pixel in self.image.iter_area():
-            if pixel.col == self.bg_col:
-                continue
-            i = pixel.i
-            j = pixel.j
-            left = non_bg_color_at(i - 1, j    ) if i > 0 else None
-            up   = non_bg_color_at(i    , j - 1) if j > 0 else None
-            if up is None and left is None:
-                blob_id += 1   # no known neighbours, maybe a new blob ?
-                blobmap.set_color_at(i, j, Color.grey(blob_id))
-                graph[blob_id] = []
-                continue
-            if up is not None:
-                blobmap.set_color_at(i, j, up)  # belongs to the same blob as "up"
-                if left is not None and left != up:
-                    set_equivalence(left.g, up.g)
-                    set_equivalence(up.g, left.g)
-                continue
-            blobmap.set_color_at(i, j, left)  # belongs to the same blob as "left"
-        return (blobmap, graph)
+        sets = DisjointSet()
+        width = self.image.width
+        blobmap = Image(width, self.image.height, typecode='L')
+        labels = blobmap.data   # 0 means background
+
+        for j in range(0, self.image.height):
+            foreground = self.image.foreground_row(j, self.bg_col)
+            i = foreground.find(1)
+            while i >= 0:
+                k = j * width + i
+                left = labels[k - 1    ] if i > 0 else 0
+                up   = labels[k - width] if j > 0 else 0
+                if up == 0 and left == 0:
+                    labels[k] = sets.make_set()   # no known neighbours, maybe a new blob ?
+                elif up != 0:
+                    labels[k] = up  # belongs to the same blob as "up"
+                    if left != 0 and left != up:
+                        sets.union(left, up)
+                else:
+                    labels[k] = left  # belongs to the same blob as "left"
+                i = foreground.find(1, i + 1)
+        return (blobmap, sets)
 
-    def _resolve_labels(self, graph):
-        """walk through the equivalence graph built in 1st pass,
-        Returns a new structure where all labels are "resolved" to the
-        smallest label
+    def _resolve_labels(self, sets):
+        """Returns a new structure where all labels found in 1st pass
+        are "resolved" to the smallest label of their set
         e.g. input:
-            1: 2, 3
-            2: 1, 3
-            3: 1
-            4: 6
-            5:
-            6: 4, 7
-            7: 6
+            {1, 2, 3}
+            {4, 6, 7}
+            {5}
 
         output:
             1: 1
@@ -412,57 +1048,231 @@ class BlobFinder:
             6: 4
             7: 4
 """
-
-        resolved = {}
-
-        def smallest_label(label, explored=[]):
-            if label in resolved:
-                return resolved[label]
-            smallest = label
-            for label in graph[label]:
-                if label < smallest:
-                    smallest = label
-                if label in explored:
-                    continue
-                x = smallest_label(label, explored + [label])
-                if x < smallest:
-                    smallest = x
-            return smallest
-
-        for label in graph:
-            resolved[label] = smallest_label(label)
-        return resolved
+        return [0] + [sets.smallest(label) for label in range(1, len(sets) + 1)]
 
     def _second_pass(self, blobmap, resolved):
         """In the blobmap, replace each label by its "resolved"
         value"""
-        for pixel in blobmap.iter_area():
-            label = pixel.col.g
+        labels = blobmap.data
+        for k in range(0, len(labels)):
+            label = labels[k]
             if label == 0:
                 continue
-            label = resolved[label]
-            blobmap.set_color_at(pixel.i, pixel.j, Color.grey(label))
+            labels[k] = resolved[label]
+
+    def _find_runs(self):
+        """returns, for each row, the list of (ia, ib) runs of non
+        background pixels, from column ia to column ib included"""
+        return [self._runs_of_row(j) for j in range(0, self.image.height)]
+
+    def _runs_of_row(self, j):
+        """the list of (ia, ib) runs of non background pixels of row j"""
+        foreground = self.image.foreground_row(j, self.bg_col)
+        return [(m.start(), m.end() - 1) for m in _FOREGROUND_RUN.finditer(foreground)]
+
+    def _label_runs(self):
+        """Label each run found by _find_runs(), merging labels of runs
+        that overlap with a run of the previous row. Returns the blobs
+        as Blob objects"""
+        return self._union_runs(enumerate(self._find_runs()))
+
+    def _union_runs(self, rows, skip=()):
+        """Label runs, merging labels of runs that overlap with a run of
+        the row above, if it is part of rows. Returns the blobs as Blob
+        objects.
+
+        parameters:
+          rows: (j, [(ia, ib), ...]) runs of each row, in rows order
+          skip: set of (j, ia, ib) runs left out
+        """
+        sets = DisjointSet()
+        labelled = []     # (label, j, ia, ib) for all runs
+        previous = []     # (label, ia, ib) for runs of the previous row
+        last = None
+        for j, row in rows:
+            if last != j - 1:
+                previous = []   # the row above is not labelled
+            last = j
+            current = []
+            k = 0
+            for ia, ib in row:
+                if (j, ia, ib) in skip:
+                    continue
+                label = sets.make_set()
+                # runs of the previous row ending before this run can't
+                # overlap with the next runs either
+                while k < len(previous) and previous[k][2] < ia:
+                    k += 1
+                n = k
+                while n < len(previous) and previous[n][1] <= ib:
+                    sets.union(label, previous[n][0])
+                    n += 1
+                current.append((label, ia, ib))
+                labelled.append((label, j, ia, ib))
+            previous = current
+        blobs = {}
+        for label, j, ia, ib in labelled:
+            blob_label = sets.smallest(label)
+            if blob_label not in blobs:
+                blobs[blob_label] = Blob(blob_label, self.image)
+            blobs[blob_label].add_run(j, ia, ib)
+        return list(blobs.values())
+
+    def _dirty_tiles(self, previous):
+        """returns the set of (ti, tj) tiles where the image differs
+        from the previous image"""
+        tile = self.tile
+        width = self.image.width
+        channels = self.image.channels
+        dirty = set()
+        for j in range(0, self.image.height):
+            row = self.image.get_row(j)
+            before = previous.get_row(j)
+            if row == before:
+                continue
+            tj = j // tile
+            for ti in range(0, -(-width // tile)):
+                ka = ti * tile * channels
+                kb = min((ti + 1) * tile, width) * channels
+                if row[ka:kb] != before[ka:kb]:
+                    dirty.add((ti, tj))
+        return dirty
+
+    def _touches(self, blob, dirty):
+        """True if a dirty tile is at 1 pixel or less from the bounding
+        box of blob"""
+        tile = self.tile
+        for tj in range(max(0, blob.ja - 1) // tile, min(self.image.height - 1, blob.jb + 1) // tile + 1):
+            for ti in range(max(0, blob.ia - 1) // tile, min(self.image.width - 1, blob.ib + 1) // tile + 1):
+                if (ti, tj) in dirty:
+                    return True
+        return False
+
+    def _update_runs(self):
+        """Find blobs from the blobs of the previous image. A blob
+        whose pixels, and the background pixels around them, are in
+        tiles that didn't change, is the same in this image. Pixels of
+        other blobs of this image can only be in a tile that changed, or
+        where a blob of the previous image that is not kept was, so
+        only the rows of those are labelled again."""
+        previous = self._previous
+        dirty = self._dirty_tiles(previous.image)
+        kept = []
+        changed = []
+        for blob in previous.blobs:
+            (changed if self._touches(blob, dirty) else kept).append(blob)
+        rows = set()
+        for ti, tj in dirty:
+            rows.update(range(tj * self.tile, min((tj + 1) * self.tile, self.image.height)))
+        for blob in changed:
+            rows.update(range(blob.ja, blob.jb + 1))
+        blobs = self._union_runs(((j, self._runs_of_row(j)) for j in sorted(rows)),
+                                 skip=set(run for blob in kept for run in blob.runs))
+        self._next_label = self._relabel(blobs, changed, previous.next_label)
+        for blob in kept:
+            same = copy(blob)   # same runs and summary, in this image
+            same.image = self.image
+            same._pixels = None
+            blobs.append(same)
+        blobs.sort(key=lambda b: b.runs[0])
+        self.reused = len(kept)
+        return blobs
+
+    def _overlaps(self, found, changed):
+        """(n, label, blob) for each blob of found, and label of a blob
+        of changed it has n > 0 pixels in common with, most pixels
+        first"""
+        runs_of_row = {}
+        for blob in changed:
+            for j, ia, ib in blob.runs:
+                runs_of_row.setdefault(j, []).append((ia, ib, blob.label))
+        overlaps = []
+        for blob in found:
+            counts = {}
+            for j, ia, ib in blob.runs:
+                for pa, pb, label in runs_of_row.get(j, ()):
+                    n = min(ib, pb) - max(ia, pa) + 1
+                    if n > 0:
+                        counts[label] = counts.get(label, 0) + n
+            overlaps.extend((n, label, blob) for label, n in counts.items())
+        overlaps.sort(key=lambda o: o[0], reverse=True)
+        return overlaps
+
+    def _relabel(self, found, changed, next_label):
+        """Blobs of found get the label of the blob of changed (the
+        previous image) they have the most pixels in common with, or
+        else a new label from next_label on. Returns the next label
+        not used."""
+        taken = set()
+        named = set()
+        for n, label, blob in self._overlaps(found, changed):
+            if label not in taken and id(blob) not in named:
+                blob.label = label
+                taken.add(label)
+                named.add(id(blob))
+        for blob in found:
+            if id(blob) not in named:
+                blob.label = next_label
+                next_label += 1
+        return next_label
+
+    @property
+    def next_label(self):
+        """a label not used by any blob of this image, or of the
+        previous images"""
+        if self._next_label is None:
+            self._next_label = max((blob.label for blob in self.blobs), default=0) + 1
+        return self._next_label
+
+    def _runs_from_blobmap(self):
+        """returns the blobs of the blobmap as Blob objects"""
+        blobs = {}
+        for j in range(0, self.image.height):
+            i = 0
+            for label, run in groupby(self.blobmap.get_row(j)):
+                n = len(list(run))
+                if label != 0:
+                    if label not in blobs:
+                        blobs[label] = Blob(label, self.image)
+                    blobs[label].add_run(j, i, i + n - 1)
+                i += n
+        return list(blobs.values())
 
     @property
     def blobmap(self):
+        """an image of the same size, where background pixels are 0,
+        and pixels of the same blob have the same label"""
         if self._blobmap is None:
-            blobmap, graph = self._first_pass()
-            resolved = self._resolve_labels(graph)
-            self._second_pass(blobmap, resolved)
-            self._blobmap = blobmap
+            if self.method == 'runs':
+                blobmap = Image(self.image.width, self.image.height, typecode='L')
+                for blob in self.blobs:
+                    for j, ia, ib in blob.runs:
+                        blobmap.set_row(j, array('L', [blob.label]) * (ib - ia + 1), ia)
+                self._blobmap = blobmap
+            else:
+                blobmap, sets = self._first_pass()
+                resolved = self._resolve_labels(sets)
+                self._second_pass(blobmap, resolved)
+                self._blobmap = blobmap
         return self._blobmap
 
+    @property
+    def runs(self):
+        """all blobs, each one as a list of (j, ia, ib) runs of pixels
+        in row j, from column ia to column ib included"""
+        return [blob.runs for blob in self.blobs]
+
     @property
     def blobs(self):
+        """all blobs, as Blob objects"""
         if self._blobs is None:
-            blobs = {}
-            for pixel in self.image.iter_area():
-                label = self.blobmap.get_pixel_at(pixel.i, pixel.j).col.g
-                if label == 0:
-                    continue
-                if label in blobs:
-                    blobs[label].append(pixel)
-                else:
-                    blobs[label] = [pixel]
-            self._blobs = list(blobs.values())
+            previous = self._previous
+            if previous is not None and (previous.image.width, previous.image.height, previous.image.channels) == \
+                    (self.image.width, self.image.height, self.image.channels):
+                self._blobs = self._update_runs()
+            elif self.method == 'runs':
+                self._blobs = self._label_runs()
+            else:
+                self._blobs = self._runs_from_blobmap()
+            self._previous = None   # not needed anymore, don't keep all previous images
         return self._blobs
@@ -0,0 +1,138 @@
+"""Intensities at locations over a range of times, e.g. to plot the
+rain at home over the last two hours, or to find when rain started or
+stopped.
+
+Decoded intensity maps are kept in a FrameCache, that holds the most
+recently used ones, up to a given amount of memory. Series over time
+ranges that overlap, e.g. the last two hours asked every 5 minutes,
+only load the images they don't share."""
+import collections
+import datetime
+from nlannuzel.sgrain.rain import RainAreas
+
+
+def _nbytes(intensity_map):
+    """memory used by the levels of an intensity map"""
+    return len(intensity_map.data) * getattr(intensity_map.data, 'itemsize', 1)
+
+
+class FrameCache:
+    """intensity maps by image time. The least recently used maps are
+    dropped when they use more than max_bytes of memory."""
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._frames = collections.OrderedDict()   # image time -> Image, least recently used first
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, image_time):
+        return image_time in self._frames
+
+    def get(self, image_time):
+        """the intensity map of image_time, or None if it is not in the
+        cache"""
+        intensity_map = self._frames.get(image_time)
+        if intensity_map is not None:
+            self._frames.move_to_end(image_time)
+        return intensity_map
+
+    def put(self, image_time, intensity_map):
+        """keep intensity_map as the map of image_time. It must not be
+        changed afterwards, e.g. by RainAreas.remove_blobs()."""
+        if image_time in self._frames:
+            self.nbytes -= _nbytes(self._frames.pop(image_time))
+        self._frames[image_time] = intensity_map
+        self.nbytes += _nbytes(intensity_map)
+        while self.nbytes > self.max_bytes and len(self._frames) > 1:
+            _, dropped = self._frames.popitem(last=False)
+            self.nbytes -= _nbytes(dropped)
+
+    def clear(self):
+        self._frames.clear()
+        self.nbytes = 0
+
+
+class RainHistory:
+    """intensities at locations over time, from the images loaded by
+    a RainAreas, or a subclass such as ArchivedRainAreas"""
+    def __init__(self, rain=None, frames=None):
+        """
+
+        parameters:
+          rain: RainAreas used to load images, and to query them, a
+            new RainAreas by default
+          frames: FrameCache that keeps decoded images, can be shared
+            by many RainHistory. A new one by default.
+        """
+        self.rain = rain if rain is not None else RainAreas()
+        self.frames = frames if frames is not None else FrameCache()
+
+    def image_times(self, start, end):
+        """times of all images from start to end, both included"""
+        image_time = self.rain.round_to_previous_5_min(start)
+        while image_time <= end:
+            yield image_time
+            image_time += datetime.timedelta(minutes=5)
+
+    def frame(self, image_time):
+        """the intensity map of image_time, from the cache or loaded by
+        rain, or None if there is no image at this time, e.g. because
+        the radar was down. It must not be changed."""
+        intensity_map = self.frames.get(image_time)
+        if intensity_map is not None:
+            return intensity_map
+        try:
+            self.rain.load_image(image_time)
+        except RuntimeError:
+            return None
+        # load_image() looks back for an older image if there's none at
+        # image_time, it's kept too since it may be part of the series
+        self.frames.put(self.rain.image_time, self.rain.intensity_map)
+        if self.rain.image_time != image_time:
+            return None
+        return self.rain.intensity_map
+
+    def series(self, locations, start, end, d=0):
+        """Intensity at each of the given Location, in each image from
+        start to end. Returns a list of (image_time, intensities) in
+        time order, where intensities is a list in the same order as
+        locations. Intensities are None if there is no image at
+        image_time, or if the location is outside of the map.
+
+        parameters:
+          d: report the average intensity of pixels at distance d or
+            less instead, see RainAreas.intensity_at()
+        """
+        series = []
+        for image_time in self.image_times(start, end):
+            intensity_map = self.frame(image_time)
+            if intensity_map is None:
+                series.append((image_time, [None] * len(locations)))
+                continue
+            self.rain.use_image(image_time, intensity_map)
+            reports = self.rain.query(locations, d)
+            series.append((image_time, [report.intensity if d == 0 else report.mean_intensity for report in reports]))
+        return series
+
+    def series_at(self, location, start, end, d=0):
+        """same as series() for a single Location, returns a list of
+        (image_time, intensity)"""
+        return [(image_time, intensities[0]) for image_time, intensities in self.series([location], start, end, d)]
+
+    def changes_at(self, location, start, end, d=0, threshold=0):
+        """times when rain started or stopped at location, from start to
+        end. It's raining when the intensity is more than threshold.
+        Returns a list of (image_time, raining) for each image where
+        raining differs from the previous image. Times without an image
+        are skipped."""
+        changes = []
+        raining = None
+        for image_time, intensity in self.series_at(location, start, end, d):
+            if intensity is None:
+                continue
+            if raining is not None and (intensity > threshold) != raining:
+                changes.append((image_time, intensity > threshold))
+            raining = intensity > threshold
+        return changes
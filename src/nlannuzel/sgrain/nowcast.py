@@ -0,0 +1,307 @@
+"""When will the rain reach a location: motion of rain between two
+consecutive images, and the time rain moving that way takes to arrive
+at given locations.
+
+Motion is estimated in two ways, once per pair of images:
+  - blobs of the current image are matched with the blobs of the
+    previous one they overlap the most, or else the one with the
+    nearest centroid (tracks)
+  - the image is divided in square blocks, and each block with rain is
+    matched with the block of the previous image it most looks like,
+    within a few pixels (motion field)
+A blob that is matched with a blob of a similar size moves like its
+centroid, other blobs (e.g. new, merging, or splitting) move like the
+motion field over their pixels. Rain is assumed to keep moving at the
+same speed, in the same direction."""
+import datetime
+import operator
+from math import ceil, floor, sqrt
+from nlannuzel.sgrain.graph import Pixel
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain import vector
+
+
+def _shifts(search):
+    """all displacements of search pixels or less, shortest first, so
+    that ties are resolved in favour of slow motion"""
+    shifts = [(di, dj) for dj in range(-search, search + 1) for di in range(-search, search + 1)]
+    return sorted(shifts, key=lambda s: (s[0] * s[0] + s[1] * s[1], s[1], s[0]))
+
+
+def _shifted_row(image, j, ia, ib):
+    """levels of row j from column ia up to, but not including, ib,
+    with 0 outside of the image"""
+    if j < 0 or j >= image.height:
+        return bytes(ib - ia)
+    return bytes(max(0, -ia)) + image.get_row(j, max(0, ia), min(ib, image.width)) + bytes(max(0, ib - image.width))
+
+
+def block_motion(previous, current, block=16, search=4):
+    """Motion field from the intensity map previous to current: for
+    each block of block x block pixels of current with rain, the
+    displacement (di, dj), of search pixels or less in each direction,
+    such that the block of previous at (i - di, j - dj) has the least
+    sum of absolute differences of levels. Returns a dict of
+    (bi, bj) -> (di, dj), where (bi, bj) is the column and row of the
+    block."""
+    shifts = _shifts(search)
+    field = {}
+    for bj in range(0, -(-current.height // block)):
+        ja = bj * block
+        jb = min(ja + block, current.height)
+        for bi in range(0, -(-current.width // block)):
+            ia = bi * block
+            ib = min(ia + block, current.width)
+            rows = [current.get_row(j, ia, ib) for j in range(ja, jb)]
+            if all(row.count(0) == len(row) for row in rows):
+                continue   # no rain, no motion to see
+            best = None
+            for di, dj in shifts:
+                sad = 0
+                for j, row in enumerate(rows, ja):
+                    sad += sum(map(abs, map(operator.sub, row, _shifted_row(previous, j - dj, ia - di, ib - di))))
+                    if best is not None and sad >= best[0]:
+                        break
+                if best is None or sad < best[0]:
+                    best = (sad, di, dj)
+            field[(bi, bj)] = best[1:]
+    return field
+
+
+def match_blobs(previous, current, max_shift):
+    """Tracks blobs from the list of Blob previous to the list of Blob
+    current. Returns a list of (previous blob, current blob, overlap)
+    with one entry per blob of current that is matched: with the blob
+    of previous it has the most pixels in common (overlap), or if it
+    has none in common with any, with the one with the nearest
+    centroid, at max_shift pixels or less (overlap is then 0)."""
+    runs_of_row = {}   # row -> [(ia, ib, blob)] of previous
+    for blob in previous:
+        for j, ia, ib in blob.runs:
+            runs_of_row.setdefault(j, []).append((ia, ib, blob))
+    tracks = []
+    for blob in current:
+        overlaps = {}
+        for j, ia, ib in blob.runs:
+            for pa, pb, other in runs_of_row.get(j, ()):
+                n = min(ib, pb) - max(ia, pa) + 1
+                if n > 0:
+                    overlaps[id(other)] = (overlaps.get(id(other), (0, other))[0] + n, other)
+        if overlaps:
+            overlap, other = max(overlaps.values(), key=lambda o: o[0])
+            tracks.append((other, blob, overlap))
+            continue
+        ci, cj = blob.centroid
+        nearest = None
+        for other in previous:
+            pi, pj = other.centroid
+            d2 = (pi - ci) ** 2 + (pj - cj) ** 2
+            if d2 <= max_shift * max_shift and (nearest is None or d2 < nearest[0]):
+                nearest = (d2, other)
+        if nearest is not None:
+            tracks.append((nearest[1], blob, 0))
+    return tracks
+
+
+def heading_of(vi, vj):
+    """direction of the displacement (vi, vj) in degrees, counted
+    clockwise with 0 to the top of the map (north), see
+    Pixel.angle_to()"""
+    origin = Pixel(abs(vi), abs(vj))   # so that both pixels have positive coordinates
+    return origin.angle_to(Pixel(origin.i + vi, origin.j + vj))
+
+
+class Nowcast:
+    """motion of rain from the image of a RainAreas to the image of
+    another one, and when it arrives at locations. Motion is estimated
+    once, when first needed, and used for all locations."""
+
+    # how close, in pixels, rain has to pass to a location to reach it
+    tolerance = 0.5
+
+    def __init__(self, previous, current, block=16, search=4):
+        """
+
+        parameters:
+          previous, current: RainAreas with consecutive images loaded,
+            e.g. 5 minutes apart. Noise should be removed from both
+            (remove_blobs()) before, if needed.
+          block: size of the blocks of the motion field, in pixels
+          search: fastest motion detected by the motion field, in
+            pixels per image
+        """
+        self.minutes = (current.image_time - previous.image_time).total_seconds() / 60
+        if self.minutes <= 0:
+            raise RuntimeError("the previous image must be older than the current one")
+        self.previous = previous
+        self.current = current
+        self.block = block
+        self.search = search
+        self._field = None
+        self._tracks = None
+        self._velocities = None
+
+    @property
+    def field(self):
+        """motion field, see block_motion()"""
+        if self._field is None:
+            if self.current.engine == 'numpy':
+                self._field = vector.block_motion(vector.as_array(self.previous.intensity_map),
+                                                  vector.as_array(self.current.intensity_map),
+                                                  self.block, self.search, _shifts(self.search))
+            else:
+                self._field = block_motion(self.previous.intensity_map, self.current.intensity_map, self.block, self.search)
+        return self._field
+
+    @property
+    def tracks(self):
+        """blobs of the previous image matched with blobs of the current
+        one, see match_blobs()"""
+        if self._tracks is None:
+            self._tracks = match_blobs(self.previous.blobs, self.current.blobs, self.search)
+        return self._tracks
+
+    @property
+    def velocities(self):
+        """(vi, vj) motion of each blob of the current image, in pixels
+        per minute, in the same order as RainAreas.blobs"""
+        if self._velocities is None:
+            tracked = {}
+            for other, blob, overlap in self.tracks:
+                if overlap > 0 and 0.5 <= blob.size / other.size <= 2:
+                    (pi, pj), (ci, cj) = other.centroid, blob.centroid
+                    tracked[id(blob)] = ((ci - pi) / self.minutes, (cj - pj) / self.minutes)
+            self._velocities = [tracked[id(blob)] if id(blob) in tracked else self._field_velocity(blob)
+                                for blob in self.current.blobs]
+        return self._velocities
+
+    def _field_velocity(self, blob):
+        """mean of the motion field over the pixels of blob, in pixels
+        per minute"""
+        field = self.field
+        block = self.block
+        si = sj = 0
+        for j, ia, ib in blob.runs:
+            bj = j // block
+            for bi in range(ia // block, ib // block + 1):
+                n = min(ib, (bi + 1) * block - 1) - max(ia, bi * block) + 1
+                di, dj = field.get((bi, bj), (0, 0))
+                si += di * n
+                sj += dj * n
+        return (si / blob.size / self.minutes, sj / blob.size / self.minutes)
+
+    def _first_arrival(self, pixel, vi, vj, runs, horizon):
+        """earliest (minutes, i, j) at which a pixel of runs, moving by
+        (vi, vj) pixels per minute, passes over pixel, within horizon
+        minutes, or None"""
+        speed2 = vi * vi + vj * vj
+        if speed2 == 0:
+            return None
+        margin = self.tolerance * sqrt(speed2)
+        first = None
+        for j, ia, ib in runs:
+            dj = pixel.j - j
+            # distance to the line followed by pixel i is |cross(i)| / speed
+            cross = pixel.i * vj - dj * vi   # cross(i) = cross - i * vj
+            lo, hi = ia, ib
+            if vj == 0:
+                if abs(cross) > margin:
+                    continue
+            else:
+                a, b = sorted(((cross - margin) / vj, (cross + margin) / vj))
+                lo, hi = max(lo, ceil(a)), min(hi, floor(b))
+            # time at which pixel i is the nearest: ((pixel.i - i) * vi + dj * vj) / speed2, must be positive
+            if vi == 0:
+                if dj * vj <= 0:
+                    continue
+            else:
+                limit = (pixel.i * vi + dj * vj) / vi
+                if vi > 0:
+                    hi = min(hi, ceil(limit) - 1)
+                else:
+                    lo = max(lo, floor(limit) + 1)
+            if lo > hi:
+                continue
+            i = hi if vi > 0 else lo
+            minutes = ((pixel.i - i) * vi + dj * vj) / speed2
+            if minutes <= horizon and (first is None or minutes < first[0]):
+                first = (minutes, i, j)
+        return first
+
+    def arrival(self, location, horizon=120):
+        """When rain is expected at the given Location, returns an
+        Arrival
+
+        parameters:
+          horizon: in minutes, rain expected later than that is ignored
+        """
+        report = Arrival(location, self.current.image_time)
+        pixel = self.current.locate([location])[0]
+        if pixel is None:
+            return report
+        report.pixel = pixel
+        if self.current.intensity_map.get_level_at(pixel.i, pixel.j) != 0:
+            report.eta = 0.0
+            return report
+        first = None
+        for blob, (vi, vj) in zip(self.current.blobs, self.velocities):
+            found = self._first_arrival(pixel, vi, vj, blob.runs, horizon)
+            if found is not None and (first is None or found[0] < first[0]):
+                first = found + (vi, vj)
+        if first is None:
+            return report
+        minutes, i, j, vi, vj = first
+        widths, heights = self.current.pixel_sizes
+        kx, ky = widths[pixel.j], heights[pixel.j]
+        report.eta = minutes
+        report.bearing = pixel.angle_to(Pixel(i, j))
+        report.heading = heading_of(vi, vj)
+        report.speed = sqrt((vi * kx) ** 2 + (vj * ky) ** 2) * 60
+        return report
+
+    def arrivals(self, locations, horizon=120):
+        """same as arrival() for a list of Location"""
+        return [self.arrival(location, horizon) for location in locations]
+
+
+class Arrival:
+    """When rain is expected at a location, see Nowcast.arrival().
+    Values not known, e.g. because the location is outside of the map,
+    or no rain is coming, are None."""
+    def __init__(self, location, image_time):
+        self.location = location
+        self.image_time = image_time
+        self.pixel = None
+        self.eta = None       # minutes after image_time, 0 if it's already raining
+        self.bearing = None   # degrees, clockwise from north, where the rain comes from
+        self.heading = None   # degrees, clockwise from north, where the rain goes to
+        self.speed = None     # km/h
+
+    @property
+    def time(self):
+        """when rain is expected, or None"""
+        return None if self.eta is None else self.image_time + datetime.timedelta(minutes=self.eta)
+
+    def __repr__(self):
+        return f"Arrival({self.location}, eta={self.eta})"
+
+
+def load(when=None, cache_dir=None, engine=None, filter_noise=None, rain_class=RainAreas, **kwargs):
+    """returns a Nowcast from the image of when (the latest by default)
+    and the one 5 minutes before
+
+    parameters:
+      cache_dir, engine: see RainAreas
+      filter_noise: if given, remove_blobs(filter_noise) is called on
+        both images
+      rain_class: RainAreas, or a subclass, e.g. ArchivedRainAreas
+      kwargs: passed to Nowcast
+    """
+    current = rain_class(cache_dir=cache_dir, engine=engine)
+    current.load_image(when)
+    previous = rain_class(cache_dir=cache_dir, engine=engine)
+    previous.load_image(current.image_time - datetime.timedelta(minutes=5))
+    if filter_noise:
+        current.remove_blobs(filter_noise)
+        previous.remove_blobs(filter_noise)
+    return Nowcast(previous, current, **kwargs)
@@ -1,12 +1,13 @@
 from nlannuzel.sgrain.geo import Location
-from nlannuzel.sgrain.graph import Color, Image, Pixel, YELLOW, BLACK, BlobFinder
-import png
-import urllib.request
+from nlannuzel.sgrain import geo
+from nlannuzel.sgrain.graph import Color, DistanceTransform, Image, Pixel, PixelGrid, Posterizer, SummedAreaTable, YELLOW, BlobFinder
+from nlannuzel.sgrain import vector
+from nlannuzel.sgrain import cache
+import urllib.error
 import datetime
+import copy
 import time
 import os
-import shutil
-import fcntl
 
 class RainAreas:
     # Coordinates from the HTML/js code of
@@ -64,10 +65,61 @@ class RainAreas:
             [ 255, 16 , 251 ]
     ]]
 
-    def __init__(self, cache_dir=None):
+    # where images are downloaded from, followed by the image file name
+    base_url = "https://www.weather.gov.sg/files/rainarea/50km/v2/"
+
+    # built once per color_scale, see posterizer
+    _posterizer = None
+
+    # shared by all instances, see locate()
+    _pixels_of_locations = {}
+
+    # shared by all instances, see pixel_sizes
+    _pixel_sizes = {}
+
+    engines = ('python', 'numpy')
+
+    def __init__(self, cache_dir=None, engine=None):
+        """
+
+        parameters:
+          cache_dir: directory that holds downloaded images
+          engine: 'numpy' to process images with NumPy arrays, or
+            'python' to use pure Python. By default, NumPy is used if
+            it is installed.
+        """
+        if engine is not None and engine not in self.engines:
+            raise RuntimeError(f"unknown engine {engine}, must be one of {self.engines}")
+        if engine == 'numpy' and not vector.available():
+            raise RuntimeError("the numpy engine needs NumPy to be installed")
         self._cache_dir = cache_dir
+        self._engine = engine
         self._blobs = None
+        self._blob_finder = None
+        self._follow = None
+        self._labels = None
+        self._rain_index = None
+        self._distance_transform = None
+        self._intensity_table = None
+        self._rain_table = None
         self._intensity_map = None
+        self._window = None   # (ia, ja, ib, jb) if only that part of the image was read
+        self._query = (None, 0)
+        self._original_image = None
+
+    def copy(self):
+        """returns a new RainAreas for the same image, with its own copy
+        of the intensity map, e.g. to remove noise from it while
+        keeping this one as is"""
+        other = copy.copy(self)
+        other._set_intensity_map(self.intensity_map.copy())
+        return other
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = 'numpy' if vector.available() else 'python'
+        return self._engine
 
     def round_to_previous_5_min(self, dt):
         """Round the time down to previous 5 minute, because images on
@@ -80,26 +132,147 @@ class RainAreas:
             minute = 5 * (dt.minute//5),
         )
 
-    def _download_image_to_cache(self):
-        """Download the remote image and save it in a file locally"""
-        url = f"https://www.weather.gov.sg/files/rainarea/50km/v2/{self.filename}"
+    def _download_image_to_cache(self, filepath=None, timeout=None):
+        """Download the remote image and save it in a file locally.
 
-        with open(self.filepath, "ab") as f:
-            fcntl.flock(f, fcntl.LOCK_EX)  # wait until we get the lock...
-            # we got the lock
-            try:
-                if os.fstat(f.fileno()).st_size == 0:  # file is empty, create it
-                    with urllib.request.urlopen(url) as response:
-                        shutil.copyfileobj(response, f)
-            finally:
-                fcntl.flock(f, fcntl.LOCK_UN)
-
-    def _read_image_from_cache(self):
-        """read the local image file, and load it in memory"""
+        Only one process downloads a given image at a time: others
+        wait for it, then use its file. The image is downloaded to a
+        temporary file, and renamed when complete, so readers of the
+        cache never need the lock, and never see a partial image.
+
+        parameters:
+          filepath: where the image is saved in the cache, the one of
+            the current image time by default
+          timeout: seconds to wait for the server, see urlopen()
+        """
+        import urllib.request  # only needed when downloading
+        filepath = filepath if filepath is not None else self.filepath
+        url = f"{self.base_url}{os.path.basename(filepath)}"
+        options = {} if timeout is None else {'timeout': timeout}
+
+        with cache.locked(filepath):
+            if not self._is_cached(filepath):  # not downloaded by another process meanwhile
+                with urllib.request.urlopen(url, **options) as response:
+                    cache.save_stream(response, filepath)
+
+    def _is_cached(self, filepath=None):
+        """True if the image is in the cache. Empty files, left by
+        previous versions when a download failed, are removed."""
+        filepath = filepath if filepath is not None else self.filepath
+        try:
+            if os.path.getsize(filepath) > 0:
+                return True
+        except FileNotFoundError:
+            return False
+        os.unlink(filepath)
+        return False
+
+    def _read_image_from_cache(self, location=None, d=0, write_sidecar=True):
+        """read the local image file, and convert it to the intensity
+        map row by row, as the rows are decoded. The image itself is
+        only loaded when original_image is used.
+
+        If a location is given, only the pixels at distance d or less
+        from this location are converted, and decoding stops after the
+        last row needed.
+
+        If the image was already decoded, by this process or another
+        one, the intensity map saved next to it is used instead, see
+        the cache module. It is saved there after decoding, unless
+        write_sidecar is False."""
+        intensity_map = cache.read_sidecar(self.filepath, self.cache_key)
+        if intensity_map is not None:
+            self._set_intensity_map(intensity_map)
+            return
+        import png  # only needed when images are decoded
         with open(self.filepath, "rb") as f:
+            image_stat = os.fstat(f.fileno())  # of the image decoded, even if replaced meanwhile
             reader = png.Reader(f)
             width, height, data, info = reader.read()
-            self.original_image = Image.from_rgb_rows(rows=data, has_alpha=True)
+            if location is not None:
+                self._read_window_from_rows(data, width, height, location, d)
+                return
+            if self.engine == 'numpy':
+                levels = vector.posterize_rows(data, width, height, self.posterizer)
+                data = bytearray(levels.tobytes())
+            else:
+                posterize_row = self.posterizer.posterize_row
+                data = bytearray().join(posterize_row(row, channels=4) for row in data)
+            intensity_map = Image(width=width, height=height, data=data)
+        if write_sidecar:
+            cache.write_sidecar(self.filepath, self.cache_key, intensity_map, image_stat)
+        self._set_intensity_map(intensity_map)
+
+    @property
+    def cache_key(self):
+        """identifies the color scale and georeference used to decode
+        images, see the cache module"""
+        return cache.key_of(self.color_scale, self.top_left, self.bottom_right)
+
+    def _set_intensity_map(self, intensity_map, window=None):
+        """use a new intensity map, forget everything computed from
+        the previous one"""
+        self._intensity_map = intensity_map
+        self._window = window
+        self._original_image = None
+        self._blobs = None
+        self._blob_finder = None
+        self._follow = None
+        self._labels = None
+        self._rain_index = None
+        self._distance_transform = None
+        self._intensity_table = None
+        self._rain_table = None
+
+    def _read_window_from_rows(self, rows, width, height, location, d):
+        """convert only the rows and columns of the box around
+        location to intensities, and stop consuming rows after the
+        last row of the box"""
+        intensity_map = Image(width=width, height=height)
+        pixel = self._location_to_pixel(location, width, height)
+        ia = max(0, pixel.i - d)
+        ja = max(0, pixel.j - d)
+        ib = min(width - 1, pixel.i + d)
+        jb = min(height - 1, pixel.j + d)
+        posterize_row = self.posterizer.posterize_row
+        for j, row in enumerate(rows):
+            if j < ja:
+                continue
+            intensity_map.set_row(j, posterize_row(row[4*ia:4*(ib+1)], channels=4), ia)
+            if j == jb:
+                break
+        self._set_intensity_map(intensity_map, window=(ia, ja, ib, jb))
+
+    def _read_original_image_from_cache(self):
+        """read the local image file in memory. Pixels that have been
+        removed from the intensity map since it was read (see
+        remove_blobs) are also removed from the image."""
+        import png
+        with open(self.filepath, "rb") as f:
+            reader = png.Reader(f)
+            width, height, data, info = reader.read()
+            if self.engine == 'numpy':
+                rgba = vector.read_rgba(data, width, height)
+                image = Image(width=width, height=height, channels=3, data=bytearray(rgba[:, :, :3].tobytes()))
+                removed = (vector.posterize(rgba, self.posterizer) != 0) & (vector.as_array(self.intensity_map) == 0)
+                vector.as_array(image)[removed] = 0
+                return image
+            image = Image.from_rgb_rows(rows=data, has_alpha=True)
+        posterize_row = self.posterizer.posterize_row
+        black = bytes(3)
+        for j, row in enumerate(image.iter_rows()):
+            intensities = self.intensity_map.get_row(j)
+            for i, level in enumerate(posterize_row(row)):
+                if level != 0 and intensities[i] == 0:
+                    image.set_row(j, black, i)
+        return image
+
+    @property
+    def original_image(self):
+        """the radar image, as downloaded"""
+        if self._original_image is None:
+            self._original_image = self._read_original_image_from_cache()
+        return self._original_image
 
     @property
     def cache_dir(self):
@@ -110,27 +283,94 @@ class RainAreas:
                 self._cache_dir = '/tmp'
         return self._cache_dir
 
+    @property
+    def posterizer(self):
+        """Posterizer for color_scale. It is shared by all instances,
+        so colors already seen in previous images are not posterized
+        again"""
+        cls = type(self)
+        if cls._posterizer is None or cls._posterizer.palette is not cls.color_scale:
+            cls._posterizer = Posterizer(cls.color_scale)
+        return cls._posterizer
+
     @property
     def intensity_map(self):
-        def to_bw(pixel):
-            intensity = pixel.col.posterize(self.color_scale)
-            return Color.grey(intensity)
         if self._intensity_map is None:
-            self._intensity_map = self.original_image.transform(to_bw)
+            raise RuntimeError("no image loaded, load_image() must be called first")
+        if self._window is not None:
+            self._read_image_from_cache()  # only part of the image was read, read all of it
         return self._intensity_map
 
+    def _intensity_map_around(self, pixel, d):
+        """returns the intensity map if it is fully loaded, or if the
+        part loaded contains all pixels at distance d of pixel"""
+        if self._window is not None:
+            ia, ja, ib, jb = self._window
+            width = self._intensity_map.width
+            height = self._intensity_map.height
+            if ia <= max(0, pixel.i - d) and ja <= max(0, pixel.j - d) \
+               and min(width - 1, pixel.i + d) <= ib and min(height - 1, pixel.j + d) <= jb:
+                return self._intensity_map
+        return self.intensity_map
+
+    def _set_image_time(self, image_time):
+        """use the image of image_time (rounded to 5 minutes), and its
+        file name in the cache"""
+        self.image_time = image_time
+        self.filename = self.filename_of(image_time)
+        self.filepath = f"{self.cache_dir}/{self.filename}"
+
+    def filename_of(self, image_time):
+        """name of the file of the image of image_time, on the server
+        and in the cache"""
+        return f"dpsri_70km_{image_time.year}{image_time.month:02d}{image_time.day:02d}{image_time.hour:02d}{image_time.minute:02d}0000dBR.dpsri.png"
+
     def _try_to_load_image(self):
         """Download the image if needed, then load it in memory"""
-        self.filename = f"dpsri_70km_{self.image_time.year}{self.image_time.month:02d}{self.image_time.day:02d}{self.image_time.hour:02d}{self.image_time.minute:02d}0000dBR.dpsri.png"
-        self.filepath = f"{self.cache_dir}/{self.filename}"
+        self._set_image_time(self.image_time)
         try:
-            self._read_image_from_cache()
-        except (FileNotFoundError, EOFError):
+            self._read_image_from_cache(*self._query)
+        except FileNotFoundError:
+            self._download_image_to_cache()
+            self._read_image_from_cache(*self._query)
+        except Exception as e:
+            if not cache.is_broken_image(e):
+                raise
+            os.unlink(self.filepath)  # a broken file, e.g. written by a previous version
             self._download_image_to_cache()
-            self._read_image_from_cache()
+            self._read_image_from_cache(*self._query)
+
+    def use_image(self, image_time, intensity_map):
+        """use intensity_map as the image of image_time, instead of
+        loading it, e.g. a map kept in memory. It is not copied, and
+        is changed by remove_blobs()."""
+        self._query = (None, 0)
+        self._set_image_time(image_time)
+        self._set_intensity_map(intensity_map)
 
-    def load_image(self, when=None):
-        """get the latest available image, try to look back in 5 minutes steps if needed"""
+    def load_cached_image(self, when, write_sidecar=True):
+        """load the image of time when from the cache, without
+        downloading it, nor looking back for an older one. Raises
+        FileNotFoundError if it is not in the cache, or the error of
+        the decoder if it is broken, see cache.is_broken_image().
+
+        parameters:
+          write_sidecar: False to not save the decoded intensity map
+            next to the image, e.g. if it is only decoded once
+        """
+        self._query = (None, 0)
+        self._set_image_time(self.round_to_previous_5_min(when))
+        self._read_image_from_cache(write_sidecar=write_sidecar)
+
+    def load_image(self, when=None, location=None, d=0):
+        """get the latest available image, try to look back in 5 minutes steps if needed
+
+        If a location is given, only the part of the image needed by
+        intensity_at(location, d) is decoded. The rest of the image is
+        decoded later, only if it is needed. Not worth it if the whole
+        image is needed anyway, e.g. to remove noise with
+        remove_blobs()."""
+        self._query = (location, d)
         self.image_time  = self.round_to_previous_5_min( when if when is not None else datetime.datetime.fromtimestamp( time.time()) )
         max_tries = 3
         while max_tries > 0:
@@ -165,20 +405,52 @@ class RainAreas:
     def location_to_pixel(self, location):
         """Take a Location(latitude,logintude) and return the
         corresponding Pixel location in the image map"""
+        return self._location_to_pixel(location, self._map_size.width, self._map_size.height)
+
+    def locate(self, locations):
+        """Same as location_to_pixel() for a list of Location, but
+        returns None for locations outside of the map. Results are
+        kept, and reused for images of the same size, e.g. when
+        querying the same locations every 5 minutes."""
+        width = self._map_size.width
+        height = self._map_size.height
+        georeference = (self.top_left.lat, self.top_left.lon, self.bottom_right.lat, self.bottom_right.lon, width, height)
+        pixels = []
+        for location in locations:
+            key = (location.lat, location.lon) + georeference
+            if key not in self._pixels_of_locations:
+                if len(self._pixels_of_locations) >= 10000:
+                    self._pixels_of_locations.clear()
+                if self.location_is_inside_map(location):
+                    self._pixels_of_locations[key] = self._location_to_pixel(location, width, height)
+                else:
+                    self._pixels_of_locations[key] = None
+            pixels.append(self._pixels_of_locations[key])
+        return pixels
+
+    def _location_to_pixel(self, location, width, height):
         if not self.location_is_inside_map(location):
             raise Exception('location is outside of covered area')
         return Pixel(
-            i = round(self._interpolate(self.top_left.lon, 0, self.bottom_right.lon, self.intensity_map.width - 1, location.lon)),
-            j = round(self._interpolate(self.top_left.lat, 0, self.bottom_right.lat, self.intensity_map.height - 1, location.lat)),
+            i = round(self._interpolate(self.top_left.lon, 0, self.bottom_right.lon, width - 1, location.lon)),
+            j = round(self._interpolate(self.top_left.lat, 0, self.bottom_right.lat, height - 1, location.lat)),
         )
 
+    @property
+    def _map_size(self):
+        """the intensity map, possibly partially loaded, only to be
+        used for its width and height"""
+        if self._intensity_map is None:
+            raise RuntimeError("no image loaded, load_image() must be called first")
+        return self._intensity_map
+
     def pixel_to_location(self, pixel):
         """Take a Pixel and return the corresponding
         Location(latitude, longitude) by using a linear
         interpolation"""
         return Location(
-            lon = self._interpolate(0, self.top_left.lon, self.intensity_map.width - 1, self.bottom_right.lon, pixel.i),
-            lat = self._interpolate(0, self.top_left.lat, self.intensity_map.height - 1, self.bottom_right.lat, pixel.j),
+            lon = self._interpolate(0, self.top_left.lon, self._map_size.width - 1, self.bottom_right.lon, pixel.i),
+            lat = self._interpolate(0, self.top_left.lat, self._map_size.height - 1, self.bottom_right.lat, pixel.j),
         )
 
     def intensity_at(self, location, d=0):
@@ -189,30 +461,88 @@ class RainAreas:
         consider neighbours pixels at distance d onthe left, d on the
         right, d above, and d below."""
         pixel = self.location_to_pixel(location)
+        intensity_map = self._intensity_map_around(pixel, d)
         if d == 0:
-            return self.intensity_map.get_pixel(pixel).col.g
+            return intensity_map.get_level_at(pixel.i, pixel.j)
 
         # averaging around pixel's neighbours
-        count = 0
-        intensity = 0
-        box = self.intensity_map.box_around(pixel, d)
-        for pn in self.intensity_map.iter_rectangle_area(box):
-            count += 1
-            intensity += pn.col.g
-        intensity /= count
-        return intensity
+        box = intensity_map.box_around(pixel, d)
+        return self._sum_in(intensity_map, box) / box.area()
+
+    def intensity_sum_at(self, location, d=0):
+        """Returns the sum of rain intensities of pixels at distance d
+        or less from the given Location(latitude,logitude), see
+        intensity_at()"""
+        pixel = self.location_to_pixel(location)
+        intensity_map = self._intensity_map_around(pixel, d)
+        if d == 0:
+            return intensity_map.get_level_at(pixel.i, pixel.j)
+        return self._sum_in(intensity_map, intensity_map.box_around(pixel, d))
+
+    def intensity_max_at(self, location, d=0):
+        """Returns the highest rain intensity of pixels at distance d
+        or less from the given Location(latitude,logitude), see
+        intensity_at()"""
+        pixel = self.location_to_pixel(location)
+        intensity_map = self._intensity_map_around(pixel, d)
+        if d == 0:
+            return intensity_map.get_level_at(pixel.i, pixel.j)
+        return intensity_map.max_level_in(intensity_map.box_around(pixel, d))
+
+    def rain_fraction_at(self, location, d=0):
+        """Returns the fraction (0 to 1) of pixels at distance d or
+        less from the given Location(latitude,logitude) where it's
+        raining, see intensity_at()"""
+        pixel = self.location_to_pixel(location)
+        intensity_map = self._intensity_map_around(pixel, d)
+        if d == 0:
+            return 1.0 if intensity_map.get_level_at(pixel.i, pixel.j) != 0 else 0.0
+        box = intensity_map.box_around(pixel, d)
+        return self._sum_in(intensity_map, box, rain=True) / box.area()
+
+    def _sum_in(self, intensity_map, box, rain=False):
+        """sum of intensities in the box, or number of pixels where
+        it's raining if rain is True"""
+        if self._window is not None:
+            # only part of the image is loaded, the box is small
+            total = 0
+            for j in box.iter_height():
+                row = intensity_map.get_row(j, box.tl.i, box.br.i + 1)
+                total += len(row) - row.count(0) if rain else sum(row)
+            return total
+        if rain:
+            return self.rain_table.sum(box)
+        return self.intensity_table.sum(box)
+
+    @property
+    def intensity_table(self):
+        """summed area table of the intensity map, built once per
+        image"""
+        if self._intensity_table is None or self._intensity_table.version != self.intensity_map.version:
+            self._intensity_table = SummedAreaTable(self.intensity_map)
+        return self._intensity_table
+
+    @property
+    def rain_table(self):
+        """summed area table counting pixels where it's raining, built
+        once per image"""
+        if self._rain_table is None or self._rain_table.version != self.intensity_map.version:
+            self._rain_table = SummedAreaTable.of_foreground(self.intensity_map)
+        return self._rain_table
 
     def save_intensity_map(self, file_path, location=None, color=YELLOW, d=0):
         """save the intensity map to a PNG file, optionally, draw the
         location as a dot or square. The intensity is scaled from
         0..31 to 0..255"""
+        import png
         pixel = self.location_to_pixel(location)
 
-        def brighten(pixel):
-            intensity = self.intensity_map.get_pixel(pixel).col.g
-            grey_level = round(self._interpolate(0, 0, 31, 255, intensity))
-            return Color.grey(grey_level)
-        output_image = self.intensity_map.transform(brighten)
+        brighten = [min(255, round(self._interpolate(0, 0, 31, 255, intensity))) for intensity in range(0, 256)]
+        if self.engine == 'numpy':
+            levels = vector.translate(vector.as_array(self.intensity_map), brighten)
+            output_image = Image(width=self.intensity_map.width, height=self.intensity_map.height, data=bytearray(levels.tobytes()))
+        else:
+            output_image = self.intensity_map.translate(brighten)
         if (d == 0):
             output_image.set_color_at(pixel.i, pixel.j, color)  # draw a dot
         else:
@@ -220,16 +550,70 @@ class RainAreas:
             output_image.draw_box(box, color)
         png.from_array(output_image.to_rgb_rows(), mode='RGB').save(file_path)
 
+    def save_distance_map(self, file_path, threshold=0, max_distance=None, location=None, color=YELLOW):
+        """save the distance to rain to a PNG file, see
+        distance_transform(). Pixels where it's raining are white, and
+        get darker with the distance, up to black at max_distance
+        kilometers (by default, the pixel furthest from rain). If
+        max_distance is 0, e.g. when it's raining everywhere, only
+        pixels where it's raining are white. Optionally, draw the
+        location as a dot."""
+        import png
+        transform = self.distance_transform(threshold)
+        if max_distance is None:
+            max_distance = transform.max_distance()
+        width = self.intensity_map.width
+        output_image = Image(width=width, height=self.intensity_map.height)
+        for j in range(0, output_image.height):
+            distances = map(transform.distance, (Pixel(i, j) for i in range(0, width)))
+            if max_distance <= 0:
+                row = bytes(255 if d == 0 else 0 for d in distances)
+            else:
+                row = bytes(0 if d >= max_distance else round(255 * (1 - d / max_distance)) for d in distances)
+            output_image.set_row(j, row)
+        if location is not None:
+            pixel = self.location_to_pixel(location)
+            output_image.set_color_at(pixel.i, pixel.j, color)  # draw a dot
+        png.from_array(output_image.to_rgb_rows(), mode='RGB').save(file_path)
+
     @property
     def blobs(self):
         if self._blobs is None:
-            self._blobs = BlobFinder(self.intensity_map).blobs
+            if self.engine == 'numpy':
+                self._labels = vector.label(vector.as_array(self.intensity_map) != 0)
+                self._blobs = vector.blobs_from_labels(self.intensity_map, self._labels)
+            else:
+                previous = None
+                if self._follow is not None and self._follow.engine == 'python':
+                    self._follow.blobs   # found first, if not done yet
+                    previous = self._follow._blob_finder
+                self._follow = None
+                self._blob_finder = BlobFinder(self.intensity_map, method='runs', previous=previous)
+                self._blobs = self._blob_finder.blobs
         return self._blobs
 
+    def follow(self, previous):
+        """Find blobs of this image from those of previous, a RainAreas
+        with the image before this one, see BlobFinder. Only the parts
+        of the image that changed are labelled again, and blobs keep
+        their label from one image to the next. To be called after the
+        image is loaded, and before blobs are used. The image of
+        previous must not change until then. Only done with the python
+        engine, the numpy engine labels whole images faster."""
+        if previous._follow is not None and previous.engine == 'python':
+            # find the blobs of previous from its own previous image
+            # first, so that labels carry on without keeping older
+            # images in a chain
+            previous.blobs
+        previous._follow = None
+        self._follow = previous
+
     def grep_blobs(self, f):
         """returns all blobs satisfying f(blob)==True, where f() is a
-        function taking a list of Pixel as argument and returing True
-        or False"""
+        function taking a Blob as argument and returing True or
+        False. The size (len(blob)), bounding box, centroid and
+        intensities of a Blob are known without going through its
+        pixels."""
         for blob in self.blobs:
             if f(blob):
                 yield blob
@@ -237,26 +621,153 @@ class RainAreas:
     def remove_blobs(self, max_size=1):
         """removes all blobs with a size equal or less than max_size
         and less. Used to remove noise on the radar image"""
+        if self.engine == 'numpy':
+            blobs = self.blobs
+            images = [vector.as_array(self.intensity_map)]
+            if self._original_image is not None:
+                images.append(vector.as_array(self._original_image))
+            self._labels = vector.remove_labels(self._labels, max_size, *images)
+            self.intensity_map.modified()
+            self._blobs = [b for b in blobs if len(b) > max_size]
+            self._rain_index = None
+            return
         leavers = [b for b in self.grep_blobs(lambda b: len(b) <= max_size)]
         for noise in leavers:
-            for pixel in noise:
-                self.original_image.set_color_at(pixel.i, pixel.j, BLACK)
-                self.intensity_map.set_color_at(pixel.i, pixel.j, BLACK)
+            for j, ia, ib in noise.runs:
+                if self._original_image is not None:
+                    self._original_image.set_row(j, bytes(3 * (ib - ia + 1)), ia)
+                self.intensity_map.set_row(j, bytes(ib - ia + 1), ia)
             self.blobs.remove(noise)
+        self._rain_index = None
+
+    @property
+    def rain_index(self):
+        """spatial index of all pixels of all blobs, built once per
+        image"""
+        if self._rain_index is None:
+            self._rain_index = PixelGrid.from_blobs(self.blobs)
+        return self._rain_index
+
+    @property
+    def pixel_sizes(self):
+        """(widths, heights): width and height in kilometers of the
+        pixels of each row. Longitudes and latitudes are linear along
+        the axes of the map, so all pixels of a row have the same size,
+        and only the width changes from row to row (with the cosine of
+        the latitude). Computed once for all images of the same size."""
+        width = self._map_size.width
+        height = self._map_size.height
+        tl = self.top_left
+        br = self.bottom_right
+        key = (tl.lat, tl.lon, br.lat, br.lon, width, height)
+        if key not in self._pixel_sizes:
+            lats = [self._interpolate(0, tl.lat, height - 1, br.lat, j) for j in range(0, height)]
+            d_lon = (br.lon - tl.lon) / (width - 1)
+            d_lat = (tl.lat - br.lat) / (height - 1)
+            widths = geo.haversine(lats, tl.lon, lats, tl.lon + d_lon)
+            heights = geo.haversine([lat + d_lat / 2 for lat in lats], tl.lon, [lat - d_lat / 2 for lat in lats], tl.lon)
+            self._pixel_sizes[key] = ([float(w) for w in widths], [float(h) for h in heights])
+        return self._pixel_sizes[key]
+
+    def _scale_at(self, pixel):
+        """scale of the rain index to rank pixels in kilometers around
+        pixel, see PixelGrid"""
+        widths, heights = self.pixel_sizes
+        return (widths[pixel.j], heights[pixel.j])
+
+    def distance_transform(self, threshold=0):
+        """distance in kilometers from each pixel to the nearest pixel
+        where the intensity is more than threshold, see
+        DistanceTransform. Built once per image and threshold, and
+        again after remove_blobs(). Distances are measured like
+        nearest_rain_locations() and rain_locations_within() do, with
+        the pixel sizes of the row of each pixel."""
+        transform = self._distance_transform
+        if transform is None or transform.version != self.intensity_map.version or transform.threshold != threshold:
+            transform = DistanceTransform(self.intensity_map, threshold, self.pixel_sizes)
+            self._distance_transform = transform
+        return transform
+
+    def rain_distance_at(self, location, threshold=0):
+        """returns the distance in kilometers from this location to the
+        nearest pixel where the intensity is more than threshold, 0 if
+        it's raining there, or None if it's not raining anywhere"""
+        distance = self.distance_transform(threshold).distance(self.location_to_pixel(location))
+        return None if distance == float('inf') else distance
 
-    def nearest_rain_location(self, location):
+    def nearest_rain_location(self, location, threshold=0):
         """returns the rain spot location that is the nearest to this
-        location"""
-        loc_pixel = self.location_to_pixel(location)
-        min_distance = None
-        rain_pixel = None
-        for b in self.blobs:
-            for p in b:
-                d = loc_pixel.distance_to(p)
-                if min_distance is None or d < min_distance:
-                    min_distance = d
-                    rain_pixel = p
-        if min_distance is None:
+        location, only counting pixels where the intensity is more
+        than threshold"""
+        rain_pixel = self.distance_transform(threshold).nearest(self.location_to_pixel(location))
+        if rain_pixel is None:
             return None
-        rain_location = self.pixel_to_location(rain_pixel)
-        return rain_location
+        return self.pixel_to_location(rain_pixel)
+
+    def nearest_rain_locations(self, location, k):
+        """returns the locations of the k rain spots that are the
+        nearest to this location, nearest first"""
+        pixel = self.location_to_pixel(location)
+        return [self.pixel_to_location(p) for p in self.rain_index.k_nearest(pixel, k, self._scale_at(pixel))]
+
+    def rain_locations_within(self, location, radius):
+        """returns the locations of all rain spots at radius
+        kilometers or less from this location"""
+        pixel = self.location_to_pixel(location)
+        return [self.pixel_to_location(p) for p in self.rain_index.within(pixel, radius, self._scale_at(pixel))]
+
+    def query(self, locations, d=0, filter_noise=None, nearest=False, threshold=0):
+        """Tells how it's raining at each of the given Location, using
+        the currently loaded image. Returns a list of RainReport, in
+        the same order as locations.
+
+        parameters:
+          d: also report the average intensity of pixels at distance d
+            or less, see intensity_at()
+          filter_noise: if given, remove_blobs(filter_noise) is called
+            first. It changes the loaded image.
+          nearest: also find the nearest rain spot, and its distance
+          threshold: the nearest rain spot is the nearest pixel with
+            an intensity of more than threshold
+        """
+        if filter_noise:
+            self.remove_blobs(filter_noise)
+        reports = []
+        for location, pixel in zip(locations, self.locate(locations)):
+            report = RainReport(location, self.image_time)
+            reports.append(report)
+            if pixel is None:
+                continue
+            report.pixel = pixel
+            intensity_map = self._intensity_map_around(pixel, d)
+            report.intensity = intensity_map.get_level_at(pixel.i, pixel.j)
+            if d > 0:
+                box = intensity_map.box_around(pixel, d)
+                report.mean_intensity = self._sum_in(intensity_map, box) / box.area()
+            if nearest:
+                rain_pixel = self.distance_transform(threshold).nearest(pixel)
+                if rain_pixel is not None:
+                    report.nearest_rain = self.pixel_to_location(rain_pixel)
+                    report.nearest_rain_distance = location.distance_to(report.nearest_rain)
+        return reports
+
+
+class RainReport:
+    """How it's raining at a location, see RainAreas.query(). Values
+    not requested, or not known because the location is outside of
+    the map, are None."""
+    def __init__(self, location, image_time):
+        self.location = location
+        self.image_time = image_time
+        self.pixel = None
+        self.intensity = None
+        self.mean_intensity = None
+        self.nearest_rain = None
+        self.nearest_rain_distance = None
+
+    @property
+    def inside_map(self):
+        return self.pixel is not None
+
+    def __repr__(self):
+        return f"RainReport({self.location}, intensity={self.intensity})"
@@ -0,0 +1,183 @@
+"""Vectorized versions of the per-image processing done in rain and
+graph, used when NumPy is installed. Arrays returned by as_array()
+share their memory with the Image they come from, so both views of the
+image stay consistent.
+
+NumPy is only imported by available(), which must be called, and
+return True, before using the other functions. This keeps NumPy out of
+programs that never process an image, e.g. when the answer is already
+in the cache."""
+from nlannuzel.sgrain.graph import Blob
+
+np = None
+_imported = False
+
+
+def available():
+    """returns True if NumPy is installed"""
+    global np, _imported
+    if not _imported:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:  # NumPy is optional
+            pass
+        _imported = True
+    return np is not None
+
+
+def read_rgba(rows, width, height):
+    """read PNG rows of (r, g, b, a, r, g, b, a...) levels into a
+    (height, width, 4) array"""
+    rgba = np.empty((height, width * 4), dtype=np.uint8)
+    for j, row in enumerate(rows):
+        rgba[j] = np.frombuffer(row, dtype=np.uint8)
+    return rgba.reshape((height, width, 4))
+
+
+def as_array(image):
+    """returns a (height, width) array for a grey image, or a
+    (height, width, 3) array for a r, g, b image, sharing the memory of
+    the image"""
+    if image.typecode != 'B':
+        raise RuntimeError("only 8 bits images can be seen as arrays")
+    a = np.frombuffer(image.data, dtype=np.uint8)
+    if image.channels == 1:
+        return a.reshape((image.height, image.width))
+    return a.reshape((image.height, image.width, image.channels))
+
+
+def posterize(rgb, posterizer):
+    """posterize a (height, width, 3 or 4) array of r, g, b levels,
+    returns a (height, width) array of palette positions. Each distinct
+    color is looked up once in the posterizer, so the result is the
+    same as the one of Posterizer.posterize_row()"""
+    rgb = rgb.astype(np.uint32)
+    packed = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+    keys, inverse = np.unique(packed, return_inverse=True)
+    lut = np.fromiter((posterizer.index_of_packed(int(key)) for key in keys), dtype=np.uint8, count=len(keys))
+    return lut[inverse].reshape(packed.shape)
+
+
+def posterize_rows(rows, width, height, posterizer, block=16):
+    """posterize PNG rows of (r, g, b, a, r, g, b, a...) levels as
+    they are read, block rows at a time, returns a (height, width)
+    array of palette positions"""
+    levels = np.empty((height, width), dtype=np.uint8)
+    rgba = np.empty((block, width * 4), dtype=np.uint8)
+    j = 0
+    for row in rows:
+        rgba[j % block] = np.frombuffer(row, dtype=np.uint8)
+        j += 1
+        if j % block == 0 or j == height:
+            n = (j - 1) % block + 1
+            levels[j - n:j] = posterize(rgba[:n].reshape((n, width, 4)), posterizer)
+    return levels
+
+
+def translate(levels, table):
+    """map each level of a uint8 array through table (a sequence of
+    256 levels)"""
+    return np.asarray(table, dtype=np.uint8)[levels]
+
+
+def label(mask):
+    """label the 4-connected components of a boolean (height, width)
+    array. Returns a (height, width) array where background is 0, and
+    components are numbered from 1 in the order their first pixel is
+    found when scanning rows from top to bottom, like BlobFinder
+    does."""
+    height, width = mask.shape
+    fg = mask.ravel()
+    size = fg.size
+    # each pixel points to the smallest flat index known to be in the
+    # same component; background pixels point past the end
+    parent = np.where(fg, np.arange(size), size)
+    indices = np.flatnonzero(fg)
+    if len(indices) == 0:
+        return np.zeros((height, width), dtype=np.int64)
+    grid = parent.reshape((height, width))
+    while True:
+        smallest = grid.copy()
+        np.minimum(smallest[1:, :], grid[:-1, :], out=smallest[1:, :])   # up
+        np.minimum(smallest[:-1, :], grid[1:, :], out=smallest[:-1, :])  # down
+        np.minimum(smallest[:, 1:], grid[:, :-1], out=smallest[:, 1:])   # left
+        np.minimum(smallest[:, :-1], grid[:, 1:], out=smallest[:, :-1])  # right
+        smallest = smallest.ravel()
+        candidates = smallest[indices]
+        changed = candidates < parent[indices]
+        if not changed.any():
+            break
+        # hook the root of each pixel to the smallest neighbour found
+        np.minimum.at(parent, parent[indices], candidates)
+        np.minimum.at(parent, indices, candidates)
+        # pointer jumping, until each pixel points to its root
+        while True:
+            jumped = parent[parent[indices]]
+            if np.array_equal(jumped, parent[indices]):
+                break
+            parent[indices] = jumped
+    roots = np.unique(parent[indices])
+    labels = np.zeros(size, dtype=np.int64)
+    labels[indices] = np.searchsorted(roots, parent[indices]) + 1
+    return labels.reshape((height, width))
+
+
+def blobs_from_labels(image, labels):
+    """returns the list of Blob found in labels, ordered like
+    BlobFinder.blobs"""
+    fg = labels != 0
+    starts = fg.copy()
+    starts[:, 1:] &= labels[:, 1:] != labels[:, :-1]
+    ends = fg.copy()
+    ends[:, :-1] &= labels[:, :-1] != labels[:, 1:]
+    js, ias = np.nonzero(starts)   # both in row by row order, so each
+    _, ibs = np.nonzero(ends)      # start matches the next end
+    blobs = {}
+    for label, j, ia, ib in zip(labels[js, ias].tolist(), js.tolist(), ias.tolist(), ibs.tolist()):
+        if label not in blobs:
+            blobs[label] = Blob(label, image)
+        blobs[label].add_run(j, ia, ib)
+    return list(blobs.values())
+
+
+def remove_labels(labels, max_size, *images):
+    """set to 0 all pixels of the given arrays (e.g. intensity and
+    r, g, b levels) that belong to a component of max_size pixels or
+    less. Returns labels with those components removed."""
+    sizes = np.bincount(labels.ravel())
+    small = sizes <= max_size
+    small[0] = False
+    noise = small[labels]
+    for image in images:
+        image[noise] = 0
+    labels = labels.copy()
+    labels[noise] = 0
+    return labels
+
+
+def block_motion(previous, current, block, search, shifts):
+    """same as nowcast.block_motion(), on (height, width) arrays of
+    levels. Each shift is tried on all blocks at once."""
+    height, width = current.shape
+    nbj = -(-height // block)
+    nbi = -(-width // block)
+    cur = np.zeros((nbj * block, nbi * block), dtype=np.int16)
+    cur[:height, :width] = current
+    valid = np.zeros(cur.shape, dtype=np.int16)   # excludes the padding of partial blocks
+    valid[:height, :width] = 1
+    prev = np.zeros((nbj * block + 2 * search, nbi * block + 2 * search), dtype=np.int16)
+    prev[search:search + height, search:search + width] = previous
+    rain = (cur != 0).reshape((nbj, block, nbi, block)).any(axis=(1, 3))
+    best = np.full((nbj, nbi), np.iinfo(np.int64).max, dtype=np.int64)
+    best_di = np.zeros((nbj, nbi), dtype=np.int64)
+    best_dj = np.zeros((nbj, nbi), dtype=np.int64)
+    for di, dj in shifts:
+        window = prev[search - dj:search - dj + cur.shape[0], search - di:search - di + cur.shape[1]]
+        sad = (np.abs(cur - window) * valid).reshape((nbj, block, nbi, block)).sum(axis=(1, 3), dtype=np.int64)
+        better = sad < best
+        best[better] = sad[better]
+        best_di[better] = di
+        best_dj[better] = dj
+    bjs, bis = np.nonzero(rain)
+    return {(bi, bj): (di, dj) for bi, bj, di, dj in zip(bis.tolist(), bjs.tolist(), best_di[bjs, bis].tolist(), best_dj[bjs, bis].tolist())}
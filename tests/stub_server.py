@@ -0,0 +1,105 @@
+"""A local HTTP server that serves radar images like
+www.weather.gov.sg does, for tests that need to download images
+without network access.
+
+Images are served under /files/rainarea/50km/v2/<file name>. Like the
+real server, it returns 403 for images that are not published yet.
+Each image has a publish time, compared with the clock of the server,
+which tests can control."""
+import datetime
+import email.utils
+import hashlib
+import http.server
+import threading
+
+PATH = '/files/rainarea/50km/v2/'
+
+
+class StubServer:
+    def __init__(self, now=None):
+        """
+
+        parameters:
+          now: function that returns the current time of the server,
+            datetime.datetime.now by default
+        """
+        self.now = now if now is not None else datetime.datetime.now
+        self.images = {}   # file name -> (publish time, content)
+        self.requests = []   # (method, file name, status), in order
+        self.headers = []   # headers of each request, in the same order
+        self.clients = set()   # (host, port) of clients, one per connection
+        self.keep_alive = True
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.do_GET(body=False)
+
+            def do_GET(self, body=True):
+                status, headers, content = stub._respond(self.path, self.headers)
+                stub.requests.append((self.command, self.path[len(PATH):], status))
+                stub.headers.append(dict(self.headers))
+                stub.clients.add(self.client_address)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                if not stub.keep_alive:
+                    self.send_header('Connection', 'close')
+                    self.close_connection = True
+                self.end_headers()
+                if body:
+                    self.wfile.write(content)
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}{PATH}"
+
+    def publish(self, filename, content, when=None):
+        """serve content as filename from when (from now by default)"""
+        self.images[filename] = (when if when is not None else self.now(), content)
+
+    def _respond(self, path, request_headers):
+        if not path.startswith(PATH):
+            return 404, {}, b''
+        filename = path[len(PATH):]
+        if filename not in self.images or self.images[filename][0] > self.now():
+            return 403, {}, b'Forbidden'
+        publish_time, content = self.images[filename]
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        last_modified = email.utils.format_datetime(publish_time.replace(tzinfo=datetime.timezone.utc), usegmt=True)
+        headers = {'ETag': etag, 'Last-Modified': last_modified}
+        if request_headers.get('If-None-Match') == etag:
+            return 304, headers, b''
+        since = request_headers.get('If-Modified-Since')
+        if since is not None and 'If-None-Match' not in request_headers:
+            if email.utils.parsedate_to_datetime(since).replace(tzinfo=None) >= publish_time.replace(microsecond=0):
+                return 304, headers, b''
+        headers['Content-Type'] = 'image/png'
+        return 200, headers, content
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,89 @@
+import unittest
+import asyncio
+import datetime
+import os
+import tempfile
+from unittest.mock import patch
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain.aio import AsyncRainAreas
+from nlannuzel.sgrain.geo import Location
+from .test_rain import mock_load_image
+from .stub_server import StubServer
+
+
+class TestAio(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rain = RainAreas(cache_dir=self.tmp.name)
+        mock_load_image(self.rain, 'big_blob')
+        with open(self.rain.filepath, 'rb') as f:
+            self.content = f.read()
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        os.mkdir(self.cache_dir)
+        self.when = self.rain.image_time
+        self.server.publish(self.rain.filename, self.content, self.when)
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def new(self):
+        rain = AsyncRainAreas(cache_dir=self.cache_dir)
+        rain.base_url = self.server.base_url
+        return rain
+
+    def test_load_image(self):
+        async def main():
+            rain = self.new()
+            await rain.async_load_image(self.when + datetime.timedelta(minutes=12))  # 00:10 and 00:05 are 403
+            self.assertEqual(rain.image_time, self.when)
+            self.assertEqual(rain.intensity_map.data, self.rain.intensity_map.data)
+            location = Location(1.35, 103.8)
+            self.assertEqual(await rain.async_intensity_at(location, 2), self.rain.intensity_at(location, 2))
+            await rain.async_remove_blobs(20)
+            self.rain.remove_blobs(20)
+            reports = await rain.async_query([location], d=1, nearest=True)
+            self.assertEqual(reports[0].nearest_rain_distance, self.rain.query([location], nearest=True)[0].nearest_rain_distance)
+            nearest = await rain.async_nearest_rain_location(location)
+            self.assertEqual((nearest.lat, nearest.lon), (reports[0].nearest_rain.lat, reports[0].nearest_rain.lon))
+        asyncio.run(main())
+        self.assertEqual([status for _, _, status in self.server.requests], [403, 403, 200])
+
+    def test_not_published(self):
+        """the image loaded instead of one not published yet is kept for
+        it, without asking the server again"""
+        async def main():
+            rain = self.new()
+            with patch.object(AsyncRainAreas, '_read_image_from_cache', autospec=True,
+                              side_effect=RainAreas._read_image_from_cache) as decode:
+                for _ in range(0, 3):
+                    await rain.async_load_image(self.when + datetime.timedelta(minutes=7))   # 00:05 is 403
+                    self.assertEqual(rain.image_time, self.when)
+                self.assertEqual(decode.call_count, 1)
+        asyncio.run(main())
+        self.assertEqual([status for _, _, status in self.server.requests], [403, 200])
+
+    def test_coalesce(self):
+        async def main():
+            rains = [self.new() for _ in range(0, 3)]
+            with patch.object(AsyncRainAreas, '_read_image_from_cache', autospec=True,
+                              side_effect=RainAreas._read_image_from_cache) as decode:
+                await asyncio.gather(*(rain.async_load_image(self.when) for rain in rains for _ in range(0, 4)))
+                self.assertEqual(decode.call_count, 3)  # once per instance
+            for rain in rains:
+                self.assertEqual(rain.intensity_map.data, self.rain.intensity_map.data)
+        asyncio.run(main())
+        self.assertEqual(len(self.server.requests), 1)  # downloaded once
+
+    def test_errors(self):
+        async def main():
+            rain = self.new()
+            with self.assertRaises(RuntimeError):
+                await rain.async_load_image(self.when - datetime.timedelta(days=1))  # never published
+        asyncio.run(main())
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain.archive import ArchivedRainAreas, DailyArchive, archive_path, import_day
+from nlannuzel.sgrain.geo import Location
+from nlannuzel.sgrain import cache
+from .test_rain import mock_load_image
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rain = RainAreas(cache_dir=self.tmp.name)
+        mock_load_image(self.rain, 'big_blob')  # 1971/01/01 00:00
+        self.day = self.rain.image_time
+        later = RainAreas(cache_dir=self.tmp.name)
+        later._set_image_time(self.day + datetime.timedelta(hours=13, minutes=20))
+        shutil.copy(self.rain.filepath, later.filepath)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_import(self):
+        self.assertEqual(import_day(self.day, self.tmp.name), (2, 0))
+        self.assertEqual(import_day(self.day, self.tmp.name), (0, 0))  # already there
+        with DailyArchive(archive_path(self.tmp.name, self.day)) as archive:
+            self.assertEqual(archive.times(), [self.day, self.day.replace(hour=13, minute=20)])
+            self.assertEqual(archive.read(self.day).data, self.rain.intensity_map.data)
+            self.assertIn(self.day, archive)
+            self.assertNotIn(self.day.replace(minute=5), archive)
+            self.assertNotIn(self.day - datetime.timedelta(days=1), archive)
+            with self.assertRaises(KeyError):
+                archive.plane(self.day.replace(minute=5))
+            with self.assertRaises(RuntimeError):
+                archive.write(self.day, self.rain.intensity_map)  # read only
+
+    def test_import_broken(self):
+        broken = RainAreas(cache_dir=self.tmp.name)
+        broken._set_image_time(self.day + datetime.timedelta(hours=2))
+        with open(self.rain.filepath, 'rb') as f, open(broken.filepath, 'wb') as g:
+            g.write(f.read()[:100])   # an interrupted download
+        for name in os.listdir(self.tmp.name):
+            if name.endswith(cache.SUFFIX):
+                os.unlink(os.path.join(self.tmp.name, name))
+        self.assertEqual(import_day(self.day, self.tmp.name), (2, 1))
+        self.assertEqual([name for name in os.listdir(self.tmp.name) if name.endswith(cache.SUFFIX)], [])   # no sidecar written
+        with DailyArchive(archive_path(self.tmp.name, self.day)) as archive:
+            self.assertEqual(len(archive.times()), 2)
+
+    def test_load_image(self):
+        import_day(self.day, self.tmp.name)
+        rain = ArchivedRainAreas(archive_dir=self.tmp.name)
+        with patch('png.Reader', side_effect=AssertionError("no PNG should be read")):
+            rain.load_image(self.day.replace(minute=7))  # looks back to 00:00
+            self.assertEqual(rain.image_time, self.day)
+            self.assertEqual(rain.intensity_map.data, self.rain.intensity_map.data)
+            location = Location(1.35, 103.8)
+            self.assertEqual(rain.intensity_at(location, 2), self.rain.intensity_at(location, 2))
+            rain.remove_blobs(20)
+            self.rain.remove_blobs(20)
+            self.assertEqual(rain.intensity_map.data, self.rain.intensity_map.data)
+            rain.load_image(self.day)  # not changed by remove_blobs()
+            self.assertNotEqual(rain.intensity_map.data, self.rain.intensity_map.data)
+        self.assertEqual(len(rain.times(self.day)), 2)
+        self.assertEqual(rain.times(self.day + datetime.timedelta(days=1)), [])
+        with self.assertRaises(RuntimeError):
+            rain.original_image
+        with self.assertRaises(RuntimeError):
+            rain.load_image(self.day.replace(hour=1))
+
+    def test_color_scale_changed(self):
+        import_day(self.day, self.tmp.name)
+
+        class Other(ArchivedRainAreas):
+            top_left = Location(1.5, 103.5)
+        with self.assertRaises(RuntimeError):
+            Other(archive_dir=self.tmp.name).load_image(self.day)
+        self.assertTrue(os.path.exists(archive_path(self.tmp.name, self.day)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
-from nlannuzel.sgrain.graph import Color, Image, BLACK, BlobFinder
+import random
+from nlannuzel.sgrain.graph import Color, Image, BLACK, BlobFinder, DisjointSet
 
 class TestBlobFinder(unittest.TestCase):
     def test_find_blob(self):
@@ -70,5 +71,153 @@ class TestBlobFinder(unittest.TestCase):
         self.assertEqual(count_blobs_of_size(6), 2)
         self.assertEqual(count_blobs_of_size(2), 2)
         self.assertEqual(count_blobs_of_size(1), 2)
+
+    def test_comb(self):
+        # each tooth of the comb gets a new label in the first pass, and
+        # the bottom row chains all labels together: 1-2, 2-3, 3-4...
+        teeth = 5000
+        image = Image(width=2 * teeth, height=3)
+        image.set_row(0, b'\x01\x00' * teeth)
+        image.set_row(1, b'\x01\x00' * teeth)
+        image.set_row(2, b'\x01' * (2 * teeth))
+        for method in BlobFinder.methods:
+            finder = BlobFinder(image, method=method)
+            self.assertEqual(len(finder.blobs), 1)
+            self.assertEqual(len(finder.blobs[0]), 4 * teeth)
+            self.assertEqual(len(set(finder.blobmap.data)), 2)
+
+    def test_runs(self):
+        rng = random.Random(7)
+        for density in (0.05, 0.3, 0.5, 0.7, 0.95):
+            image = Image(rows=[[Color.grey(rng.randrange(1, 4) if rng.random() < density else 0) for i in range(0, 50)] for j in range(0, 40)])
+            pixels = BlobFinder(image, method='pixels')
+            runs = BlobFinder(image, method='runs')
+            self.assertEqual(pixels.runs, runs.runs)
+            self.assertEqual(
+                [[(p.i, p.j, p.col.g) for p in blob] for blob in pixels.blobs],
+                [[(p.i, p.j, p.col.g) for p in blob] for blob in runs.blobs])
+            for k in range(0, len(image.data)):  # same partition of the image
+                self.assertEqual(pixels.blobmap.data[k] == 0, runs.blobmap.data[k] == 0)
+
+        image = Image(rows=[[Color.grey(v) for v in row] for row in [
+            [ 0, 1, 1, 0, 1 ],
+            [ 0, 0, 1, 0, 1 ],
+            [ 1, 1, 1, 1, 1 ],
+            [ 0, 0, 0, 0, 0 ],
+            [ 1, 0, 1, 1, 0 ],
+        ]])
+        finder = BlobFinder(image, method='runs')
+        self.assertEqual(finder.runs, [
+            [(0, 1, 2), (0, 4, 4), (1, 2, 2), (1, 4, 4), (2, 0, 4)],
+            [(4, 0, 0)],
+            [(4, 2, 3)],
+        ])
+        with self.assertRaises(RuntimeError):
+            BlobFinder(image, method='other')
+
+    def test_blob_summary(self):
+        image = Image(rows=[[Color.grey(v) for v in row] for row in [
+            [ 0, 3, 1, 0, 0 ],
+            [ 0, 0, 7, 2, 0 ],
+            [ 0, 0, 4, 0, 0 ],
+            [ 0, 0, 0, 0, 5 ],
+        ]])
+        for method in BlobFinder.methods:
+            blobs = BlobFinder(image, method=method).blobs
+            self.assertEqual(len(blobs), 2)
+            blob = blobs[0]
+            self.assertEqual(len(blob), 5)
+            self.assertEqual(blob.runs, [(0, 1, 2), (1, 2, 3), (2, 2, 2)])
+            self.assertEqual((blob.tl.i, blob.tl.j, blob.br.i, blob.br.j), (1, 0, 3, 2))
+            self.assertEqual(blob.centroid, ((1 + 2 + 2 + 3 + 2) / 5, (0 + 0 + 1 + 1 + 2) / 5))
+            self.assertEqual(blob.min_level, 1)
+            self.assertEqual(blob.max_level, 7)
+            self.assertEqual(blob.mean_level, 17 / 5)
+            self.assertIsNone(blob._pixels)  # pixels are not created until needed
+            self.assertEqual([(p.i, p.j, p.col.g) for p in blob], [(1, 0, 3), (2, 0, 1), (2, 1, 7), (3, 1, 2), (2, 2, 4)])
+            self.assertEqual(blob[2].col.g, 7)
+            self.assertEqual(blobs[1].centroid, (4, 3))
+            self.assertEqual(blobs[1].mean_level, 5)
+
+    def test_disjoint_set(self):
+        sets = DisjointSet()
+        labels = [sets.make_set() for n in range(0, 7)]
+        self.assertEqual(labels, [1, 2, 3, 4, 5, 6, 7])
+        sets.union(2, 3)
+        sets.union(3, 1)
+        sets.union(7, 6)
+        sets.union(6, 4)
+        self.assertEqual([sets.smallest(label) for label in labels], [1, 1, 1, 4, 5, 4, 4])
+        self.assertEqual(sets.find(2), sets.find(1))
+        self.assertNotEqual(sets.find(5), sets.find(4))
+
+
+class TestIncremental(unittest.TestCase):
+    def random_image(self, rng, width=70, height=50, density=0.3):
+        image = Image(width, height)
+        for j in range(0, height):
+            image.set_row(j, bytes(1 if rng.random() < density else 0 for _ in range(0, width)))
+        return image
+
+    def changed(self, rng, image, spots=3, size=6):
+        """a copy of image with a few random areas redrawn"""
+        image = image.copy()
+        for _ in range(0, spots):
+            ia = rng.randrange(0, image.width - size)
+            ja = rng.randrange(0, image.height - size)
+            for j in range(ja, ja + size):
+                image.set_row(j, bytes(1 if rng.random() < 0.5 else 0 for _ in range(0, size)), ia)
+        return image
+
+    def test_same_blobs(self):
+        """blobs found from the previous image are the same as blobs
+        found from scratch"""
+        rng = random.Random(1)
+        for density in (0.1, 0.3, 0.6):
+            image = self.random_image(rng, density=density)
+            finder = BlobFinder(image, method='runs')
+            for n in range(0, 10):
+                image = self.changed(rng, image)
+                finder = BlobFinder(image, method='runs', previous=finder, tile=8)
+                expected = BlobFinder(image, method='runs').blobs
+                self.assertEqual([b.runs for b in finder.blobs], [b.runs for b in expected])
+                self.assertEqual([(b.size, b.centroid, b.mean_level) for b in finder.blobs],
+                                 [(b.size, b.centroid, b.mean_level) for b in expected])
+                self.assertTrue(all(b.image is image for b in finder.blobs))
+                self.assertEqual(len(set(b.label for b in finder.blobs)), len(finder.blobs))
+
+    def test_stable_labels(self):
+        image = Image(rows=[[Color.grey(v) for v in row] for row in [
+            [1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [1, 1, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0],
+            [0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0],
+            [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            ]])
+        finder = BlobFinder(image, method='runs')
+        first, second = finder.blobs
+        moved = image.copy()
+        moved.set_row(1, bytes([0, 1, 1]), 9)   # the blob on the right moves right
+        moved.set_row(2, bytes([0, 1, 1]), 9)
+        moved.set_row(6, bytes([1]), 5)   # a new blob
+        follower = BlobFinder(moved, method='runs', previous=finder, tile=4)
+        blobs = follower.blobs
+        self.assertEqual(follower.reused, 1)   # the blob on the left didn't change
+        self.assertEqual([b.label for b in blobs], [first.label, second.label, finder.next_label])
+        self.assertEqual(follower.next_label, finder.next_label + 1)
+
+    def test_unchanged(self):
+        image = Image(rows=[[Color.grey(v) for v in row] for row in [[1, 0, 1], [1, 0, 0]]])
+        finder = BlobFinder(image, method='runs')
+        follower = BlobFinder(image.copy(), method='runs', previous=finder)
+        self.assertEqual([b.runs for b in follower.blobs], [b.runs for b in finder.blobs])
+        self.assertEqual(follower.reused, 2)
+        with self.assertRaises(RuntimeError):
+            BlobFinder(image, method='pixels', previous=finder)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,168 @@
+import unittest
+import io
+import os
+import tempfile
+import threading
+import time
+from unittest.mock import patch, MagicMock
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain.geo import Location
+from nlannuzel.sgrain.graph import Image
+from nlannuzel.sgrain import cache
+from .test_rain import mock_load_image
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.tmp.name, 'image.png')
+        with open(self.filepath, 'wb'):
+            pass
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        image = Image(width=3, height=2, data=bytearray(range(6)))
+        key = cache.key_of(RainAreas.color_scale, RainAreas.top_left, RainAreas.bottom_right)
+        self.assertTrue(cache.write_sidecar(self.filepath, key, image))
+        read = cache.read_sidecar(self.filepath, key)
+        self.assertEqual((read.width, read.height, read.data), (3, 2, image.data))
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['image.png', 'image.png.intensity'])  # no temporary file left
+
+        other = cache.key_of(RainAreas.color_scale, Location(1.5, 103.5), RainAreas.bottom_right)
+        self.assertNotEqual(key, other)
+        self.assertIsNone(cache.read_sidecar(self.filepath, other))
+        self.assertNotEqual(key, cache.key_of(RainAreas.color_scale[:-1], RainAreas.top_left, RainAreas.bottom_right))
+
+        os.utime(self.filepath, ns=(0, os.stat(cache.sidecar_path(self.filepath)).st_mtime_ns + 1))
+        self.assertIsNone(cache.read_sidecar(self.filepath, key))  # image is newer
+
+        self.assertTrue(cache.write_sidecar(self.filepath, key, image))
+        with open(self.filepath, 'wb') as f:  # downloaded again, with the time it was published at
+            f.write(b'new')
+        os.utime(self.filepath, ns=(0, 1))
+        self.assertIsNone(cache.read_sidecar(self.filepath, key))  # image is older, but not the same
+
+        with open(cache.sidecar_path(self.filepath), 'r+b') as f:
+            f.truncate(20)
+        self.assertIsNone(cache.read_sidecar(self.filepath, key))
+
+    def test_missing(self):
+        key = cache.key_of(RainAreas.color_scale, RainAreas.top_left, RainAreas.bottom_right)
+        self.assertIsNone(cache.read_sidecar(self.filepath, key))
+        with self.assertRaises(FileNotFoundError):
+            cache.read_sidecar(os.path.join(self.tmp.name, 'missing.png'), key)
+
+    def test_rain_areas(self):
+        rain = RainAreas(cache_dir=self.tmp.name)
+        mock_load_image(rain, 'big_blob')
+        self.assertTrue(os.path.exists(cache.sidecar_path(rain.filepath)))
+        again = RainAreas(cache_dir=self.tmp.name)
+        with patch('png.Reader', side_effect=AssertionError("the image should not be decoded")):
+            again.load_image(rain.image_time)
+        self.assertEqual(again.intensity_map.data, rain.intensity_map.data)
+        self.assertEqual(again.original_image.data, rain.original_image.data)  # still read from the image
+
+    def test_color_scale_changed(self):
+        rain = RainAreas(cache_dir=self.tmp.name)
+        mock_load_image(rain, 'big_blob')
+
+        class Reversed(RainAreas):
+            color_scale = RainAreas.color_scale[:1] + RainAreas.color_scale[:0:-1]
+        other = Reversed(cache_dir=self.tmp.name)
+        other.load_image(rain.image_time)
+        levels = other.intensity_map.data
+        self.assertNotEqual(levels, rain.intensity_map.data)
+        self.assertEqual(levels, bytearray(0 if level == 0 else 32 - level for level in rain.intensity_map.data))
+        self.assertEqual(cache.read_sidecar(rain.filepath, other.cache_key).data, levels)  # written again
+
+    def test_concurrent_results(self):
+        def write(i):
+            for k in range(0, 10):
+                self.assertTrue(cache.write_result(self.filepath, f'{i}-{k}', k))
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(0, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(0, 4):
+            for k in range(0, 10):
+                self.assertEqual(cache.read_result(self.filepath, f'{i}-{k}'), k)
+        self.assertFalse(os.path.exists(self.filepath + '.lock'))
+
+    def test_results_of_replaced_image(self):
+        self.assertTrue(cache.write_result(self.filepath, 'query', 1))
+        self.assertEqual(cache.read_result(self.filepath, 'query'), 1)
+        with open(self.filepath, 'wb') as f:  # downloaded again, with the time it was published at
+            f.write(b'new')
+        os.utime(self.filepath, ns=(0, 1))
+        self.assertIsNone(cache.read_result(self.filepath, 'query'))
+        self.assertTrue(cache.write_result(self.filepath, 'other', 2))
+        self.assertEqual(cache._read_results(self.filepath), {'other': 2})  # results of the old image are dropped
+        os.remove(self.filepath)
+        self.assertIsNone(cache.read_result(self.filepath, 'other'))
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rain = RainAreas(cache_dir=self.tmp.name)
+        mock_load_image(rain, 'basic')
+        with open(rain.filepath, 'rb') as f:
+            self.content = f.read()
+        self.image_time = rain.image_time
+        self.filepath = rain.filepath
+        self.intensities = rain.intensity_map.data
+        for name in os.listdir(self.tmp.name):
+            os.remove(os.path.join(self.tmp.name, name))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def urlopen(self, content, delay=0):
+        def urlopen(url):
+            time.sleep(delay)
+            response = MagicMock()
+            response.__enter__.return_value = io.BytesIO(content)
+            return response
+        return patch('urllib.request.urlopen', side_effect=urlopen)
+
+    def test_truncated(self):
+        rain = RainAreas(cache_dir=self.tmp.name)
+        with self.urlopen(self.content[:-20]):
+            with self.assertRaises(RuntimeError):
+                rain.load_image(self.image_time)
+        self.assertEqual(os.listdir(self.tmp.name), [])  # no partial image, temporary or lock file left
+        with self.urlopen(b''):
+            with self.assertRaises(RuntimeError):
+                rain.load_image(self.image_time)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_broken_file_in_cache(self):
+        for content in (b'', self.content[:100]):  # e.g. left by previous versions
+            with open(self.filepath, 'wb') as f:
+                f.write(content)
+            rain = RainAreas(cache_dir=self.tmp.name)
+            with self.urlopen(self.content) as urlopen:
+                rain.load_image(self.image_time)
+            self.assertEqual(urlopen.call_count, 1)
+            self.assertEqual(rain.intensity_map.data, self.intensities)
+            os.remove(cache.sidecar_path(self.filepath))
+
+    def test_single_flight(self):
+        rains = [RainAreas(cache_dir=self.tmp.name) for _ in range(0, 4)]
+        with self.urlopen(self.content, delay=0.2) as urlopen:
+            threads = [threading.Thread(target=rain.load_image, args=(self.image_time,)) for rain in rains]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(urlopen.call_count, 1)
+        for rain in rains:
+            self.assertEqual(rain.intensity_map.data, self.intensities)
+        self.assertFalse(os.path.exists(self.filepath + '.lock'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+import datetime
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+from unittest.mock import patch
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain.geo import Location
+from nlannuzel.sgrain.graph import Pixel
+from nlannuzel.sgrain import daemon
+from .test_rain import mock_load_image
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rain = RainAreas(cache_dir=self.tmp.name)
+        mock_load_image(self.rain, 'big_blob')  # 1971/01/01 00:00, now in the cache
+        self.path = os.path.join(self.tmp.name, 'test.sock')
+        self.daemon = daemon.RainDaemon(cache_dir=self.tmp.name, socket_path=self.path)
+        self.daemon.now = lambda: datetime.datetime(1971, 1, 1, 0, 3)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        for _ in range(0, 100):
+            if self.daemon._server is not None and self.daemon._raw is not None:
+                break
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        self.tmp.cleanup()
+
+    def test_query(self):
+        self.assertEqual(daemon.request({'op': 'status'}, path=self.path), {'image_time': '1971-01-01T00:00:00'})
+        locations = [self.rain.pixel_to_location(Pixel(i, j)) for i, j in ((193, 78), (10, 10), (100, 60))]
+        locations.append(Location(2.0, 103.8))  # outside of the map
+        for filter_noise in (None, 20, None):
+            reports = daemon.query(locations, d=2, filter_noise=filter_noise, nearest=True, path=self.path)
+            rain = self.rain.copy()
+            expected = rain.query(locations, d=2, filter_noise=filter_noise, nearest=True)
+            for report, other in zip(reports, expected):
+                self.assertEqual(report.image_time, other.image_time)
+                self.assertEqual(report.inside_map, other.inside_map)
+                self.assertEqual((report.intensity, report.mean_intensity), (other.intensity, other.mean_intensity))
+                self.assertEqual(report.nearest_rain_distance, other.nearest_rain_distance)
+        self.assertEqual(list(self.daemon._filtered), [20])
+        self.assertEqual(self.daemon._raw.intensity_map.data, self.rain.intensity_map.data)  # not filtered
+
+    def test_stable_labels(self):
+        self.daemon.engine = 'python'
+        self.daemon._raw = None   # loaded again with this engine
+        self.daemon.frame()
+        self.daemon.frame(20)
+        labels = [b.label for b in self.daemon._raw.blobs]
+        next_image = os.path.join(self.tmp.name, self.rain.filename_of(datetime.datetime(1971, 1, 1, 0, 5)))
+        with open(self.rain.filepath, 'rb') as f, open(next_image, 'wb') as g:
+            g.write(f.read())
+        self.daemon.now = lambda: datetime.datetime(1971, 1, 1, 0, 8)
+        self.daemon.refresh()
+        filtered = self.daemon.frame(20)   # before blobs of the new raw image are found
+        raw = self.daemon.frame()
+        self.assertEqual(raw.image_time, datetime.datetime(1971, 1, 1, 0, 5))
+        self.assertEqual([b.label for b in raw.blobs], labels)
+        self.assertEqual(raw._blob_finder.reused, len(labels))   # not labelled from scratch
+        self.assertEqual([b.label for b in filtered.blobs], [b.label for b in raw.blobs if len(b) > 20])
+
+    def test_error(self):
+        with self.assertRaises(RuntimeError):
+            daemon.request({'op': 'unknown'}, path=self.path)
+        self.daemon._raw = None   # e.g. offline since the daemon started
+        self.daemon.now = lambda: datetime.datetime(1971, 1, 2)
+        with patch('urllib.request.urlopen', side_effect=urllib.error.URLError("offline")):
+            with self.assertRaises(RuntimeError):
+                daemon.request({'op': 'status'}, path=self.path)  # not in the cache, and can't be downloaded
+
+    def test_download_error(self):
+        self.daemon.frame()
+        self.daemon.now = lambda: datetime.datetime(1971, 1, 1, 0, 8)
+        with patch('urllib.request.urlopen', side_effect=urllib.error.URLError("offline")) as urlopen:
+            self.daemon.refresh()
+            reports = daemon.query([Location(1.35, 103.8)], path=self.path)
+            self.assertEqual(reports[0].image_time, datetime.datetime(1971, 1, 1, 0, 0))   # the previous image
+            self.assertEqual(urlopen.call_count, 1)
+            self.daemon.refresh()
+            self.assertEqual(urlopen.call_count, 1)   # not again before retry seconds
+            self.assertGreater(self.daemon._next_refresh(), self.daemon.retry - 1)
+            self.daemon._checked -= self.daemon.retry
+            self.assertEqual(self.daemon._next_refresh(), 0)
+            self.daemon.refresh()
+            self.assertEqual(urlopen.call_count, 2)
+
+    def test_background_refresh(self):
+        """the image of the next slot is loaded when it starts, not
+        by the first query after it"""
+        self.daemon.shutdown()
+        self.thread.join()
+        clock = [datetime.datetime(1971, 1, 1, 0, 4, 59, 800000)]
+        self.daemon = daemon.RainDaemon(cache_dir=self.tmp.name, socket_path=self.path)
+        self.daemon.now = lambda: clock[0]
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        for _ in range(0, 100):
+            if self.daemon._raw is not None:
+                break
+            time.sleep(0.01)
+        next_image = os.path.join(self.tmp.name, self.rain.filename_of(datetime.datetime(1971, 1, 1, 0, 5)))
+        with open(self.rain.filepath, 'rb') as f, open(next_image, 'wb') as g:
+            g.write(f.read())
+        clock[0] = datetime.datetime(1971, 1, 1, 0, 5)   # no query from now on
+        for _ in range(0, 500):
+            if self.daemon._raw.image_time == datetime.datetime(1971, 1, 1, 0, 5):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.daemon._raw.image_time, datetime.datetime(1971, 1, 1, 0, 5))
+
+    def test_no_daemon(self):
+        self.assertIsNone(daemon.query([Location(1.35, 103.8)], path=os.path.join(self.tmp.name, 'other.sock')))
+        with self.assertRaises(RuntimeError):
+            daemon.RainDaemon(socket_path=self.path).serve_forever()  # already running
+
+
+if __name__ == '__main__':
+    unittest.main()
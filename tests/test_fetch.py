@@ -0,0 +1,169 @@
+import unittest
+import datetime
+import os
+import tempfile
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain import fetch
+from .test_rain import mock_load_image
+from .stub_server import StubServer
+
+
+class TestFetch(unittest.TestCase):
+    def setUp(self):
+        self.time = datetime.datetime(1971, 1, 1, 0, 0, 10)
+        self.server = StubServer(now=lambda: self.time).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        rain = RainAreas(cache_dir=self.tmp.name)
+        mock_load_image(rain, 'big_blob')
+        with open(rain.filepath, 'rb') as f:
+            self.content = f.read()
+        os.remove(rain.filepath)
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        os.mkdir(self.cache_dir)
+        self.prefetcher = fetch.Prefetcher(cache_dir=self.cache_dir, base_url=self.server.base_url, delay=30)
+        self.prefetcher.now = lambda: self.time
+        self.prefetcher.sleep = self.sleep
+        self.sleeps = []
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.time += datetime.timedelta(seconds=seconds)
+        return False
+
+    def publish(self, image_time, delay=45):
+        filename = os.path.basename(self.prefetcher.filepath_of(image_time))
+        self.server.publish(filename, self.content, image_time + datetime.timedelta(seconds=delay))
+        return filename
+
+    def test_fetch(self):
+        slot = datetime.datetime(1971, 1, 1, 0, 0)
+        filename = self.publish(slot)
+        filepath = self.prefetcher.filepath_of(slot)
+        self.assertEqual(self.prefetcher.fetch(slot), fetch.NOT_PUBLISHED)
+        self.assertFalse(os.path.exists(filepath))
+        self.time = slot + datetime.timedelta(minutes=1)
+        self.assertEqual(self.prefetcher.fetch(slot), fetch.FETCHED)
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(self.prefetcher.fetch(slot), fetch.CACHED)
+        self.assertEqual(self.prefetcher.fetch(slot, revalidate=True), fetch.NOT_MODIFIED)
+        self.assertEqual([status for _, name, status in self.server.requests if name == filename], [403, 200, 304])
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), [filename])  # no temporary file left
+
+        rain = RainAreas(cache_dir=self.cache_dir)
+        rain.load_image(slot)  # from the cache, urlopen is not patched
+        self.assertEqual(rain.image_time, slot)
+
+    def test_poll_backoff(self):
+        slot = datetime.datetime(1971, 1, 1, 0, 0)
+        self.publish(slot, delay=100)
+        self.assertEqual(self.prefetcher.poll(slot, until=slot + datetime.timedelta(minutes=5)), fetch.FETCHED)
+        self.assertEqual(self.sleeps, [5, 10, 20, 40, 60])  # 10s + 135s > 100s
+        self.assertEqual(self.prefetcher.stats[fetch.NOT_PUBLISHED], 5)
+
+        self.sleeps = []
+        later = slot + datetime.timedelta(minutes=5)
+        self.assertEqual(self.prefetcher.poll(later, until=self.time + datetime.timedelta(seconds=30)), fetch.NOT_PUBLISHED)
+        self.assertEqual(sum(self.sleeps), 30)  # gave up in time
+
+    def test_run(self):
+        slots = [datetime.datetime(1971, 1, 1, 0, 5 * n) for n in range(0, 4)]
+        for slot in slots:
+            self.publish(slot)
+
+        def sleep(seconds):
+            self.sleep(seconds)
+            return self.time >= slots[-1]
+        self.prefetcher.sleep = sleep
+        self.prefetcher.run()
+        for slot in slots[:-1]:
+            self.assertTrue(os.path.exists(self.prefetcher.filepath_of(slot)))
+        statuses = [status for _, _, status in self.server.requests]
+        self.assertEqual(statuses.count(200), 3)
+        self.assertTrue(statuses.count(403) <= 3 * 3)  # first polls at 30s, published at 45s
+
+    def test_run_revalidates(self):
+        slots = [datetime.datetime(1971, 1, 1, 0, 5 * n) for n in range(0, 2)]
+        for slot in slots:
+            self.publish(slot)
+        self.time = slots[0] + datetime.timedelta(minutes=1)
+        self.assertEqual(self.prefetcher.fetch(slots[0]), fetch.FETCHED)
+
+        def sleep(seconds):
+            self.sleep(seconds)
+            return self.time >= slots[-1]
+        self.prefetcher.sleep = sleep
+        self.prefetcher.run()   # restarted, the latest image is already in the cache
+        self.assertEqual(self.prefetcher.stats[fetch.NOT_MODIFIED], 1)
+        filename = os.path.basename(self.prefetcher.filepath_of(slots[0]))
+        status, headers = [(status, headers) for (_, name, status), headers in zip(self.server.requests, self.server.headers)
+                           if name == filename][-1]
+        self.assertEqual(status, 304)
+        self.assertIn('If-Modified-Since', headers)
+        self.assertIn('If-None-Match', headers)
+
+    def test_next_publish_time(self):
+        at = datetime.datetime(1971, 1, 1, 0, 7, 10)
+        self.assertEqual(self.prefetcher.next_publish_time(at),
+                         (datetime.datetime(1971, 1, 1, 0, 10), datetime.datetime(1971, 1, 1, 0, 10, 30)))
+        at = datetime.datetime(1971, 1, 1, 0, 5, 20)
+        self.assertEqual(self.prefetcher.next_publish_time(at)[1], datetime.datetime(1971, 1, 1, 0, 5, 30))
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.tmp = tempfile.TemporaryDirectory()
+        rain = RainAreas(cache_dir=self.tmp.name)
+        mock_load_image(rain, 'big_blob')
+        with open(rain.filepath, 'rb') as f:
+            self.content = f.read()
+        os.remove(rain.filepath)
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        os.mkdir(self.cache_dir)
+        self.start = datetime.datetime(1971, 1, 1, 0, 0)
+        self.times = [self.start + datetime.timedelta(minutes=5 * n) for n in range(0, 24)]
+        self.gaps = self.times[3:6] + self.times[10:11]
+        for image_time in self.times:
+            if image_time not in self.gaps:
+                self.server.publish(rain.filename_of(image_time), self.content, image_time)
+        self.rain = rain
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def test_backfill(self):
+        cached = self.rain.filename_of(self.times[0])
+        with open(os.path.join(self.cache_dir, cached), 'wb') as f:
+            f.write(self.content)
+        backfill = fetch.Backfill(cache_dir=self.cache_dir, base_url=self.server.base_url, workers=3)
+        stats = backfill.run(self.times[0] + datetime.timedelta(minutes=2), self.times[-1])
+        self.assertEqual((stats[fetch.FETCHED], stats[fetch.CACHED], stats[fetch.NOT_PUBLISHED], stats['errors']), (19, 1, 4, 0))
+        self.assertEqual(stats['bytes'], 19 * len(self.content))
+        self.assertIn('19 images downloaded', backfill.report())
+        expected = sorted(self.rain.filename_of(t) for t in self.times if t not in self.gaps)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), expected)
+        self.assertEqual(len(self.server.requests), 23)  # cached image not asked
+        self.assertTrue(len(self.server.clients) <= 3)  # connections are kept open
+
+        rain = RainAreas(cache_dir=self.cache_dir)
+        rain.load_image(self.times[-1])  # from the cache, urlopen is not patched
+        self.assertEqual(rain.intensity_map.data, self.rain.intensity_map.data)
+
+        stats = fetch.Backfill(cache_dir=self.cache_dir, base_url=self.server.base_url).run(self.times[0], self.times[-1])
+        self.assertEqual((stats[fetch.FETCHED], stats[fetch.CACHED], stats[fetch.NOT_PUBLISHED]), (0, 20, 4))
+
+    def test_connection_closed(self):
+        self.server.keep_alive = False
+        backfill = fetch.Backfill(cache_dir=self.cache_dir, base_url=self.server.base_url, workers=2)
+        stats = backfill.run(self.times[0], self.times[-1])
+        self.assertEqual((stats[fetch.FETCHED], stats[fetch.NOT_PUBLISHED], stats['errors']), (20, 4, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
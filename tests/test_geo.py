@@ -1,5 +1,6 @@
 import unittest
-from nlannuzel.sgrain.geo import Location
+from nlannuzel.sgrain.geo import Location, haversine
+from nlannuzel.sgrain import vector
 
 class TestLoc(unittest.TestCase):
     def test_distance(self):
@@ -11,6 +12,20 @@ class TestLoc(unittest.TestCase):
         self.assertAlmostEqual(merlion.distance_to(flyer), 1.01, 1)
         self.assertAlmostEqual(flyer.distance_to(changi_jewel), 16.12, 1)
         self.assertAlmostEqual(woodland_checkpoint.distance_to(changi_jewel), 26.32, 1)
+    def test_haversine(self):
+        merlion = Location(1.2868012156184587, 103.85447217129732)
+        others = [Location(1.3600993711358866, 103.98980701072115),
+                  Location(1.289366192868755, 103.86315734141414),
+                  Location(1.4453921110423973, 103.76891392488915)]
+        self.assertEqual(haversine(merlion.lat, merlion.lon, others[0].lat, others[0].lon), merlion.distance_to(others[0]))
+        distances = haversine(merlion.lat, merlion.lon, [o.lat for o in others], [o.lon for o in others])
+        self.assertEqual(len(distances), len(others))
+        for d, other in zip(distances, others):
+            self.assertAlmostEqual(float(d), merlion.distance_to(other), 9)
+        if vector.available():
+            self.assertTrue(isinstance(distances, vector.np.ndarray))
+        else:
+            self.assertTrue(isinstance(distances, list))
 
 if __name__ == '__main__':
     unittest.main()
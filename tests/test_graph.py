@@ -1,5 +1,6 @@
 import unittest
-from nlannuzel.sgrain.graph import Color, Pixel, Box, BLACK, RED
+import random
+from nlannuzel.sgrain.graph import Color, Pixel, PixelGrid, Box, DistanceTransform, Image, Posterizer, SummedAreaTable, BLACK, RED, YELLOW
 
 class TestGraph(unittest.TestCase):
     def test_color(self):
@@ -27,6 +28,28 @@ class TestGraph(unittest.TestCase):
         self.assertEqual( Color(255, 255, 0  ).posterize(palette), 2 )
         self.assertEqual( Color(255, 255, 255).posterize(palette), 2 )
 
+    def test_posterizer(self):
+        palette = [Color(r, g, b) for r, g, b, in [
+            [0  , 0  , 0],
+            [255, 0  , 0],
+            [255, 255, 0],
+            [0  , 128, 255],
+            [7  , 7  , 7],
+        ]]
+        posterizer = Posterizer(palette)
+        row = []
+        expected = []
+        for r in range(0, 256, 15):
+            for g in range(0, 256, 17):
+                for b in (0, 3, 7, 130, 255):
+                    col = Color(r, g, b)
+                    self.assertEqual(posterizer.index_of(r, g, b), col.posterize(palette))
+                    self.assertEqual(posterizer.index_of_color(col), col.posterize(palette))
+                    row.extend([r, g, b, 255])
+                    expected.append(col.posterize(palette))
+        self.assertEqual(list(posterizer.posterize_row(row, channels=4)), expected)
+        self.assertEqual(list(posterizer.posterize_row(row, channels=4)), expected)  # memoized
+
     def test_distance(self):
         a = Color(0, 0, 0)
         b = Color(127, 0, 0)
@@ -124,6 +147,140 @@ class TestGraph(unittest.TestCase):
             a.append([i, j])
         self.assertEqual( len(a), 8 )  # 6 + 6 + 1 + 1
 
+    def test_image(self):
+        image = Image(width=4, height=3)
+        self.assertTrue(image.is_grey())
+        self.assertEqual(len(image.data), 12)
+        self.assertEqual(image.get_color_at(3, 2), BLACK)
+        image.set_color_at(1, 2, Color.grey(7))
+        self.assertEqual(image.get_level_at(1, 2), 7)
+        self.assertEqual(list(image.get_row(2)), [0, 7, 0, 0])
+        self.assertEqual(list(image.get_row(2, 1, 3)), [7, 0])
+        image.set_row(0, bytes([1, 2]), 2)
+        self.assertEqual(list(image.get_row(0)), [0, 0, 1, 2])
+        self.assertEqual(list(image.translate(range(255, -1, -1)).get_row(0)), [255, 255, 254, 253])
+        self.assertEqual(list(image.foreground_row(0)), [0, 0, 1, 1])
+        self.assertEqual(image.to_rgb_rows()[0], [0, 0, 0, 0, 0, 0, 1, 1, 1, 2, 2, 2])
+
+        image.set_color_at(0, 0, YELLOW)  # becomes a r, g, b image
+        self.assertFalse(image.is_grey())
+        self.assertEqual(image.get_color_at(0, 0), YELLOW)
+        self.assertEqual(image.get_color_at(1, 2), Color.grey(7))
+        self.assertEqual(list(image.foreground_row(0)), [1, 0, 1, 1])
+        with self.assertRaises(RuntimeError):
+            image.translate(range(0, 256))
+
+        image = Image.from_rgb_rows([[1, 2, 3, 255, 4, 5, 6, 255]], has_alpha=True)
+        self.assertEqual(image.width, 2)
+        self.assertEqual(image.height, 1)
+        self.assertEqual(image.get_color_at(1, 0), Color(4, 5, 6))
+        self.assertEqual(image.to_rgb_rows(), [[1, 2, 3, 4, 5, 6]])
+
+        labels = Image(width=2, height=2, typecode='L')
+        labels.set_color_at(1, 1, Color.grey(1000))
+        self.assertEqual(labels.get_level_at(1, 1), 1000)
+        with self.assertRaises(RuntimeError):
+            labels.set_color_at(0, 0, YELLOW)
+
+    def test_pixel_grid(self):
+        rng = random.Random(3)
+        grid = PixelGrid(cell=4)
+        self.assertIsNone(grid.nearest(Pixel(3, 3)))
+        pixels = set()
+        for n in range(0, 60):
+            j = rng.randrange(0, 50)
+            ia = rng.randrange(0, 70)
+            ib = min(69, ia + rng.randrange(0, 9))
+            if any((i, j) in pixels for i in range(ia - 1, ib + 2)):
+                continue
+            grid.add_run(j, ia, ib)
+            pixels.update((i, j) for i in range(ia, ib + 1))
+        self.assertEqual(len(grid), len(pixels))
+        for n in range(0, 50):
+            q = Pixel(rng.randrange(0, 80), rng.randrange(0, 60))
+            expected = sorted(pixels, key=lambda p: ((p[0] - q.i)**2 + (p[1] - q.j)**2, p[1], p[0]))
+            self.assertEqual([(p.i, p.j) for p in grid.k_nearest(q, 5)], expected[:5])
+            nearest = grid.nearest(q)
+            self.assertEqual((nearest.i, nearest.j), expected[0])
+            d = rng.uniform(0, 15)
+            self.assertEqual(
+                [(p.i, p.j) for p in grid.within(q, d)],
+                sorted((p for p in pixels if (p[0] - q.i)**2 + (p[1] - q.j)**2 <= d * d), key=lambda p: (p[1], p[0])))
+
+    def test_pixel_grid_scale(self):
+        rng = random.Random(11)
+        grid = PixelGrid(cell=4)
+        pixels = set()
+        for n in range(0, 60):
+            j = rng.randrange(0, 50)
+            ia = rng.randrange(0, 70)
+            ib = min(69, ia + rng.randrange(0, 9))
+            if any((i, j) in pixels for i in range(ia - 1, ib + 2)):
+                continue
+            grid.add_run(j, ia, ib)
+            pixels.update((i, j) for i in range(ia, ib + 1))
+        sx, sy = 0.3, 0.7   # pixels are not square
+        for n in range(0, 50):
+            q = Pixel(rng.randrange(0, 80), rng.randrange(0, 60))
+            d2 = lambda p: ((p[0] - q.i) * sx)**2 + ((p[1] - q.j) * sy)**2
+            expected = sorted(pixels, key=lambda p: (d2(p), p[1], p[0]))
+            self.assertEqual([(p.i, p.j) for p in grid.k_nearest(q, 5, (sx, sy))], expected[:5])
+            nearest = grid.nearest(q, (sx, sy))
+            self.assertEqual((nearest.i, nearest.j), expected[0])
+            d = rng.uniform(0, 8)
+            self.assertEqual(
+                [(p.i, p.j) for p in grid.within(q, d, (sx, sy))],
+                sorted((p for p in pixels if d2(p) <= d * d), key=lambda p: (p[1], p[0])))
+
+    def test_distance_transform(self):
+        rng = random.Random(7)
+        image = Image(width=31, height=23)
+        self.assertIsNone(DistanceTransform(image).nearest(Pixel(3, 3)))
+        self.assertEqual(DistanceTransform(image).distance(Pixel(3, 3)), float('inf'))
+        for j in range(0, image.height):
+            image.set_row(j, bytes(rng.choice((0, 0, 0, 0, 0, 0, rng.randrange(1, 32))) for i in range(0, image.width)))
+        widths = [rng.uniform(0.2, 1) for j in range(0, image.height)]
+        heights = [rng.uniform(0.2, 1) for j in range(0, image.height)]
+        for threshold, scale in ((0, (1, 1)), (10, (1, 1)), (0, (widths, 0.6)), (0, (widths, heights))):
+            transform = DistanceTransform(image, threshold, scale)
+            sx = scale[0] if isinstance(scale[0], list) else [scale[0]] * image.height
+            sy = scale[1] if isinstance(scale[1], list) else [scale[1]] * image.height
+            foreground = [(i, j) for j in range(0, image.height) for i in range(0, image.width) if image.get_level_at(i, j) > threshold]
+            for j in range(0, image.height):
+                for i in range(0, image.width):
+                    d2 = lambda p: ((p[0] - i) * sx[j])**2 + ((p[1] - j) * sy[j])**2
+                    expected = min(d2(p) for p in foreground)
+                    self.assertAlmostEqual(transform.distance(Pixel(i, j)) ** 2, expected)
+                    nearest = transform.nearest(Pixel(i, j))
+                    self.assertIn((nearest.i, nearest.j), foreground)
+                    self.assertAlmostEqual(d2((nearest.i, nearest.j)), expected)
+
+    def test_summed_area_table(self):
+        rng = random.Random(5)
+        image = Image(width=23, height=17)
+        for j in range(0, image.height):
+            image.set_row(j, bytes(rng.choice((0, 0, 0, rng.randrange(1, 32))) for i in range(0, image.width)))
+        table = SummedAreaTable(image)
+        rain = SummedAreaTable.of_foreground(image)
+        for n in range(0, 200):
+            ia, ib = sorted(rng.sample(range(0, image.width), 2))
+            ja, jb = sorted(rng.sample(range(0, image.height), 2))
+            box = Box.from_coordinates(ia, ja, ib, jb)
+            levels = [image.get_level_at(i, j) for i, j in box.iter_area()]
+            self.assertEqual(box.area(), len(levels))
+            self.assertEqual(table.sum(box), sum(levels))
+            self.assertAlmostEqual(table.mean(box), sum(levels) / len(levels))
+            self.assertEqual(rain.sum(box), sum(1 for level in levels if level != 0))
+            self.assertEqual(image.max_level_in(box), max(levels))
+
+    def test_box_around(self):
+        image = Image(width=10, height=8)
+        box = image.box_around(Pixel(9, 7), 2)
+        self.assertEqual((box.tl.i, box.tl.j, box.br.i, box.br.j), (7, 5, 9, 7))
+        box = image.box_around(Pixel(0, 1), 3)
+        self.assertEqual((box.tl.i, box.tl.j, box.br.i, box.br.j), (0, 0, 3, 4))
+        self.assertEqual(len(list(image.iter_rectangle_area(image.box_around(Pixel(9, 7), 20)))), 80)
+
     def test_angle(self):
         a = Pixel(5, 5)
         with self.assertRaises(RuntimeError):
@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import patch
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain.geo import Location
+from nlannuzel.sgrain.history import FrameCache, RainHistory
+import datetime
+import os
+import shutil
+import tempfile
+import urllib.error
+from .test_rain import mock_load_image
+
+T0 = datetime.datetime(1970, 1, 1, 0, 0)
+HOME = Location(1.3, 103.8)
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        """images at 00:00 (basic), 00:05 (big_blob), 00:10 (basic), and
+        none at 00:15"""
+        self._dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self._dir.name
+        basic = RainAreas(cache_dir=self.cache_dir)
+        mock_load_image(basic, 'basic')
+        big_blob = RainAreas(cache_dir=self.cache_dir)
+        mock_load_image(big_blob, 'big_blob')
+        for minute, rain in ((5, big_blob), (10, basic)):
+            shutil.copy(rain.filepath, os.path.join(self.cache_dir, rain.filename_of(T0 + datetime.timedelta(minutes=minute))))
+        self.expected = [basic.intensity_at(HOME, 2), big_blob.intensity_at(HOME, 2), basic.intensity_at(HOME, 2), None]
+        patcher = patch("urllib.request.urlopen", side_effect=urllib.error.HTTPError('url', 403, 'Forbidden', None, None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_series(self):
+        history = RainHistory(RainAreas(cache_dir=self.cache_dir))
+        series = history.series([HOME, Location(0, 0)], T0, T0 + datetime.timedelta(minutes=15), d=2)
+        self.assertEqual([t for t, _ in series], [T0 + datetime.timedelta(minutes=m) for m in (0, 5, 10, 15)])
+        self.assertEqual([intensities[0] for _, intensities in series], self.expected)
+        self.assertEqual([intensities[1] for _, intensities in series], [None] * 4)
+
+    def test_only_missing_frames_are_loaded(self):
+        rain = RainAreas(cache_dir=self.cache_dir)
+        history = RainHistory(rain)
+        history.series_at(HOME, T0, T0 + datetime.timedelta(minutes=5))
+        self.assertEqual(len(history.frames), 2)
+        with patch.object(rain, 'load_image', wraps=rain.load_image) as load_image:
+            series = history.series_at(HOME, T0, T0 + datetime.timedelta(minutes=15), d=2)
+        self.assertEqual([intensity for _, intensity in series], self.expected)
+        # 00:10, and 00:15 which is not published, 00:10 is found instead
+        self.assertEqual([c.args[0] for c in load_image.call_args_list], [T0 + datetime.timedelta(minutes=m) for m in (10, 15)])
+
+    def test_changes(self):
+        history = RainHistory(RainAreas(cache_dir=self.cache_dir))
+        changes = history.changes_at(HOME, T0, T0 + datetime.timedelta(minutes=15))
+        self.assertEqual(changes, [(T0 + datetime.timedelta(minutes=5), True), (T0 + datetime.timedelta(minutes=10), False)])
+
+    def test_eviction(self):
+        rain = RainAreas(cache_dir=self.cache_dir)
+        rain.load_image(T0)
+        size = len(rain.intensity_map.data)
+        frames = FrameCache(max_bytes=2 * size)
+        history = RainHistory(rain, frames)
+        history.series_at(HOME, T0, T0 + datetime.timedelta(minutes=10))
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(frames.nbytes, 2 * size)
+        self.assertNotIn(T0, frames)   # least recently used
+        self.assertIn(T0 + datetime.timedelta(minutes=10), frames)
@@ -0,0 +1,98 @@
+import unittest
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain.graph import Image, Pixel
+from nlannuzel.sgrain.nowcast import Nowcast, block_motion, heading_of
+from nlannuzel.sgrain import vector
+import collections
+import datetime
+from .test_rain import mock_load_image
+
+T0 = datetime.datetime(1970, 1, 1, 0, 0)
+
+
+def shifted(rain, di, dj, minutes=5):
+    """a RainAreas with the image of rain moved by (di, dj) pixels,
+    minutes later"""
+    other = rain.copy()
+    image = rain.intensity_map
+    moved = Image(image.width, image.height)
+    for j in range(max(0, dj), min(image.height, image.height + dj)):
+        for i in range(max(0, di), min(image.width, image.width + di)):
+            moved.set_level_at(i, j, image.get_level_at(i - di, j - dj))
+    other._set_image_time(rain.image_time + datetime.timedelta(minutes=minutes))
+    other._set_intensity_map(moved)
+    return other
+
+
+def square(i, j, size=3, engine='python'):
+    """a RainAreas with an empty image, but for a square of rain"""
+    rain = RainAreas(engine=engine)
+    rain._set_image_time(T0)
+    image = Image(217, 120)
+    for dj in range(0, size):
+        image.set_row(j + dj, bytes([10] * size), i)
+    rain._set_intensity_map(image)
+    return rain
+
+
+class TestNowcast(unittest.TestCase):
+    def engines(self):
+        return ('python', 'numpy') if vector.available() else ('python',)
+
+    def test_heading(self):
+        self.assertEqual(heading_of(0, -1), 0)
+        self.assertEqual(heading_of(1, 0), 90)
+        self.assertEqual(heading_of(0, 2), 180)
+        self.assertEqual(heading_of(-0.5, 0), 270)
+        self.assertAlmostEqual(heading_of(1, -1), 45)
+
+    def test_motion_field(self):
+        for engine in self.engines():
+            with self.subTest(engine=engine):
+                previous = RainAreas(engine=engine)
+                mock_load_image(previous, 'big_blob')
+                current = shifted(previous, 2, -1)
+                nowcast = Nowcast(previous, current)
+                vectors = collections.Counter(nowcast.field.values())
+                self.assertEqual(vectors.most_common(1)[0][0], (2, -1))
+                speeds = collections.Counter((round(vi * 5, 6), round(vj * 5, 6)) for vi, vj in nowcast.velocities)
+                self.assertEqual(speeds.most_common(1)[0][0], (2, -1))
+
+    @unittest.skipUnless(vector.available(), "NumPy is not installed")
+    def test_engines(self):
+        previous = RainAreas(engine='python')
+        mock_load_image(previous, 'big_blob')
+        current = shifted(previous, 1, 3)
+        current.remove_blobs(5)   # not exactly the same image
+        self.assertEqual(
+            vector.block_motion(vector.as_array(previous.intensity_map), vector.as_array(current.intensity_map), 16, 4,
+                                sorted(((di, dj) for dj in range(-4, 5) for di in range(-4, 5)),
+                                       key=lambda s: (s[0] * s[0] + s[1] * s[1], s[1], s[0]))),
+            block_motion(previous.intensity_map, current.intensity_map, 16, 4))
+
+    def test_tracks(self):
+        previous = square(10, 50)
+        current = shifted(previous, 2, 0)
+        nowcast = Nowcast(previous, current)
+        self.assertEqual(len(nowcast.tracks), 1)
+        other, blob, overlap = nowcast.tracks[0]
+        self.assertEqual(overlap, 3)
+        self.assertEqual(nowcast.velocities, [(0.4, 0.0)])
+
+    def test_arrival(self):
+        for engine in self.engines():
+            with self.subTest(engine=engine):
+                previous = square(10, 50, engine=engine)
+                current = shifted(previous, 2, 0)   # now at columns 12 to 14, moving east at 0.4 pixels per minute
+                nowcast = Nowcast(previous, current)
+                ahead, behind, under, aside = nowcast.arrivals([current.pixel_to_location(p) for p in (
+                    Pixel(30, 51), Pixel(5, 51), Pixel(13, 51), Pixel(30, 60))])
+                self.assertAlmostEqual(ahead.eta, (30 - 14) / 0.4)
+                self.assertEqual(ahead.time, T0 + datetime.timedelta(minutes=45))
+                self.assertEqual(ahead.bearing, 270)   # comes from the west
+                self.assertEqual(ahead.heading, 90)    # goes to the east
+                self.assertAlmostEqual(ahead.speed, 0.4 * current.pixel_sizes[0][51] * 60)   # km/h, moving along row 51
+                self.assertIsNone(behind.eta)
+                self.assertEqual(under.eta, 0)
+                self.assertIsNone(aside.eta)
+                self.assertIsNone(nowcast.arrival(current.pixel_to_location(Pixel(30, 51)), horizon=30).eta)
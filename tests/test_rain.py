@@ -2,11 +2,15 @@ import unittest
 from unittest.mock import patch, MagicMock
 from nlannuzel.sgrain.rain import RainAreas
 from nlannuzel.sgrain.geo import Location
-from nlannuzel.sgrain.graph import Pixel, Color
+from nlannuzel.sgrain.graph import Pixel, Color, Image
+from nlannuzel.sgrain import cache
 import datetime
+import os
+import tempfile
+import png
 
 @patch("urllib.request.urlopen")
-def mock_load_image(rain, test_image, mock_urlopen):
+def mock_load_image(rain, test_image, mock_urlopen, **kwargs):
     # dpsri_70km_2025101516e300000dBR.dpsri.png
     # image from 2025/10/15 16:30
     test_images = {
@@ -24,7 +28,7 @@ def mock_load_image(rain, test_image, mock_urlopen):
     mock_response.read.side_effect = [test_images[test_image], '']  # copyfileobj() calls read() multiple times so we use side_effect instead of return_value to avoid a endless loop
     mock_urlopen.return_value.__enter__.return_value = mock_response
 
-    rain.load_image(dt)
+    rain.load_image(dt, **kwargs)
 
 
 class TestRain(unittest.TestCase):
@@ -71,6 +75,45 @@ class TestRain(unittest.TestCase):
         self.assertAlmostEqual(rain.intensity_at(location, 1), 1/9)
         self.assertAlmostEqual(rain.intensity_at(location, 2), 1/25)
 
+    def test_intensity_in_box(self):
+        rain = RainAreas()
+        mock_load_image(rain, 'big_blob')
+        for i, j, d in ((193, 78, 3), (0, 0, 2), (216, 119, 4), (100, 60, 10), (150, 40, 7)):
+            location = rain.pixel_to_location(Pixel(i, j))
+            levels = [
+                rain.intensity_map.get_level_at(x, y)
+                for x in range(max(0, i - d), min(216, i + d) + 1)
+                for y in range(max(0, j - d), min(119, j + d) + 1)]
+            self.assertAlmostEqual(rain.intensity_at(location, d), sum(levels) / len(levels))
+            self.assertEqual(rain.intensity_sum_at(location, d), sum(levels))
+            self.assertEqual(rain.intensity_max_at(location, d), max(levels))
+            self.assertAlmostEqual(rain.rain_fraction_at(location, d), sum(1 for v in levels if v) / len(levels))
+
+        location = rain.pixel_to_location(Pixel(100, 60))
+        before = rain.intensity_sum_at(location, 2)
+        rain.intensity_map.set_color_at(100, 60, Color.grey(rain.intensity_map.get_level_at(100, 60) + 1))
+        self.assertEqual(rain.intensity_sum_at(location, 2), before + 1)  # table is rebuilt
+        rain.remove_blobs(20)
+        self.assertEqual(rain.rain_fraction_at(rain.pixel_to_location(Pixel(193, 78)), 1), 0)
+
+    def test_intensity_at_window(self):
+        full = RainAreas()
+        mock_load_image(full, 'big_blob')
+        os.remove(cache.sidecar_path(full.filepath))  # or the whole image is read from it
+        for i, j, d in ((193, 78, 0), (193, 78, 3), (0, 0, 2), (216, 119, 4), (100, 60, 1)):
+            location = full.pixel_to_location(Pixel(i, j))
+            rain = RainAreas()
+            mock_load_image(rain, 'big_blob', location=location, d=d)
+            self.assertIsNotNone(rain._window)
+            self.assertEqual(rain.intensity_at(location, d), full.intensity_at(location, d))
+            self.assertIsNotNone(rain._window)  # still partial
+            if j + d + 1 < full.intensity_map.height:
+                self.assertEqual(sum(rain._intensity_map.get_row(j + d + 1)), 0)  # not decoded
+        rain.remove_blobs()  # needs the whole image
+        self.assertIsNone(rain._window)
+        full.remove_blobs()
+        self.assertEqual(rain.intensity_map.data, full.intensity_map.data)
+
     def test_intensity_at_big(self):
         rain = RainAreas()
         mock_load_image(rain, 'big_blob')
@@ -99,6 +142,15 @@ class TestRain(unittest.TestCase):
         self.assertEqual(count_blobs_of_size(   2 ),  7          )
         self.assertEqual(count_blobs_of_size(   1 ), noise_count )  # noise
 
+        for blob in rain.blobs:
+            pixels = list(blob)
+            self.assertEqual(len(pixels), len(blob))
+            self.assertEqual(blob.tl.i, min(p.i for p in pixels))
+            self.assertEqual(blob.br.j, max(p.j for p in pixels))
+            self.assertAlmostEqual(blob.centroid[0], sum(p.i for p in pixels) / len(pixels))
+            self.assertEqual(blob.max_level, max(p.col.g for p in pixels))
+            self.assertAlmostEqual(blob.mean_level, sum(p.col.g for p in pixels) / len(pixels))
+
         rain.remove_blobs()
         self.assertEqual(len(rain.blobs), initial_blobs_count - noise_count)
         self.assertEqual(count_blobs_of_size( 186 ), 1 )
@@ -111,6 +163,22 @@ class TestRain(unittest.TestCase):
         self.assertEqual(count_blobs_of_size(   2 ), 7 )
         self.assertEqual(count_blobs_of_size(   1 ), 0 )  # gone!
 
+    def test_original_image(self):
+        rain = RainAreas()
+        mock_load_image(rain, 'basic')
+        self.assertIsNone(rain._original_image)  # not decoded until needed
+        noise = [blob[0] for blob in rain.grep_blobs(lambda blob: len(blob) == 1)]
+        rain.remove_blobs()
+        image = rain.original_image
+        self.assertEqual(image.width, rain.intensity_map.width)
+        self.assertEqual(image.height, rain.intensity_map.height)
+        for pixel in noise:
+            self.assertEqual(image.get_color_at(pixel.i, pixel.j), Color.grey(0))
+        for blob in rain.blobs:
+            for pixel in blob:
+                col = image.get_color_at(pixel.i, pixel.j)
+                self.assertEqual(col.posterize(rain.color_scale), pixel.col.g)
+
     def test_rain_distance(self):
         rain = RainAreas()
         mock_load_image(rain, 'big_blob')
@@ -122,5 +190,132 @@ class TestRain(unittest.TestCase):
         d = location.distance_to(rain.nearest_rain_location(location))
         self.assertAlmostEqual(d, 2.98, 2)  # now further away
 
+        nearest = rain.nearest_rain_locations(location, 10)
+        self.assertEqual(len(nearest), 10)
+        self.assertAlmostEqual(location.distance_to(nearest[0]), 2.98, 2)
+        distances = sorted(location.distance_to(rain.pixel_to_location(p)) for b in rain.blobs for p in b)[:10]
+        for n, d in zip(nearest, distances):   # ranked in kilometers, not in pixels
+            self.assertAlmostEqual(location.distance_to(n), d, 6)
+        self.assertEqual(rain.rain_locations_within(location, 2.9), [])
+        within = rain.rain_locations_within(location, 5)
+        self.assertTrue(len(within) >= 10)
+        self.assertTrue(all(location.distance_to(n) <= 5 for n in within))
+        count = sum(1 for b in rain.blobs for p in b if location.distance_to(rain.pixel_to_location(p)) <= 5)
+        self.assertEqual(len(within), count)
+
+    def test_pixel_sizes(self):
+        rain = RainAreas()
+        mock_load_image(rain, 'basic')
+        widths, heights = rain.pixel_sizes
+        self.assertEqual(len(widths), rain.intensity_map.height)
+        self.assertEqual(len(heights), rain.intensity_map.height)
+        for j in (0, 60, rain.intensity_map.height - 1):
+            a = rain.pixel_to_location(Pixel(10, j))
+            self.assertAlmostEqual(widths[j], a.distance_to(rain.pixel_to_location(Pixel(11, j))), 6)
+            self.assertAlmostEqual(heights[j], 0.5 * a.distance_to(rain.pixel_to_location(Pixel(10, j + 1 if j == 0 else j - 1)))
+                                   + 0.5 * a.distance_to(rain.pixel_to_location(Pixel(10, j - 1 if j > 0 else j + 1))), 4)
+        self.assertGreater(widths[0], widths[-1] * 0.999)   # nearer to the equator, almost the same width
+        self.assertNotEqual(widths[0], heights[0])          # pixels are not square
+
+    def test_rain_distance_transform(self):
+        rain = RainAreas()
+        mock_load_image(rain, 'big_blob')
+        location = rain.pixel_to_location(Pixel(193, 78))
+        self.assertAlmostEqual(rain.rain_distance_at(location), 0.30, 2)
+        rain.remove_blobs(max_size = 20)   # the noise filter changes the image, and distances
+        self.assertAlmostEqual(rain.rain_distance_at(location), 2.98, 2)
+        nearest = rain.nearest_rain_location(location)
+        self.assertAlmostEqual(location.distance_to(nearest), 2.98, 2)
+        blob = max(rain.blobs, key=len)
+        inside = rain.pixel_to_location(next(iter(blob)))
+        self.assertEqual(rain.rain_distance_at(inside), 0)
+        self.assertEqual(rain.rain_distance_at(inside, threshold=31), None)   # no pixel above the highest level
+        strong = rain.distance_transform(threshold=blob.max_level - 1).nearest(Pixel(193, 78))
+        self.assertEqual(rain.intensity_map.get_level_at(strong.i, strong.j), blob.max_level)
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "distance.png")
+            rain.save_distance_map(file_path, location=location)
+            with open(file_path, "rb") as f:
+                width, height, rows, info = png.Reader(file=f).read()
+                rows = list(rows)
+        self.assertEqual((width, height), (rain.intensity_map.width, rain.intensity_map.height))
+        pixel = next(iter(blob))
+        self.assertEqual(tuple(rows[pixel.j][3 * pixel.i:3 * pixel.i + 3]), (255, 255, 255))   # raining
+
+    def test_distance_map_all_rain(self):
+        rain = RainAreas()
+        mock_load_image(rain, 'big_blob')
+        width, height = rain.intensity_map.width, rain.intensity_map.height
+        rain.use_image(rain.image_time, Image(width=width, height=height, data=bytearray([5]) * (width * height)))
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "distance.png")
+            rain.save_distance_map(file_path)
+            with open(file_path, "rb") as f:
+                rows = list(png.Reader(file=f).read()[2])
+            self.assertEqual({v for row in rows for v in row}, {255})   # raining everywhere
+            mock_load_image(rain, 'big_blob')
+            rain.save_distance_map(file_path, max_distance=0)
+            with open(file_path, "rb") as f:
+                rows = list(png.Reader(file=f).read()[2])
+        self.assertEqual([[v == 255 for v in row[::3]] for row in rows],
+                         [[rain.intensity_map.get_level_at(i, j) != 0 for i in range(0, width)] for j in range(0, height)])
+
+    def test_distance_transform_and_index_agree(self):
+        rain = RainAreas()
+        mock_load_image(rain, 'big_blob')
+        rain.remove_blobs(max_size = 20)
+        widths, heights = rain.pixel_sizes
+        for i, j in ((193, 78), (10, 10), (100, 60), (0, 119), (216, 0)):
+            location = rain.pixel_to_location(Pixel(i, j))
+            nearest = rain.location_to_pixel(rain.nearest_rain_locations(location, 1)[0])
+            d = ((widths[j] * (nearest.i - i))**2 + (heights[j] * (nearest.j - j))**2) ** 0.5
+            self.assertAlmostEqual(rain.rain_distance_at(location), d, 9)   # the pixels may differ if at the same distance
+            other = rain.location_to_pixel(rain.nearest_rain_location(location))
+            self.assertAlmostEqual(((widths[j] * (other.i - i))**2 + (heights[j] * (other.j - j))**2) ** 0.5, d, 9)
+
+    def test_query(self):
+        rain = RainAreas()
+        mock_load_image(rain, 'big_blob')
+        locations = [rain.pixel_to_location(Pixel(i, j)) for i, j in ((193, 78), (10, 10), (100, 60))]
+        locations.append(Location(2.0, 103.8))  # outside of the map
+        reports = rain.query(locations, d=2, filter_noise=20, nearest=True)
+        self.assertEqual(len(reports), 4)
+        for location, report in zip(locations[:3], reports):
+            self.assertTrue(report.inside_map)
+            self.assertEqual(report.image_time, rain.image_time)
+            self.assertEqual(report.intensity, rain.intensity_at(location))
+            self.assertEqual(report.mean_intensity, rain.intensity_at(location, 2))
+            nearest = rain.nearest_rain_location(location)
+            self.assertEqual((report.nearest_rain.lat, report.nearest_rain.lon), (nearest.lat, nearest.lon))
+            self.assertEqual(report.nearest_rain_distance, location.distance_to(nearest))
+        self.assertAlmostEqual(reports[0].nearest_rain_distance, 2.98, 2)
+        self.assertFalse(reports[3].inside_map)
+        self.assertIsNone(reports[3].intensity)
+        self.assertIsNone(reports[3].nearest_rain)
+
+        other = RainAreas()
+        mock_load_image(other, 'basic')
+        self.assertIs(other.locate(locations)[1], rain.locate(locations)[1])  # same image size, reused
+        self.assertEqual([r.mean_intensity for r in other.query(locations)], [None] * 4)
+
+    def test_follow(self):
+        previous = RainAreas(engine='python')
+        mock_load_image(previous, 'basic')
+        rain = previous.copy()
+        rain.intensity_map.set_row(5, bytes([7, 7]), 100)   # a new blob
+        rain.follow(previous)
+        expected = RainAreas(engine='python')
+        mock_load_image(expected, 'basic')
+        expected.intensity_map.set_row(5, bytes([7, 7]), 100)
+        self.assertEqual([b.runs for b in rain.blobs], [b.runs for b in expected.blobs])
+        self.assertEqual(rain._blob_finder.reused, len(previous.blobs))
+        labels = set(b.label for b in previous.blobs)
+        self.assertEqual(len([b for b in rain.blobs if b.label not in labels]), 1)
+
+        rain.remove_blobs(2)
+        after = rain.copy()
+        after.follow(rain)
+        self.assertEqual([(b.label, b.runs) for b in after.blobs], [(b.label, b.runs) for b in rain.blobs])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import patch
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain import cache
+import nlannuzel.sgrain
+import contextlib
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import urllib.error
+from .test_rain import mock_load_image
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        """entry points can answer from the cache without importing
+        the modules that decode and download images"""
+        src = os.path.dirname(os.path.dirname(nlannuzel.sgrain.__path__[0]))
+        code = ("import sys, nlannuzel.sgrain; "
+                "print(' '.join(m for m in ('png', 'numpy', 'urllib.request', 'nlannuzel.sgrain.rain') if m in sys.modules))")
+        env = dict(os.environ, PYTHONPATH=src)
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), '')
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self._dir.name
+        mock_load_image(RainAreas(cache_dir=self.cache_dir), 'basic')   # 1970/01/01 00:00
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def run_cli(self, entry_point, *args):
+        out = io.StringIO()
+        argv = [entry_point.__name__, '-c', self.cache_dir, '-a', '1.3', '-o', '103.8', *args]
+        with patch.object(sys, 'argv', argv), contextlib.redirect_stdout(out):
+            entry_point()
+        return out.getvalue()
+
+    def results_of(self, image_time):
+        filepath = os.path.join(self.cache_dir, RainAreas().filename_of(image_time))
+        return cache._read_results(filepath)
+
+    def test_hit(self):
+        when = ('-Y', '1970', '-M', '1', '-D', '1', '-H', '0', '-m', '2')
+        for entry_point in (nlannuzel.sgrain.rain_intensity_at, nlannuzel.sgrain.nearest_rain_spot):
+            first = self.run_cli(entry_point, *when)
+            with patch.object(RainAreas, 'load_image', side_effect=AssertionError('not from the cache')):
+                self.assertEqual(self.run_cli(entry_point, *when), first)
+        self.assertEqual(len(self.results_of(datetime.datetime(1970, 1, 1, 0, 0))), 2)
+
+    def test_image_replaced(self):
+        when = ('-Y', '1970', '-M', '1', '-D', '1', '-H', '0', '-m', '0')
+        first = self.run_cli(nlannuzel.sgrain.rain_intensity_at, *when)
+        filepath = os.path.join(self.cache_dir, RainAreas().filename_of(datetime.datetime(1970, 1, 1, 0, 0)))
+        os.utime(filepath, ns=(0, 1))   # e.g. downloaded again
+        with patch.object(RainAreas, 'load_image', side_effect=RuntimeError('loaded')):
+            with self.assertRaises(RuntimeError):
+                self.run_cli(nlannuzel.sgrain.rain_intensity_at, *when)   # not the result of the old image
+        self.assertEqual(self.run_cli(nlannuzel.sgrain.rain_intensity_at, *when), first)
+
+    @patch("urllib.request.urlopen")
+    def test_fallback_not_cached(self, mock_urlopen):
+        """the image of 00:05 is not published, the one of 00:00 is
+        used instead, and the result must not be kept for 00:05"""
+        mock_urlopen.side_effect = urllib.error.HTTPError('url', 403, 'Forbidden', None, None)
+        self.run_cli(nlannuzel.sgrain.rain_intensity_at, '-Y', '1970', '-M', '1', '-D', '1', '-H', '0', '-m', '5')
+        self.assertEqual(self.results_of(datetime.datetime(1970, 1, 1, 0, 5)), {})
+
+    def test_rain_report(self):
+        """rain-report gives the same values as the other commands"""
+        when = ('-Y', '1970', '-M', '1', '-D', '1', '-H', '0', '-m', '0')
+        report = json.loads(self.run_cli(nlannuzel.sgrain.rain_report, '-p', '2', *when))
+        self.assertEqual(report['image_time'], '1970-01-01T00:00:00')
+        self.assertEqual(len(report['reports']), 1)
+        r = report['reports'][0]
+        self.assertEqual((r['lat'], r['lon']), (1.3, 103.8))
+        self.assertEqual(str(r['intensity']), self.run_cli(nlannuzel.sgrain.rain_intensity_at, *when).strip())
+        self.assertEqual(str(r['mean_intensity']), self.run_cli(nlannuzel.sgrain.rain_intensity_at, '-p', '2', *when).strip())
+        self.assertEqual(str(r['nearest_rain_distance']), self.run_cli(nlannuzel.sgrain.nearest_rain_spot, *when).strip())
+        self.assertEqual(','.join(map(str, r['nearest_rain'])), self.run_cli(nlannuzel.sgrain.nearest_rain_spot, '-l', *when).strip())
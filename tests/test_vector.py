@@ -0,0 +1,68 @@
+import unittest
+import random
+from nlannuzel.sgrain.rain import RainAreas
+from nlannuzel.sgrain.graph import Color, Image, BlobFinder
+from nlannuzel.sgrain import vector
+from .test_rain import mock_load_image
+
+
+def blob_pixels(blobs):
+    return [[(p.i, p.j, p.col.g) for p in blob] for blob in blobs]
+
+
+def blob_summaries(blobs):
+    return [(b.size, b.ia, b.ja, b.ib, b.jb, b.centroid, b.min_level, b.max_level, b.mean_level) for b in blobs]
+
+
+@unittest.skipUnless(vector.available(), "NumPy is not installed")
+class TestVector(unittest.TestCase):
+    def load(self, test_image):
+        rains = []
+        for engine in RainAreas.engines:
+            rain = RainAreas(engine=engine)
+            mock_load_image(rain, test_image)
+            rains.append(rain)
+        return rains
+
+    def test_intensity_parity(self):
+        for test_image in ('basic', 'big_blob'):
+            python, numpy = self.load(test_image)
+            self.assertEqual(python.original_image.data, numpy.original_image.data)
+            self.assertEqual(python.intensity_map.data, numpy.intensity_map.data)
+
+    def test_blobs_parity(self):
+        for test_image in ('basic', 'big_blob'):
+            python, numpy = self.load(test_image)
+            self.assertEqual(blob_pixels(python.blobs), blob_pixels(numpy.blobs))
+            self.assertEqual(blob_summaries(python.blobs), blob_summaries(numpy.blobs))
+            for max_size in (1, 5, 20):
+                python.remove_blobs(max_size)
+                numpy.remove_blobs(max_size)
+                self.assertEqual(blob_pixels(python.blobs), blob_pixels(numpy.blobs))
+                self.assertEqual(python.intensity_map.data, numpy.intensity_map.data)
+                self.assertEqual(python.original_image.data, numpy.original_image.data)
+
+    def test_nearest_rain_parity(self):
+        for test_image in ('basic', 'big_blob'):
+            python, numpy = self.load(test_image)
+            for max_size in (0, 20):
+                python.remove_blobs(max_size)
+                numpy.remove_blobs(max_size)
+                for i, j in ((193, 78), (0, 0), (216, 119), (100, 60), (30, 90)):
+                    location = python.pixel_to_location(python.intensity_map.get_pixel_at(i, j))
+                    a = python.nearest_rain_location(location)
+                    b = numpy.nearest_rain_location(location)
+                    self.assertEqual((a.lat, a.lon), (b.lat, b.lon))
+                    self.assertEqual(python.intensity_at(location, 2), numpy.intensity_at(location, 2))
+
+    def test_label(self):
+        rng = random.Random(1)
+        for density in (0.2, 0.5, 0.7):
+            rows = [[Color.grey(1 if rng.random() < density else 0) for i in range(0, 40)] for j in range(0, 30)]
+            image = Image(rows=rows)
+            labels = vector.label(vector.as_array(image) != 0)
+            self.assertEqual(blob_pixels(BlobFinder(image).blobs), blob_pixels(vector.blobs_from_labels(image, labels)))
+
+
+if __name__ == '__main__':
+    unittest.main()